@@ -3,7 +3,7 @@
 __cleanup()
 {
     rv=$?
-    rm -rf ${BUILDDIR} ${LOG}
+    rm -rf ${BUILDDIR} ${LOG} ${CCACHE_BIN} ${CCACHE_STATSLOG}
     exit ${rv}
 }
 
@@ -1,13 +1,27 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import json
 import os
+import queue
+import signal
+import socket
+import socketserver
 import sqlite3
 import subprocess
+import sys
+import threading
 import time
 
 builddb = '/tmp/buildcounter.db'
+# Build history is kept across reboots and database re-creation
+historydb = '/opt/buildbot/buildhistory.db'
 gitpath = '/opt/buildbot/cache'
+sockpath = '/tmp/buildcounter.sock'
+
+# Daemon: maximum time to keep database changes uncommitted
+flush_interval = 1
 
 def create_builddb(remove=False):
     '''
@@ -35,14 +49,37 @@ def create_builddb(remove=False):
 
     c.execute("CREATE INDEX repository ON builds(repository)")
 
+    create_refcache(c)
+
     # Save (commit) any changes
     db.commit()
     db.close()
 
 
+def create_history(c):
+    # One record per completed branch run. Append only.
+    c.execute("CREATE TABLE IF NOT EXISTS history.runs \
+                 (id INTEGER PRIMARY KEY, \
+                  repository text NOT NULL, \
+                  branch text NOT NULL, \
+                  reference text NOT NULL, \
+                  starttime INTEGER NOT NULL, \
+                  endtime INTEGER NOT NULL)")
+    # Branch names are only unique per repository ('master' of upstream
+    # and of next).
+    c.execute("DROP INDEX IF EXISTS history.runs_branch")
+    c.execute("CREATE INDEX IF NOT EXISTS history.runs_repository_branch \
+                 ON runs(repository, branch, starttime)")
+    c.execute("CREATE INDEX IF NOT EXISTS history.runs_starttime \
+                 ON runs(starttime)")
+
+
 def opendb(dbname, readonly=False):
     db = sqlite3.connect(dbname, timeout=20)
     db.execute('pragma journal_mode=wal;')
+    db.execute('ATTACH DATABASE ? AS history', [historydb])
+    db.execute('pragma history.journal_mode=wal;')
+    create_history(db.cursor())
     if readonly:
         db.execute('pragma query_only=1;')
     return db
@@ -57,6 +94,16 @@ def closedb(db):
     db.close()
 
 
+def create_refcache(c):
+    # Build references, keyed by repository, branch, and commit SHA
+    c.execute("CREATE TABLE IF NOT EXISTS refcache \
+                 (repository text NOT NULL, \
+                  branch text NOT NULL, \
+                  sha text NOT NULL, \
+                  reference text NOT NULL, \
+                  PRIMARY KEY (repository, branch, sha) )")
+
+
 def git_check_output(path, command):
     git_cmd = ['git', '-C', path] + command
     return subprocess.check_output(git_cmd, encoding='utf-8', errors='ignore',
@@ -69,7 +116,34 @@ def git_run(path, command):
                           stderr=subprocess.DEVNULL)
 
 
+def remote_head(repository, branch):
+    cmd = ['git', 'ls-remote', repository, 'refs/heads/%s' % branch]
+    output = subprocess.check_output(cmd, encoding='utf-8', errors='ignore',
+                                     stderr=subprocess.DEVNULL)
+    if not output:
+        raise RuntimeError('Branch %s not found in %s' % (branch, repository))
+    return output.split()[0]
+
+
 def get_reference(repository, branch):
+    '''
+    Return reference (git describe) for the head of the given branch.
+    Since this may take a long time, it should be called in the background.
+    '''
+
+    sha = remote_head(repository, branch)
+
+    db = open_builddb()
+    c = db.cursor()
+    create_refcache(c)
+    q = """SELECT reference FROM refcache
+           WHERE repository IS ? AND branch IS ? AND sha IS ?"""
+    c.execute(q, [repository, branch, sha])
+    row = c.fetchone()
+    closedb(db)
+    if row:
+        return row[0]
+
     repo = os.path.basename(repository)
     localdir = os.path.join(gitpath, os.path.splitext(repo)[0])
 
@@ -85,19 +159,61 @@ def get_reference(repository, branch):
         subprocess.run(cmd, check=True)
         os.chdir(oldpath)
 
-    # First fetch everything including tags, then the target branch into FETCH_HEAD
-    cmd = ['fetch', 'origin']
-    git_run(localdir, cmd)
-    cmd = ['fetch', 'origin', branch]
+    # Fetch only the target branch, plus tags needed for describe. The
+    # branch may have moved since ls-remote; describe what was fetched.
+    cmd = ['fetch', '--tags', 'origin', branch]
     git_run(localdir, cmd)
+    sha = git_check_output(localdir, ['rev-parse', 'FETCH_HEAD']).strip()
+
+    cmd = ['describe', sha]
+    reference = git_check_output(localdir, cmd).strip()
+
+    db = open_builddb()
+    c = db.cursor()
+    q = """INSERT OR REPLACE INTO refcache (repository, branch, sha, reference)
+           VALUES (?, ?, ?, ?)"""
+    c.execute(q, [repository, branch, sha, reference])
+    closedb(db)
 
-    cmd = ['describe', 'FETCH_HEAD']
-    reference = git_check_output(localdir, cmd)
+    return reference
+
+
+def set_reference(c, repository, branch, starttime, reference):
+    '''
+    Set the reference of the run of repository and branch which started
+    at 'starttime'.
+    '''
+
+    q = """UPDATE builds SET reference = ?
+           WHERE repository IS ? AND branch IS ? AND starttime IS ?"""
+    c.execute(q, [reference, repository, branch, starttime])
+    # The run may have completed before its reference was known
+    q = """UPDATE runs SET reference = ?
+           WHERE id = (SELECT MAX(id) FROM runs
+                       WHERE repository IS ? AND branch IS ?
+                         AND starttime IS ? AND reference IS '')"""
+    c.execute(q, [reference, repository, branch, starttime])
+
+
+def resolve_in_background(repository, branch, starttime):
+    '''
+    Resolve reference in a detached process which updates the database
+    when done.
+    '''
 
-    return reference.strip()
+    cmd = [sys.executable, os.path.abspath(__file__), '--resolve',
+           repository, branch, str(starttime)]
+    subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
 
 
 def build_started(c, repository, branch):
+    '''
+    Count build start. If this is the first build for the repository and
+    branch, return the start time of the new run, otherwise None. The
+    caller is then responsible for resolving the build reference; it is
+    left empty here.
+    '''
 
     q = """SELECT buildcount FROM builds
            WHERE repository IS ? AND branch IS ?"""
@@ -106,12 +222,14 @@ def build_started(c, repository, branch):
         q = """UPDATE builds SET buildcount = buildcount + 1
                WHERE repository IS ? AND branch IS ?"""
         c.execute(q, [repository, branch])
-    else:
-        reference = get_reference(repository, branch)
-        q = """INSERT INTO builds
-            (repository, branch, reference, starttime, endtime, buildcount)
-            VALUES (?, ?, ?, ?, ?, ?)"""
-        c.execute(q, [repository, branch, reference, int(time.time()), 0, 1])
+        return None
+
+    starttime = int(time.time())
+    q = """INSERT INTO builds
+        (repository, branch, reference, starttime, endtime, buildcount)
+        VALUES (?, ?, ?, ?, ?, ?)"""
+    c.execute(q, [repository, branch, '', starttime, 0, 1])
+    return starttime
 
 
 def build_done(c, repository, branch):
@@ -128,7 +246,13 @@ def build_done(c, repository, branch):
     count, = c.fetchone()
     if count == 0:
         # No more active builds
-	# Report builds and remove build entries from database
+        # Save builds in history, report them, and remove build entries
+        # from database
+        q = """INSERT INTO runs
+               (repository, branch, reference, starttime, endtime)
+               SELECT repository, branch, reference, starttime, endtime
+               FROM builds"""
+        c.execute(q)
         q = """SELECT repository, branch, reference, starttime, endtime, buildcount FROM builds"""
         c.execute(q)
         for (repository, branch, reference, starttime, endtime, buildcount) in c.fetchall():
@@ -141,6 +265,297 @@ def build_done(c, repository, branch):
             c.execute(q, [repository, branch])
 
 
+def active_builds(c):
+    q = """SELECT repository, branch, reference, starttime, buildcount FROM builds
+           WHERE buildcount > 0"""
+    c.execute(q)
+    return {(repository, branch): {'reference': reference,
+                                   'starttime': starttime,
+                                   'buildcount': buildcount}
+            for (repository, branch, reference, starttime, buildcount) in c.fetchall()}
+
+
+class BuildCounterHandler(socketserver.StreamRequestHandler):
+    """Handle one client request: a single line of JSON."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.execute(request)
+        except Exception as e:
+            response = {'status': 'error', 'error': str(e)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class BuildCounterServer(socketserver.UnixStreamServer):
+    """Build counter daemon.
+
+    Keeps the database open, batches database commits, and serves the
+    list of active builds from memory.
+    """
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            if client_request({'command': 'query'}, path) is not None:
+                raise RuntimeError('Daemon already running on %s' % path)
+            os.remove(path)
+        super().__init__(path, BuildCounterHandler)
+        # Only remove our own socket when done
+        self.inode = os.stat(path).st_ino
+        self.db = open_builddb()
+        self.cursor = self.db.cursor()
+        self.active = active_builds(self.cursor)
+        self.dirty = False
+        self.last_flush = time.time()
+        # References are resolved in worker threads. Results are queued
+        # and written to the database from the server thread.
+        self.resolver = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.resolved = queue.Queue()
+        for (repository, branch), build in self.active.items():
+            if not build['reference']:
+                self.resolve(repository, branch, build['starttime'])
+
+    def resolve(self, repository, branch, starttime):
+        def done(future):
+            try:
+                reference = future.result()
+            except Exception:
+                return
+            self.resolved.put((repository, branch, starttime, reference))
+        self.resolver.submit(get_reference, repository, branch).add_done_callback(done)
+
+    def execute(self, request):
+        command = request['command']
+        if command == 'query':
+            return {'status': 'ok',
+                    'builds': [{'repository': repository, 'branch': branch, **build}
+                               for (repository, branch), build in sorted(self.active.items())]}
+        if command == 'reset':
+            # Database re-creation: the daemon keeps the database open,
+            # so clear its tables instead of removing it.
+            self.cursor.execute('DELETE FROM builds')
+            # Databases created by older versions have no reference cache
+            create_refcache(self.cursor)
+            self.cursor.execute('DELETE FROM refcache')
+            self.active = {}
+            self.dirty = True
+            self.flush()
+            return {'status': 'ok'}
+        repository = request['repository']
+        branch = request['branch']
+        if command == 'start':
+            starttime = build_started(self.cursor, repository, branch)
+            if starttime is not None:
+                self.resolve(repository, branch, starttime)
+        elif command == 'complete':
+            build_done(self.cursor, repository, branch)
+        else:
+            raise ValueError('Unknown command %s' % command)
+        self.dirty = True
+        self.update_active(command, repository, branch)
+        return {'status': 'ok'}
+
+    def update_active(self, command, repository, branch):
+        key = (repository, branch)
+        if command == 'start':
+            if key in self.active:
+                self.active[key]['buildcount'] += 1
+            else:
+                # New entry; the reference is only known to the database.
+                self.active.update(active_builds(self.cursor))
+        elif key in self.active:
+            self.active[key]['buildcount'] -= 1
+            if self.active[key]['buildcount'] <= 0:
+                del self.active[key]
+
+    def flush(self):
+        if self.dirty:
+            self.db.commit()
+            self.dirty = False
+        self.last_flush = time.time()
+
+    def service_actions(self):
+        while not self.resolved.empty():
+            repository, branch, starttime, reference = self.resolved.get()
+            set_reference(self.cursor, repository, branch, starttime, reference)
+            self.dirty = True
+            build = self.active.get((repository, branch))
+            if build and build['starttime'] == starttime:
+                build['reference'] = reference
+        if time.time() - self.last_flush >= flush_interval:
+            self.flush()
+
+    def server_close(self):
+        self.resolver.shutdown(wait=False)
+        self.flush()
+        closedb(self.db)
+        super().server_close()
+        try:
+            if os.stat(self.server_address).st_ino == self.inode:
+                os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def run_daemon():
+    server = BuildCounterServer(sockpath)
+    # pkill sends SIGTERM. Stop serving and flush pending changes.
+    # shutdown() waits for serve_forever() to return, so it must not be
+    # called from the signal handler, which runs in the serving thread.
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever(poll_interval=flush_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def client_request(request, path=sockpath):
+    """Send request to daemon. Return None if the daemon is not running."""
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            s.sendall(json.dumps(request).encode() + b'\n')
+            response = s.makefile('rb').readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    response = json.loads(response)
+    if response['status'] != 'ok':
+        raise RuntimeError(response.get('error', 'unknown error'))
+    return response
+
+
+def print_builds(builds):
+    for build in builds:
+        print("%s %s %s started %s active builds %d" %
+              (build['repository'], build['branch'], build['reference'],
+               time.asctime(time.localtime(build['starttime'])),
+               build['buildcount']))
+
+
+def percentile(values, p):
+    # Nearest rank percentile of a sorted list
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def duration(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def label(repository, branch):
+    # Short name of a branch of a repository, such as 'linux-next:master'
+    repo = os.path.basename(repository.rstrip('/'))
+    if repo.endswith('.git'):
+        repo = repo[:-len('.git')]
+    return '%s:%s' % (repo, branch)
+
+
+def report(c, days, top):
+    '''
+    Report build history for the last 'days' days: per-branch duration
+    percentiles and trend, slowest runs, and overlap between branches.
+    '''
+
+    now = int(time.time())
+    since = now - days * 24 * 60 * 60
+    week = now - 7 * 24 * 60 * 60
+
+    q = """SELECT repository, branch, starttime, endtime - starttime FROM runs
+           WHERE starttime >= ? ORDER BY starttime"""
+    c.execute(q, [since])
+    runs = {}
+    for repository, branch, starttime, seconds in c.fetchall():
+        runs.setdefault((repository, branch), []).append((starttime, seconds))
+    if not runs:
+        print('No builds in the last %d days' % days)
+        return
+
+    print('Build durations, last %d days' % days)
+    print('%-32s %5s %9s %9s %9s %9s %7s' %
+          ('branch', 'runs', 'p50', 'p90', 'p99', 'max', 'trend'))
+    stats = []
+    for key, branchruns in runs.items():
+        ordered = sorted(seconds for _, seconds in branchruns)
+        # Trend: median of the runs started in the last 7 days compared
+        # to the median of all runs in the reporting period
+        recent = sorted(seconds for starttime, seconds in branchruns
+                        if starttime >= week)
+        p50 = percentile(ordered, 50)
+        if not recent:
+            trend = '-'
+        elif p50:
+            trend = '%+.0f%%' % ((percentile(recent, 50) - p50) * 100 / p50)
+        else:
+            trend = '+0%'
+        stats.append((p50, label(*key), len(ordered), percentile(ordered, 90),
+                      percentile(ordered, 99), ordered[-1], trend))
+    for p50, branch, count, p90, p99, longest, trend in sorted(stats, reverse=True):
+        print('%-32s %5d %9s %9s %9s %9s %7s' %
+              (branch, count, duration(p50), duration(p90), duration(p99),
+               duration(longest), trend))
+
+    print()
+    print('Slowest runs')
+    q = """SELECT repository, branch, reference, starttime,
+                  endtime - starttime AS seconds
+           FROM runs WHERE starttime >= ? ORDER BY seconds DESC LIMIT ?"""
+    c.execute(q, [since, top])
+    for repository, branch, reference, starttime, seconds in c.fetchall():
+        print('%-32s %-28s %s %9s' %
+              (label(repository, branch), reference, time.strftime('%Y-%m-%d %H:%M',
+                                                time.localtime(starttime)),
+               duration(seconds)))
+
+    print()
+    print('Overlap between branches')
+    # Each overlapping pair of runs is counted once, as the run starting
+    # later (b) overlapping the run starting earlier (a). Pairs are
+    # ordered here, since either branch may have started first.
+    q = """SELECT a.repository, a.branch, b.repository, b.branch,
+                  COUNT(*),
+                  SUM(MIN(a.endtime, b.endtime) - b.starttime)
+           FROM runs a JOIN runs b
+             ON b.starttime BETWEEN a.starttime AND a.endtime
+            AND (b.starttime > a.starttime OR b.id > a.id)
+           WHERE a.starttime >= ?
+             AND (a.repository != b.repository OR a.branch != b.branch)
+           GROUP BY a.repository, a.branch, b.repository, b.branch"""
+    c.execute(q, [since])
+    overlaps = {}
+    for repo_a, branch_a, repo_b, branch_b, count, seconds in c.fetchall():
+        key = tuple(sorted([(repo_a, branch_a), (repo_b, branch_b)]))
+        total = overlaps.get(key, (0, 0))
+        overlaps[key] = (total[0] + count, total[1] + seconds)
+    for (first, second), (count, seconds) in sorted(
+            overlaps.items(), key=lambda o: o[1][1], reverse=True)[:top]:
+        print('%-32s %-32s %5d runs %9s' %
+              (label(*first), label(*second), count, duration(seconds)))
+
+    # Peak and average number of concurrently running branches
+    q = """SELECT starttime, endtime FROM runs WHERE starttime >= ?"""
+    c.execute(q, [since])
+    events = []
+    for starttime, endtime in c.fetchall():
+        events += [(starttime, 1), (endtime, -1)]
+    events.sort()
+    active = peak = 0
+    busy = weighted = 0
+    last = events[0][0]
+    for when, change in events:
+        if active:
+            busy += when - last
+            weighted += active * (when - last)
+        last = when
+        active += change
+        peak = max(peak, active)
+    print()
+    print('Peak concurrent branches %d, average %.1f while building' %
+          (peak, weighted / busy if busy else 0))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Maintain database of active builds')
     parser.add_argument('-r', '--remove', action='store_true',
@@ -149,23 +564,95 @@ if __name__ == '__main__':
         help='Build started')
     parser.add_argument('-c', '--complete', action='store_true',
         help='Build complete')
+    parser.add_argument('-q', '--query', action='store_true',
+        help='List active builds')
+    parser.add_argument('-d', '--daemon', action='store_true',
+        help='Run as daemon, serving requests on %s' % sockpath)
+    parser.add_argument('-R', '--report', action='store_true',
+        help='Report build history')
+    parser.add_argument('--days', type=int, default=90,
+        help='Report period in days (default 90)')
+    parser.add_argument('--top', type=int, default=10,
+        help='Number of entries in report lists (default 10)')
+    parser.add_argument('--resolve', action='store_true',
+        help=argparse.SUPPRESS)
     parser.add_argument('details', type=str, help='Repository, branch', nargs='*')
 
     args = parser.parse_args()
 
-    if not args.start and not args.complete and not args.remove:
+    if args.resolve:
+        # Internal: resolve build reference in the background
+        reference = get_reference(args.details[0], args.details[1])
+        db = open_builddb()
+        set_reference(db.cursor(), args.details[0], args.details[1],
+                      int(args.details[2]), reference)
+        closedb(db)
+        exit(0)
+
+    if args.report:
+        db = open_builddb(readonly=True)
+        report(db.cursor(), args.days, args.top)
+        db.close()
+        exit(0)
+
+    if not (args.start or args.complete or args.remove or args.query or
+            args.daemon):
         parser.error('At leat one command option is necessary')
 
     if (args.start or args.complete) and len(args.details) != 2:
         parser.error('Must have both repository and branch names')
 
-    create_builddb(args.remove)
+    if args.daemon and client_request({'command': 'query'}) is not None:
+        parser.error('Daemon already running on %s' % sockpath)
+
+    # The daemon holds the database open; ask it to clear the database
+    # instead of removing it underneath.
+    if args.remove and client_request({'command': 'reset'}) is None:
+        create_builddb(remove=True)
+
+    create_builddb()
+
+    if args.daemon:
+        run_daemon()
+        exit(0)
+
+    # Use the daemon if it is running, otherwise access the database directly.
+    requests = []
+    if args.start:
+        requests.append('start')
+    if args.complete:
+        requests.append('complete')
+    if args.query:
+        requests.append('query')
+
+    if requests:
+        response = None
+        for command in requests:
+            request = {'command': command}
+            if args.details:
+                request['repository'] = args.details[0]
+                request['branch'] = args.details[1]
+            response = client_request(request)
+            if response is None:
+                break
+            if command == 'query':
+                print_builds(response['builds'])
+        if response is not None:
+            exit(0)
+
     db = open_builddb()
     c = db.cursor()
 
+    starttime = None
     if args.start:
-        build_started(c, args.details[0], args.details[1])
+        starttime = build_started(c, args.details[0], args.details[1])
     if args.complete:
         build_done(c, args.details[0], args.details[1])
+    if args.query:
+        print_builds([{'repository': repository, 'branch': branch, **build}
+                      for (repository, branch), build in sorted(active_builds(c).items())])
 
     closedb(db)
+
+    if starttime is not None:
+        resolve_in_background(args.details[0], args.details[1], starttime)
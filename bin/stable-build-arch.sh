@@ -83,8 +83,9 @@ PREFIX_PPC=powerpc64-linux-
 PREFIX_S390="s390-linux-"
 PREFIX_X86="x86_64-linux-"
 
-BUILDDIR="/tmp/buildbot-builddir"
-LOG="/tmp/buildlog.stable-build-arch"
+# Several image builds may run on a worker at the same time
+BUILDDIR="/tmp/buildbot-builddir.$$"
+LOG="/tmp/buildlog.stable-build-arch.$$"
 
 trap __cleanup EXIT SIGHUP SIGINT SIGQUIT SIGILL SIGTRAP SIGABRT SIGBUS SIGFPE SIGSEGV SIGALRM SIGTERM SIGPWR
 
@@ -330,6 +331,302 @@ then
 	EXTRA_CMD="${EXTRA_CMD} SUBARCH=${SUBARCH}"
 fi
 
+# Optional compiler cache. Enable with STABLE_BUILD_CCACHE=1.
+# The cache is shared by all builds on a worker and limited to
+# STABLE_BUILD_CCACHE_SIZE (default 20G). Cache entries are keyed by
+# compiler version and prefix (and thus toolchain version and
+# architecture) and, through the generated configuration headers,
+# by the kernel configuration.
+#
+# The compilers are replaced with links to ccache in ${CCACHE_BIN},
+# which comes first in PATH, so the make command line (CROSS_COMPILE,
+# CROSS32_COMPILE, LLVM) is the same with and without cache.
+# Compiler paths are rewritten relative to CCACHE_BASEDIR, the source
+# tree. The per-process build directory is therefore placed in the
+# source tree, so that builds in different processes and checkouts
+# share cache entries. Each build logs its cache results to
+# CCACHE_STATSLOG, so concurrent builds do not affect its statistics.
+CCACHE_BIN=""
+ccache_hits=0
+ccache_misses=0
+ccache_saved=0
+if [[ "${STABLE_BUILD_CCACHE}" = "1" ]] && command -v ccache >/dev/null 2>&1; then
+    if [[ -w "/var/cache/buildbot" ]]; then
+	export CCACHE_DIR="/var/cache/buildbot/ccache"
+    else
+	export CCACHE_DIR="/tmp/buildbot-cache/ccache"
+    fi
+    export CCACHE_MAXSIZE="${STABLE_BUILD_CCACHE_SIZE:-20G}"
+    export CCACHE_COMPILERCHECK="string:${PREFIX}${compiler_version}"
+    export CCACHE_BASEDIR="$(pwd)"
+    export CCACHE_NOHASHDIR=1
+    export CCACHE_STATSLOG="${LOG}.ccache"
+    BUILDDIR="${CCACHE_BASEDIR}/.builddir.$$"
+    CCACHE_BIN="/tmp/buildbot-ccache.$$"
+    mkdir -p "${CCACHE_BIN}"
+    if [[ "${CCMD}" = "clang" ]]; then
+	compilers=(clang)
+    else
+	compilers=("${PREFIX}gcc")
+	if [[ -n "${PREFIX32}" ]]; then
+	    compilers+=("${PREFIX32}gcc")
+	fi
+    fi
+    for c in "${compilers[@]}"; do
+	ln -s "$(command -v ccache)" "${CCACHE_BIN}/${c}"
+    done
+    PATH="${CCACHE_BIN}:${PATH}"
+    echo "Compiler cache: ${CCACHE_DIR} (max ${CCACHE_MAXSIZE})"
+    echo
+fi
+
+# Optional result cache. Enable with STABLE_BUILD_RESULT_CACHE=1.
+# Builds which passed are recorded, keyed by the source tree, the
+# architecture and configuration, the toolchain, the configuration
+# fixups and branch setup, and this script. Builds with a recorded result
+# are not repeated. The cache is only used if the source tree has no local
+# modifications. Entries not used for 14 days are removed.
+resultcache=""
+resultcached=0
+if [[ "${STABLE_BUILD_RESULT_CACHE}" = "1" ]] && git diff --quiet HEAD; then
+    if [[ -w "/var/cache/buildbot" ]]; then
+	resultcache="/var/cache/buildbot/results/build"
+    else
+	resultcache="/tmp/buildbot-cache/results/build"
+    fi
+    mkdir -p "${resultcache}"
+    find "${resultcache}" -type f -mtime +14 -delete 2>/dev/null
+    resultbase="$({
+	git rev-parse 'HEAD^{tree}'
+	echo "${BUILDARCH} ${ARCH} ${SUBARCH} ${configcmd}"
+	echo "${PREFIX} ${PREFIX32} ${CCMD} ${EXTRA_CMD}"
+	echo "${compiler_version}"
+	echo "${assembler_version}"
+	${GCC_PERF} --version 2>/dev/null | head -n 1
+	printf "%s\n" "${fixup[@]}"
+	cat "$0" "${basedir}/build-macros.sh"
+	if [[ -n "${BRANCH}" && -x "${basedir}/branches/${BRANCH}/setup.sh" ]]; then
+	    cat "${basedir}/branches/${BRANCH}/setup.sh"
+	fi
+    } | sha256sum | cut -d ' ' -f1)"
+fi
+
+# Print the result cache key of configuration $1
+result_key()
+{
+    echo "${resultbase} $1" | sha256sum | cut -d ' ' -f1
+}
+
+# Select the configurations of shard k of n (STABLE_BUILD_SHARD="k/n").
+# Configurations are assigned longest first to the shard with the least
+# total build time so far, using the build times in STABLE_BUILD_WEIGHTS
+# ("config=seconds ..."). Configurations without history are assumed to
+# take the average time. All shards must see the same weights to select
+# disjoint sets; the build master passes the same weights to all shards.
+shard_configs()
+{
+    local shard="${STABLE_BUILD_SHARD%/*}"
+    local shards="${STABLE_BUILD_SHARD#*/}"
+
+    printf "%s\n" "$@" | awk -v shard="${shard}" -v shards="${shards}" \
+		-v weights="${STABLE_BUILD_WEIGHTS}" '
+	BEGIN {
+	    nw = split(weights, w, " ")
+	    for (i = 1; i <= nw; i++) {
+		split(w[i], kv, "=")
+		weight[kv[1]] = kv[2]
+	    }
+	}
+	{ config[NR] = $0 }
+	END {
+	    known = 0; total = 0
+	    for (i = 1; i <= NR; i++) {
+		if (config[i] in weight) {
+		    known++
+		    total += weight[config[i]]
+		}
+	    }
+	    avg = known ? total / known : 1
+	    for (i = 1; i <= NR; i++) {
+		t[i] = (config[i] in weight) ? weight[config[i]] + 0 : avg
+		order[i] = i
+	    }
+	    # Longest first, stable for equal weights
+	    for (i = 2; i <= NR; i++) {
+		for (j = i; j > 1; j--) {
+		    a = order[j - 1]; b = order[j]
+		    if (t[a] > t[b] || (t[a] == t[b] && a < b))
+			break
+		    order[j - 1] = b; order[j] = a
+		}
+	    }
+	    for (s = 1; s <= shards; s++)
+		load[s] = 0
+	    for (i = 1; i <= NR; i++) {
+		best = 1
+		for (s = 2; s <= shards; s++)
+		    if (load[s] < load[best])
+			best = s
+		load[best] += t[order[i]]
+		owner[order[i]] = best
+	    }
+	    for (i = 1; i <= NR; i++)
+		if (owner[i] == shard)
+		    print config[i]
+	}'
+}
+
+if [[ -n "${STABLE_BUILD_SHARD}" ]]; then
+    cmd=($(shard_configs "${cmd[@]}"))
+    echo "Shard ${STABLE_BUILD_SHARD}: ${#cmd[@]} configurations"
+    echo
+fi
+
+# Generate the configuration for target $1 in ${BUILDDIR}: make the
+# default configuration, apply fixups and branch specific initialization,
+# then resolve it with ${configcmd}. Return 1 if that failed.
+make_config()
+{
+    local f
+
+    if ! make ${CROSS} ${CROSS32} ARCH=${ARCH} O=${BUILDDIR} ${EXTRA_CMD} $1 </dev/null >${LOG} 2>&1; then
+	# Only report an error if the default configuration
+	# does not exist.
+	if grep -q "No rule to make target" ${LOG}; then
+	    echo "failed (config) - skipping"
+	elif grep -q "Can't find default configuration" ${LOG}; then
+	    echo "failed (config) - skipping"
+	else
+	    echo "failed (config)"
+	    dumplog 100 "${LOG}"
+	fi
+	return 1
+    fi
+    # run config file fixups if necessary
+    for f in "${fixup[@]}"; do
+	sed -i -e "${f}" ${BUILDDIR}/.config
+    done
+
+    # Always disable CONFIG_WERROR.
+    # Commit 3fe617ccafd6 ("Enable '-Werror' by default for all kernel
+    # builds") enables -Werror for all builds, causing a large number
+    # of failures for both compile and boot test images. This hides real
+    # compile and boot failures and thus isn't useful for this testbed.
+    # Disable it.
+
+    # Run branch specific initialization if necessary
+    if [ -n "${BRANCH}" -a -x "${basedir}/branches/${BRANCH}/setup.sh" ]
+    then
+	. ${basedir}/branches/${BRANCH}/setup.sh ${ARCH} ${BRANCH} ${BUILDDIR}
+    fi
+
+    if ! make ${CROSS} ARCH=${ARCH} O=${BUILDDIR} ${EXTRA_CMD} "${configcmd}" </dev/null >/dev/null 2>&1; then
+	echo "failed (${configcmd}) - skipping"
+	return 1
+    fi
+    return 0
+}
+
+# Optional cache of resolved configurations. Enable with
+# STABLE_BUILD_CONFIG_CACHE=1. Generating a configuration parses all
+# Kconfig files several times. Configurations are cached, keyed by the
+# Kconfig files, default configurations, and Makefiles involved, the
+# toolchains (Kconfig checks their features), the fixups, and the branch
+# specific initialization. Entries not used for 14 days are removed.
+configcache=""
+if [[ "${STABLE_BUILD_CONFIG_CACHE}" = "1" ]] && git diff --quiet HEAD; then
+    if [[ -w "/var/cache/buildbot" ]]; then
+	configcache="/var/cache/buildbot/configs"
+    else
+	configcache="/tmp/buildbot-cache/configs"
+    fi
+    mkdir -p "${configcache}"
+    find "${configcache}" -type f -mtime +14 -delete 2>/dev/null
+    configbase="$({
+	git ls-tree -r HEAD | awk -v arch="arch/${ARCH}/" '
+	    $4 ~ /(^|\/)Kconfig[^\/]*$/ ||
+	    $4 ~ /\/configs\// ||
+	    $4 ~ /^scripts\/(kconfig\/|Kconfig|Makefile|[^\/]*\.sh$)/ ||
+	    $4 == "Makefile" ||
+	    (index($4, arch) == 1 && $4 ~ /Makefile[^\/]*$/)'
+	echo "${ARCH} ${SUBARCH} ${configcmd}"
+	echo "${PREFIX} ${PREFIX32} ${CCMD} ${EXTRA_CMD}"
+	echo "${compiler_version}"
+	echo "${assembler_version}"
+	# Host tool versions checked by Kconfig
+	pahole --version 2>/dev/null
+	rustc --version 2>/dev/null
+	printf "%s\n" "${fixup[@]}"
+	if [[ -n "${BRANCH}" && -d "${basedir}/branches/${BRANCH}" ]]; then
+	    tar -C "${basedir}/branches" -cf - "${BRANCH}" 2>/dev/null | md5sum
+	fi
+    } | sha256sum | cut -d ' ' -f1)"
+fi
+
+# Print the configuration cache key of target $1
+config_key()
+{
+    echo "${configbase} $1" | sha256sum | cut -d ' ' -f1
+}
+
+# Restore the cached configuration for target $1. Return 1 if there is none.
+restore_config()
+{
+    local entry
+
+    if [[ -z "${configcache}" ]]; then
+	return 1
+    fi
+    entry="${configcache}/$(config_key "$1")"
+    if [[ ! -s "${entry}" ]]; then
+	return 1
+    fi
+    touch "${entry}"
+    mkdir -p "${BUILDDIR}"
+    cp "${entry}" "${BUILDDIR}/.config"
+    # Branch specific initialization may do more than update the
+    # configuration (such as providing firmware files). Run it on a
+    # scratch configuration.
+    if [ -n "${BRANCH}" -a -x "${basedir}/branches/${BRANCH}/setup.sh" ]
+    then
+	mkdir -p "${BUILDDIR}.setup"
+	(. ${basedir}/branches/${BRANCH}/setup.sh ${ARCH} ${BRANCH} "${BUILDDIR}.setup")
+	rm -rf "${BUILDDIR}.setup"
+    fi
+    return 0
+}
+
+# Add the configuration in ${BUILDDIR} for target $1 to the cache
+save_config()
+{
+    local entry
+
+    if [[ -z "${configcache}" ]]; then
+	return
+    fi
+    entry="${configcache}/$(config_key "$1")"
+    cp "${BUILDDIR}/.config" "${entry}.tmp.$$" && mv "${entry}.tmp.$$" "${entry}"
+}
+
+# Time spent generating configurations, in milliseconds
+configtime=0
+configs=0
+configcached=0
+
+# Print compiler cache hits and misses logged since the last call
+ccache_stats()
+{
+    if [[ -e "${CCACHE_STATSLOG}" ]]; then
+	awk '
+	    $1 == "direct_cache_hit" || $1 == "preprocessed_cache_hit" { hits++ }
+	    $1 == "cache_miss" { misses++ }
+	    END { print hits + 0, misses + 0 }' "${CCACHE_STATSLOG}"
+    else
+	echo 0 0
+    fi
+    rm -f "${CCACHE_STATSLOG}"
+}
+
 if [ ${#fixup[*]} -gt 0 ]; then
     echo "Configuration file workarounds:"
     fmax=$(expr ${#fixup[*]} - 1)
@@ -357,6 +654,18 @@ do
 	    fi
 	done
 
+	key=""
+	if [[ -n "${resultcache}" ]]; then
+	    key="$(result_key "${cmd[$i]}")"
+	    if [[ -e "${resultcache}/${key}" ]]; then
+		touch "${resultcache}/${key}"
+		echo "passed (cached)"
+		builds=$((builds + 1))
+		resultcached=$((resultcached + 1))
+		continue
+	    fi
+	fi
+
 	rm -f .config
 
 	# perf build is special. Use host compiler and build based on defconfig.
@@ -374,53 +683,30 @@ do
 		    errors=$(expr ${errors} + 1)
 	    else
 		    echo "passed"
+		    if [[ -n "${key}" ]]; then
+			touch "${resultcache}/${key}"
+		    fi
 	    fi
 	    i=$(expr $i + 1)
 	    continue
 	fi
 
-	if ! make ${CROSS} ${CROSS32} ARCH=${ARCH} O=${BUILDDIR} ${EXTRA_CMD} ${cmd[$i]} </dev/null >${LOG} 2>&1; then
-	    # Only report an error if the default configuration
-	    # does not exist.
-	    if grep -q "No rule to make target" ${LOG}; then
-	        echo "failed (config) - skipping"
-	    elif grep -q "Can't find default configuration" ${LOG}; then
-	        echo "failed (config) - skipping"
-	    else
-	        echo "failed (config)"
-		dumplog 100 "${LOG}"
-	    fi
-	    i=$(expr $i + 1)
-	    continue
-	fi
-	# run config file fixups if necessary
-	if [ ${#fixup[*]} -gt 0 ]; then
-	    fmax=$(expr ${#fixup[*]} - 1)
-	    for f in $(seq 0 ${fmax})
-	    do
-	        sed -i -e "${fixup[$f]}" ${BUILDDIR}/.config
-	    done
-	fi
-
-	# Always disable CONFIG_WERROR.
-	# Commit 3fe617ccafd6 ("Enable '-Werror' by default for all kernel
-	# builds") enables -Werror for all builds, causing a large number
-	# of failures for both compile and boot test images. This hides real
-	# compile and boot failures and thus isn't useful for this testbed.
-	# Disable it.
-
-	# Run branch specific initialization if necessary
-	if [ -n "${BRANCH}" -a -x "${basedir}/branches/${BRANCH}/setup.sh" ]
-	then
-	    . ${basedir}/branches/${BRANCH}/setup.sh ${ARCH} ${BRANCH} ${BUILDDIR}
-	fi
-
-	if ! make ${CROSS} ARCH=${ARCH} O=${BUILDDIR} ${EXTRA_CMD} "${configcmd}" </dev/null >/dev/null 2>&1; then
-	    echo "failed (${configcmd}) - skipping"
-	    i=$(expr $i + 1)
+	configs=$((configs + 1))
+	configstart=$(date +%s%3N)
+	if restore_config "${cmd[$i]}"; then
+	    configcached=$((configcached + 1))
+	elif make_config "${cmd[$i]}"; then
+	    save_config "${cmd[$i]}"
+	else
+	    configtime=$((configtime + $(date +%s%3N) - configstart))
 	    continue
 	fi
+	configtime=$((configtime + $(date +%s%3N) - configstart))
     	builds=$(expr ${builds} + 1)
+	if [[ -n "${CCACHE_BIN}" ]]; then
+	    ccache_stats >/dev/null
+	    starttime=${SECONDS}
+	fi
 	if ! make ${CROSS} -j${maxload} ARCH=${ARCH} O=${BUILDDIR} ${EXTRA_CMD} </dev/null >/dev/null 2>"${LOG}"; then
 	    if grep -q "CONFIG_WERROR=y" ${BUILDDIR}/.config; then
 		# If this was a test build, repeat and report _all_ errors.
@@ -433,13 +719,35 @@ do
 	    errors=$(expr ${errors} + 1)
 	else
 	    echo "passed"
+	    if [[ -n "${key}" ]]; then
+		touch "${resultcache}/${key}"
+	    fi
+	fi
+	if [[ -n "${CCACHE_BIN}" ]]; then
+	    # Estimate the time saved assuming that the build time is
+	    # spent compiling cache misses.
+	    read hits misses < <(ccache_stats)
+	    if [[ ${misses} -gt 0 ]]; then
+		ccache_saved=$((ccache_saved + (SECONDS - starttime) * hits / misses))
+	    fi
+	    ccache_hits=$((ccache_hits + hits))
+	    ccache_misses=$((ccache_misses + misses))
 	fi
 done
 
 # Clean up again to conserve disk space
 git clean -d -f -x -q
-rm -rf "${BUILDDIR}" "${LOG}"
+rm -rf "${BUILDDIR}" "${LOG}" "${CCACHE_BIN}" "${CCACHE_STATSLOG}"
 
 echo
 echo "-----------------------"
 echo "Total builds: ${builds} Total build errors: ${errors}"
+if [[ ${configs} -gt 0 ]]; then
+    echo "Configuration time: $((configtime / 1000)).$((configtime / 100 % 10))s (${configs} configurations, ${configcached} cached)"
+fi
+if [[ ${resultcached} -gt 0 ]]; then
+    echo "Result cache: ${resultcached} builds passed in an earlier run"
+fi
+if [[ -n "${CCACHE_BIN}" && $((ccache_hits + ccache_misses)) -gt 0 ]]; then
+    echo "Compiler cache: ${ccache_hits} hits, ${ccache_misses} misses ($((ccache_hits * 100 / (ccache_hits + ccache_misses)))% hit rate), estimated ${ccache_saved}s saved"
+fi
@@ -24,3 +24,12 @@ if [[ -e "${pidfile}" ]]; then
 fi
 
 buildbot start "${buildbotdir}"
+
+# (Re-)start build counter daemon
+pkill -f "buildcounter.py -d"
+# Give the daemon time to flush its database changes and exit
+for i in $(seq 50); do
+    pgrep -f "buildcounter.py -d" >/dev/null || break
+    sleep 0.1
+done
+nohup "${rootdir}/bin/buildcounter.py" -d >/dev/null 2>&1 &
@@ -3,6 +3,7 @@
 rootdir="/opt/buildbot"
 destdir="${rootdir}/virtualenv"
 buildslavedir="${rootdir}/slave"
+referencedir="${rootdir}/reference/linux.git"
 pidfile="${buildslavedir}/twistd.pid"
 
 if [[ ! -d "${destdir}" ]]; then
@@ -17,6 +18,10 @@ else
     source "${destdir}/bin/activate"
 fi
 
+# Git checkouts use the reference repository. Make sure it exists;
+# its content is maintained by the reference-<worker> builders.
+"${rootdir}/bin/update-reference.sh" -i "${referencedir}"
+
 if [[ -e "${pidfile}" ]]; then
     buildslave stop "${buildslavedir}"
     rm -f "${pidfile}"
@@ -15,3 +15,10 @@ if [[ -e "${pidfile}" ]]; then
     buildbot stop "${buildbotdir}"
     rm -f "${pidfile}"
 fi
+
+pkill -f "buildcounter.py -d"
+# Give the daemon time to flush its database changes and exit
+for i in $(seq 50); do
+    pgrep -f "buildcounter.py -d" >/dev/null || break
+    sleep 0.1
+done
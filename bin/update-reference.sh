@@ -0,0 +1,166 @@
+#!/bin/bash
+
+# Maintain the shared git reference repository of a worker.
+#
+# All builder checkouts on a worker use this repository as reference
+# (git alternates), so cloning or re-cloning a tree only needs to fetch
+# objects which are not already in the reference repository.
+#
+# usage: update-reference.sh [-i | -m] path [repository ...]
+#   -i	Only create the reference repository if it does not exist
+#   -m	Repack and prune now (if the reference is not in use)
+#
+# Checkouts depend on the objects in the reference repository, so
+# automatic garbage collection is disabled and fetches do not prune.
+# Instead, every ${maintenance_days} days after fetching, the reference
+# is repacked into a single pack and unreachable objects older than
+# ${prune_expire} are removed. Before that, the refs of all checkouts
+# using the reference are copied into it (refs/keep/), so the objects
+# they need stay reachable. Maintenance is postponed while a build runs
+# in any of those checkouts.
+
+# Checkouts using the reference are searched for below this directory
+usersdir="/opt/buildbot/slave"
+maintenance_days=7
+prune_expire="2.weeks.ago"
+
+init=0
+maintain=0
+case "$1" in
+-i)	init=1
+	shift
+	;;
+-m)	maintain=1
+	shift
+	;;
+esac
+
+refdir="$1"
+shift
+
+if [[ -z "${refdir}" ]]; then
+    echo "usage: $0 [-i | -m] path [repository ...]"
+    exit 1
+fi
+
+# List the work trees of checkouts using the reference (git alternates)
+reference_users()
+{
+    local objects="$(realpath -m "${refdir}/objects")"
+    local alternates
+    local line
+
+    find "${usersdir}" -maxdepth 6 -path '*/.git/objects/info/alternates' \
+		2>/dev/null | while read -r alternates; do
+	while read -r line; do
+	    if [[ "$(realpath -m "${line}")" = "${objects}" ]]; then
+		echo "${alternates%/.git/objects/info/alternates}"
+		break
+	    fi
+	done < "${alternates}"
+    done
+}
+
+# Return 0 if a process runs in one of the given work trees. Builds run
+# in their checkout.
+reference_in_use()
+{
+    local proc
+    local cwd
+    local user
+
+    for proc in /proc/[0-9]*; do
+	cwd="$(readlink "${proc}/cwd" 2>/dev/null)" || continue
+	for user in "$@"; do
+	    if [[ "${cwd}/" = "${user}/"* ]]; then
+		return 0
+	    fi
+	done
+    done
+    return 1
+}
+
+maintain_reference()
+{
+    local users=($(reference_users))
+    local i
+
+    if reference_in_use "${users[@]}"; then
+	echo "Reference in use, maintenance postponed"
+	return 0
+    fi
+
+    echo -n "Repacking ... "
+    start=${SECONDS}
+    # Replace the refs kept for checkouts with their current refs
+    git -C "${refdir}" for-each-ref --format='delete %(refname)' refs/keep/ | \
+	git -C "${refdir}" update-ref --stdin
+    for i in "${!users[@]}"; do
+	git -C "${refdir}" fetch -q --no-tags "${users[$i]}" \
+	    "+HEAD:refs/keep/${i}/HEAD" "+refs/*:refs/keep/${i}/*" || \
+	    echo -n "(${users[$i]} skipped) "
+    done
+    # Unreachable objects are dropped if older than ${prune_expire},
+    # and unpacked otherwise, so prune can remove them later.
+    if git -C "${refdir}" repack -q -A -d \
+		--unpack-unreachable="${prune_expire}" && \
+	    git -C "${refdir}" prune --expire="${prune_expire}"; then
+	touch "${stamp}"
+	echo "done ($((SECONDS - start))s, ${#users[@]} checkouts)"
+    else
+	echo "failed"
+	errors=$((errors + 1))
+    fi
+}
+
+if [[ ! -d "${refdir}" ]]; then
+    mkdir -p "$(dirname "${refdir}")"
+    git init -q --bare "${refdir}" || exit 1
+    git -C "${refdir}" config gc.auto 0
+    git -C "${refdir}" config gc.pruneExpire never
+    git -C "${refdir}" config core.logAllRefUpdates false
+fi
+
+if [[ ${init} -ne 0 ]]; then
+    exit 0
+fi
+
+# Only one update at a time
+exec {lockfd}>"${refdir}/update.lock"
+if ! flock -n "${lockfd}"; then
+    echo "Update already in progress"
+    exit 0
+fi
+
+errors=0
+for repo in "$@"; do
+    # One remote per repository, named after the repository
+    name="$(basename "${repo}" .git)"
+    if ! git -C "${refdir}" remote get-url "${name}" >/dev/null 2>&1; then
+	git -C "${refdir}" remote add "${name}" "${repo}"
+    fi
+    git -C "${refdir}" remote set-url "${name}" "${repo}"
+    # Keep branches of each remote in their own namespace
+    git -C "${refdir}" config --replace-all "remote.${name}.fetch" \
+	"+refs/heads/*:refs/remotes/${name}/*"
+
+    echo -n "Fetching ${repo} ... "
+    start=${SECONDS}
+    if git -C "${refdir}" fetch -q --tags "${name}"; then
+	echo "done ($((SECONDS - start))s)"
+    else
+	echo "failed"
+	errors=$((errors + 1))
+    fi
+done
+
+# Maintenance runs under the update lock, so it never overlaps a fetch
+stamp="${refdir}/maintenance.stamp"
+if [[ ${maintain} -ne 0 || ! -e "${stamp}" ||
+	-n "$(find "${stamp}" -mmin +$((maintenance_days * 24 * 60)))" ]]; then
+    maintain_reference
+fi
+
+echo "Reference size: $(du -sh "${refdir}" | cut -f1)"
+
+exit ${errors}
@@ -0,0 +1,108 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Qemu boot time history.
+#
+# The qemu scripts print one '.' for each LOOPTIME interval spent waiting
+# for a qemu session to complete, and 'R' for each retry. The log analyzer
+# converts this into boot times. This module keeps a history of those boot
+# times per branch, qemu target, and build (arch:machine:config) and flags
+# boots which are much slower than the recent history. Boot time creep
+# indicates that a target needs a larger MAXTIME or that a worker is
+# overloaded.
+
+import sqlite3
+import time
+
+historydb = 'boottime.sqlite'
+
+# Number of recent boots used as baseline
+history = 10
+# Minimum number of boots needed to establish a baseline
+minhistory = 3
+# A boot is slow if it takes 'slowfactor' times longer than the baseline,
+# and at least 'slowmargin' seconds longer.
+slowfactor = 1.5
+slowmargin = 15
+# Boots are removed from the history after this many seconds
+keep = 90 * 24 * 3600
+
+class BootHistory(object):
+    def __init__(self, dbname=historydb):
+        self.db = sqlite3.connect(dbname, timeout=10)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS boots
+                (branch text NOT NULL,
+                 target text NOT NULL,
+                 build text NOT NULL,
+                 time INTEGER NOT NULL,
+                 boottime INTEGER NOT NULL,
+                 retries INTEGER NOT NULL)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS boots_key
+                ON boots(branch, target, build, time)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS boots_time
+                ON boots(time)""")
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def baseline(self, branch, target, build):
+        # Median of the most recent boot times, or None if there is not
+        # enough history.
+        c = self.db.execute("""SELECT boottime FROM boots
+                WHERE branch = ? AND target = ? AND build = ?
+                ORDER BY time DESC LIMIT ?""",
+                (branch, target, build, history))
+        times = sorted(row[0] for row in c.fetchall())
+        if len(times) < minhistory:
+            return None
+        return times[len(times) // 2]
+
+    def add(self, branch, target, build, boottime, retries, now=None):
+        self.db.execute("""INSERT INTO boots
+                (branch, target, build, time, boottime, retries)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (branch, target, build, int(now or time.time()), boottime,
+                 retries))
+
+    def expire(self, now=None):
+        # Remove boots older than 'keep' seconds
+        self.db.execute("DELETE FROM boots WHERE time < ?",
+                        (int(now or time.time()) - keep,))
+
+    def check(self, branch, target, results):
+        # Compare boot times in result records against their baseline,
+        # flag slow boots, and add the boot times to the history.
+        # Only successful boots are recorded; failed boots end in
+        # timeouts or crashes and would skew the baseline. Results
+        # replayed from the result cache did not boot at all.
+        # Return the number of slow boots.
+        slow = 0
+        now = time.time()
+        for record in results:
+            if record['status'] != 'passed' or 'boot_time' not in record:
+                continue
+            if record.get('cached'):
+                continue
+            build = record['target']
+            boottime = record['boot_time']
+            baseline = self.baseline(branch, target, build)
+            if baseline is not None:
+                record['boot_baseline'] = baseline
+                if (boottime > baseline * slowfactor and
+                        boottime - baseline >= slowmargin):
+                    record['slow'] = True
+                    slow += 1
+            self.add(branch, target, build, boottime,
+                     record.get('retries', 0), now)
+        self.expire(now)
+        return slow
+
+def checkBoots(branch, target, results, dbname=historydb):
+    # BootHistory.check() on a history opened for this call only. This
+    # blocks on the database, so the master runs it in a thread.
+    history = BootHistory(dbname)
+    try:
+        return history.check(branch, target, results)
+    finally:
+        history.close()
@@ -0,0 +1,131 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Image build time history.
+#
+# Keeps the build time of each configuration per branch and architecture,
+# as measured by the build log analyzer. The history is used to split
+# the configurations of an architecture into shards with similar total
+# build times (see STABLE_BUILD_SHARD in stable-build-arch.sh).
+#
+# The time spent generating configurations is kept as well, per build,
+# to measure the effect of the configuration cache.
+
+import sqlite3
+import time
+
+historydb = 'buildtime.sqlite'
+
+# Number of recent builds used to estimate the build time
+history = 5
+# Builds are removed from the history after this many seconds
+keep = 90 * 24 * 3600
+
+class BuildTimeHistory(object):
+    def __init__(self, dbname=historydb):
+        self.db = sqlite3.connect(dbname, timeout=10)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS builds
+                (branch text NOT NULL,
+                 arch text NOT NULL,
+                 config text NOT NULL,
+                 time INTEGER NOT NULL,
+                 duration REAL NOT NULL)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS builds_key
+                ON builds(arch, config, branch, time)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS builds_time
+                ON builds(time)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS configs
+                (branch text NOT NULL,
+                 arch text NOT NULL,
+                 time INTEGER NOT NULL,
+                 seconds REAL NOT NULL,
+                 configs INTEGER NOT NULL,
+                 cached INTEGER NOT NULL)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS configs_time
+                ON configs(time)""")
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def add(self, branch, arch, config, duration, now=None):
+        self.db.execute("""INSERT INTO builds
+                (branch, arch, config, time, duration)
+                VALUES (?, ?, ?, ?, ?)""",
+                (branch, arch, config, int(now or time.time()), duration))
+
+    def record(self, branch, arch, results):
+        # Add the build times in result records to the history. Builds
+        # which were skipped or taken from the result cache did not build
+        # anything and are not recorded.
+        now = time.time()
+        for record in results:
+            if record['status'] not in ('passed', 'failed'):
+                continue
+            if record.get('cached'):
+                continue
+            if 'duration' not in record or ':' not in record['target']:
+                continue
+            config = record['target'].split(':', 1)[1]
+            self.add(branch, arch, config, record['duration'], now)
+        self.expire(now)
+
+    def expire(self, now=None):
+        # Remove builds and configuration summaries older than 'keep'
+        # seconds
+        limit = int(now or time.time()) - keep
+        self.db.execute("DELETE FROM builds WHERE time < ?", (limit,))
+        self.db.execute("DELETE FROM configs WHERE time < ?", (limit,))
+
+    def recordConfig(self, branch, arch, config, now=None):
+        # Add the configuration phase summary of a build ('config' in the
+        # build log analyzer summary).
+        self.db.execute("""INSERT INTO configs
+                (branch, arch, time, seconds, configs, cached)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (branch, arch, int(now or time.time()), config['seconds'],
+                 config['configs'], config['cached']))
+
+    def weights(self, branch, arch):
+        # Return {config: seconds}, the median of the most recent build
+        # times of each configuration of 'arch'. Configurations which were
+        # not built on 'branch' yet use the history of other branches.
+        # Only the last 'history' builds of each configuration are read.
+        configs = self.db.execute("""SELECT DISTINCT config FROM builds
+                WHERE arch = ?""", (arch,)).fetchall()
+        result = {}
+        for config, in configs:
+            c = self.db.execute("""SELECT duration FROM builds
+                    WHERE arch = ? AND config = ? AND branch = ?
+                    ORDER BY time DESC LIMIT ?""",
+                    (arch, config, branch, history))
+            times = [row[0] for row in c.fetchall()]
+            if not times:
+                c = self.db.execute("""SELECT duration FROM builds
+                        WHERE arch = ? AND config = ? AND branch != ?
+                        ORDER BY time DESC LIMIT ?""",
+                        (arch, config, branch, history))
+                times = [row[0] for row in c.fetchall()]
+            times = sorted(times)
+            result[config] = times[len(times) // 2]
+        return result
+
+# The master accesses the history in threads, not in the reactor, using
+# a history opened for each call.
+
+def recordBuilds(branch, arch, results, config=None, dbname=historydb):
+    # record() and, if 'config' is set, recordConfig()
+    history = BuildTimeHistory(dbname)
+    try:
+        history.record(branch, arch, results)
+        if config is not None:
+            history.recordConfig(branch, arch, config)
+    finally:
+        history.close()
+
+def buildWeights(branch, arch, dbname=historydb):
+    history = BuildTimeHistory(dbname)
+    try:
+        return history.weights(branch, arch)
+    finally:
+        history.close()
@@ -1,3 +1,121 @@
 workers = ['server', 'saturn', 'desktop', 'jupiter', 'mars', 'neptune']
 
+# Worker capacity: CPUs, memory and scratch disk space (GB), and the maximum
+# number of concurrent builds. Builds are admitted to a worker as long as
+# the needs of all builds running there fit (see resources.py). Workers not
+# listed in worker_resources use default_worker_resources.
+
+default_worker_resources = { 'cpus': 8, 'memory': 16, 'disk': 100, 'builds': 3 }
+
+worker_resources = {
+	# 'server':	{ 'cpus': 32, 'memory': 64, 'disk': 500, 'builds': 6 },
+}
+
+# Resources needed by one build of each kind of builder. Each build also
+# takes one of the worker's build slots.
+
+builder_resources = {
+	# stable-build-arch.sh: all configurations of one architecture
+	'build':	{ 'cpus': 8, 'memory': 8, 'disk': 30 },
+	# run-qemu-*.sh: one kernel build per configuration, then boots
+	# (up to qemu_parallel sessions at a time)
+	'qemu':		{ 'cpus': 4, 'memory': 8, 'disk': 10 },
+	# hwmon-build.sh: builds, sparse, and smatch
+	'smatch':	{ 'cpus': 4, 'memory': 4, 'disk': 20 },
+	# update-reference.sh: network and disk bound
+	'reference':	{ 'memory': 1 },
+}
+
 releases = ['5.4', '5.10', '5.15', '6.1', '6.6', '6.12', '6.15']
+
+# repositories
+
+hwmon_repo = 'git://server.roeck-us.net/git/linux.git'
+upstream_repo = 'git://server.roeck-us.net/git/linux-upstream.git'
+stable_repo = 'git://server.roeck-us.net/git/linux-stable.git'
+next_repo = 'git://server.roeck-us.net/git/linux-next.git'
+
+# Shared object store on each worker, used as reference for all checkouts.
+# Maintained by bin/update-reference.sh; start-worker.sh expects the same path.
+reference_repo = '/opt/buildbot/reference/linux.git'
+
+# Skip image builds and qemu sessions which already passed with the same
+# source tree, configuration, toolchain, and root file system. Forced
+# builds always build and run everything.
+result_cache = True
+
+# Cache resolved kernel configurations of image builds on the workers.
+config_cache = True
+
+# branches other than stable releases
+
+hwmon_branches_only = [ 'hwmon', 'hwmon-next', 'testing' ]
+watchdog_branches_only = [ 'watchdog-next' ]
+upstream_branch = [ 'master' ]
+next_branches = [ 'pending-fixes', 'master' ]
+
+# Build architectures and qemu targets. Both are built for all branches
+# unless listed in first_release or qemu_first_release, which specify the
+# oldest release supporting an architecture or qemu target. Branches other
+# than stable releases are always built for all architectures and targets.
+
+stable_arches = [ 'alpha', 'arc', 'arcv2', 'arm', 'arm64',
+		'csky',
+		'hexagon', 'i386',
+		'loongarch',
+		'm68k', 'm68k_nommu',
+		'microblaze', 'mips',
+		'nios2',
+		'openrisc', 'parisc', 'parisc64', 'powerpc',
+		'riscv32', 'riscv64',
+		's390', 'sh', 'sparc32', 'sparc64',
+		'x86_64', 'xtensa',
+		'um' ]
+
+# Architectures whose configuration lists are split into several parts
+# (shards), built in parallel on different workers. The number of shards
+# per architecture; see stable-build-arch.sh.
+
+stable_shards = {
+	'arm':		3,
+	'mips':		2,
+	'powerpc':	2,
+}
+
+first_release = {
+	'hexagon':	'5.15',
+	'loongarch':	'6.1',
+	'nios2':	'6.1',
+	'riscv32':	'5.15',
+	'riscv64':	'5.15',
+}
+
+qemu_targets = [ 'alpha', 'arm', 'arm-aspeed', 'arm-v7', 'arm64', 'arm64be',
+		'm68k', 'microblaze', 'microblazeel', 'mips', 'mipsel', 'mips64', 'mipsel64',
+		'openrisc',
+		'parisc', 'ppc', 'ppc64',
+		'riscv64',
+		's390', 'sparc', 'sparc64',
+		'x86', 'x86_64', 'xtensa',
+		'riscv32', 'sh', 'sheb',
+		'parisc64',
+		'loongarch', 'nios2',
+		'arm64-rt', 'loongarch-rt', 'riscv64-rt', 'x86_64-rt' ]
+
+# Maximum number of qemu sessions per qemu builder running in parallel.
+# Kernels are built one at a time; sessions run while the next kernel builds.
+qemu_parallel = 4
+
+qemu_first_release = {
+	'riscv64':	'5.15',
+	'riscv32':	'5.15',
+	'sh':		'5.10',
+	'sheb':		'5.10',
+	'parisc64':	'5.15',
+	'loongarch':	'6.1',
+	'nios2':	'6.1',
+	'arm64-rt':	'6.15',
+	'loongarch-rt':	'6.15',
+	'riscv64-rt':	'6.15',
+	'x86_64-rt':	'6.15',
+}
@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+
+# Load test for stdio log ingestion on the master.
+#
+# Every line of every stdio log passes through the log observers of its
+# build step (GetBuildReference, and the log analyzer, which also indexes
+# the log; see IndexLog), and all
+# running builds share the master's reactor thread. This script replays
+# recorded or synthetic stdio logs through the observers of
+# StableBuildCommand and QemuBuildCommand, with 'concurrency' steps
+# running at the same time, and reports
+#
+# - throughput in lines and bytes per second, including the work done
+#   when a step completes (summary, history databases, status text).
+# - per-line latency percentiles: the time from the arrival of the log
+#   chunk holding a line until all observers have processed it. In each
+#   round, every running step receives one chunk, and the chunks are
+#   processed one after the other as the reactor would, so latency grows
+#   with concurrency.
+# - the number of setProgress() calls.
+# - the CPU time spent in each observer class, as reported by the master's
+#   metrics (see metrics.py).
+# - memory growth (resident set size) after each pass over all steps.
+#   Growth which does not level off after the first pass indicates that
+#   state of completed steps is kept.
+#
+# After each step, the markers of its log index (see logstore.py) are
+# verified: unit markers must point at the result line of their build
+# unit and traceback markers at a traceback, although each log chunk
+# holds many lines. This is not included in the reported times.
+#
+# The steps run against a minimal local stand-in for the buildbot step
+# API (see below); buildbot is not used even if installed. twisted is
+# used if it is installed; the observers only need twisted.python.log.
+# Errors logged by the steps fail the run. Files written by the steps
+# and the stand-in stdio logs (log index, build and boot time history)
+# go to a temporary directory.
+#
+# Like shellcommands.py, this needs Python 2.
+#
+# Usage:
+#   ingestbench.py [-c concurrency] [-n steps] [-p passes] [-b chunk]
+#                  [-u units] [-s seed] [-q] [logfile ...]
+#
+# Without log files, synthetic logs with 'units' build units each are
+# generated, and the counters of each step are verified. -q selects qemu
+# logs; the default is image build logs. Recorded logs are replayed by the
+# step matching their content and used round robin if more steps than
+# logs are requested.
+
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import types
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Stand-in for the buildbot step API used by shellcommands.py
+
+SUCCESS, WARNINGS, FAILURE, SKIPPED, EXCEPTION, RETRY = range(6)
+
+class Build(object):
+    result = None
+
+class StdioLog(object):
+    """Stand-in for buildbot's LogFile, holding the stdio log of a step.
+
+    Output is written to a file in buildbot's format and fed to the log
+    observers, as buildbot does while the step runs.
+    """
+
+    def __init__(self, filename, observers):
+        self.filename = filename
+        self.observers = observers
+        self.file = open(filename, 'wb')
+        for observer in observers:
+            observer.setLog(self)
+
+    def getFilename(self):
+        return os.path.abspath(self.filename)
+
+    def addStdout(self, data):
+        self.file.write(b'%d:0' % (len(data) + 1) + data + b',')
+        for observer in self.observers:
+            observer.outReceived(data)
+
+    def finish(self):
+        self.file.close()
+
+class Step(object):
+    """Stand-in for buildbot's BuildStep and ShellCommand."""
+
+    name = 'generic'
+    progressMetrics = ()
+    hideStepIf = False
+
+    def __init__(self, **kwargs):
+        self.build = Build()
+        self.properties = {}
+        self.observers = []
+        self.logs = {}
+        self.progressUpdates = 0
+
+    def addLogObserver(self, logname, observer):
+        observer.setStep(self)
+        self.observers.append(observer)
+
+    def getProperty(self, name, default=None):
+        return self.properties.get(name, default)
+
+    def setProperty(self, name, value, source='Step', runtime=True):
+        self.properties[name] = value
+
+    def setProgress(self, metric, value):
+        self.progressUpdates += 1
+
+    def addCompleteLog(self, name, text):
+        self.logs[name] = text
+
+    def start(self):
+        self.stdio = StdioLog('%d-log-%s-stdio' %
+                              (self.getProperty('buildnumber'), self.name),
+                              self.observers)
+
+    def commandComplete(self, cmd):
+        pass
+
+    def createSummary(self, log):
+        pass
+
+    def evaluateCommand(self, cmd):
+        return SUCCESS
+
+    def getText(self, cmd, results):
+        return [self.name]
+
+    def _maybeEvaluate(self, value, *args):
+        if callable(value):
+            return value(*args)
+        return value
+
+class LogLineObserver(object):
+    """Stand-in for buildbot's LogLineObserver.
+
+    Like the original, each observer splits the log chunks it receives
+    into lines at '\\n'. Lines longer than 'maxLineLength' are dropped.
+    """
+
+    maxLineLength = 16384
+
+    def __init__(self):
+        self.step = None
+        self._partial = {}
+
+    def setStep(self, step):
+        self.step = step
+
+    def setLog(self, loog):
+        pass
+
+    def _split(self, channel, data, receive):
+        lines = (self._partial.pop(channel, '') + data).split('\n')
+        rest = lines.pop()
+        if rest:
+            self._partial[channel] = rest
+        for line in lines:
+            if len(line) <= self.maxLineLength:
+                receive(line)
+
+    def outReceived(self, data):
+        self._split('out', data, self.outLineReceived)
+
+    def errReceived(self, data):
+        self._split('err', data, self.errLineReceived)
+
+    def outLineReceived(self, line):
+        pass
+
+    def errLineReceived(self, line):
+        pass
+
+errors = []
+
+def logError(_stuff=None, _why=None, **kwargs):
+    # Stand-in for twisted.python.log.err
+    errors.append(_why)
+    print("error: %s" % _why, file=sys.stderr)
+    traceback.print_exc()
+
+class Fired(object):
+    """Stand-in for a twisted Deferred which fired already.
+
+    The bench has no reactor, so work the steps defer to threads runs
+    synchronously (see installStandIns).
+    """
+    def __init__(self, f, *args, **kwargs):
+        self.failure = None
+        try:
+            self.result = f(*args, **kwargs)
+        except Exception as e:
+            self.result, self.failure = None, e
+
+    def addCallback(self, f, *args, **kwargs):
+        if self.failure is None:
+            self.__init__(f, self.result, *args, **kwargs)
+        return self
+
+    def addErrback(self, f, *args, **kwargs):
+        if self.failure is not None:
+            self.__init__(f, self.failure, *args, **kwargs)
+        return self
+
+def logObserver(event):
+    if event.get('isError'):
+        errors.append(event.get('why'))
+
+def installStandIns():
+    # Register the stand-in modules imported by shellcommands.py, and
+    # minimal twisted modules if twisted is not installed.
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        sys.modules[name] = m
+        return m
+
+    constants = dict(SUCCESS=SUCCESS, WARNINGS=WARNINGS, FAILURE=FAILURE,
+                     SKIPPED=SKIPPED, EXCEPTION=EXCEPTION, RETRY=RETRY)
+    module('buildbot')
+    module('buildbot.steps')
+    module('buildbot.steps.shell', ShellCommand=Step)
+    module('buildbot.process')
+    module('buildbot.process.buildstep', BuildStep=Step,
+           LogLineObserver=LogLineObserver)
+    module('buildbot.status')
+    module('buildbot.status.builder', **constants)
+
+    try:
+        from twisted.python import log
+        log.addObserver(logObserver)
+    except ImportError:
+        module('twisted')
+        module('twisted.python', log=module('twisted.python.log',
+                                            msg=lambda *args, **kwargs: None,
+                                            err=logError))
+        module('twisted.internet', threads=module('twisted.internet.threads'))
+
+installStandIns()
+
+import logstore
+from logmatch import traceback_qemu
+from metrics import metrics
+import shellcommands
+from shellcommands import QemuBuildCommand, StableBuildCommand
+
+shellcommands.threads = types.ModuleType('threads')
+shellcommands.threads.deferToThread = Fired
+
+# Synthetic logs, following the output of stable-build-arch.sh and of
+# the qemu scripts (rootfs/scripts/common.sh).
+
+failRate = 0.05
+skipRate = 0.03
+kunitRate = 0.2
+tracebackRate = 0.3
+maxErrorLines = 1000
+
+def errorLog(rnd, lines):
+    for i in range(rnd.randint(1, lines)):
+        yield ("drivers/bench/bench%d.c:%d:%d: error: implicit declaration of "
+               "function 'bench_%d' [-Werror=implicit-function-declaration]" %
+               (rnd.randint(0, 99), rnd.randint(1, 5000), rnd.randint(1, 80), i))
+
+def bootLog(rnd, lines, crash):
+    t = 0.0
+    count = rnd.randint(1, lines)
+    for i in range(count):
+        t += rnd.random() / 10
+        if crash and i == count // 2:
+            yield "[%12.6f] ------------[ cut here ]------------" % t
+            yield "[%12.6f] Call trace:" % t
+        yield "[%12.6f] bench%d: probe of device %d returned 0" % (t, i % 50, i)
+
+def synthBuildLog(rnd, units):
+    # Return a build log and the expected (total, passed, failed, skipped)
+    lines = ["", "Build reference: v6.6.%d" % rnd.randint(1, 99),
+             "Compiler version: gcc (GCC) 13.2.0",
+             "Assembler version: GNU assembler (GNU Binutils) 2.41", ""]
+    passed = failed = skipped = 0
+    for i in range(units):
+        r = rnd.random()
+        build = "Building arm:config%d ... " % i
+        if r < failRate:
+            lines.append(build + "failed")
+            lines.append("--------------")
+            lines.append("Error log:")
+            lines.extend(errorLog(rnd, maxErrorLines))
+            lines.append("--------------")
+            failed += 1
+        elif r < failRate + skipRate:
+            lines.append(build + "failed (config) - skipping")
+            skipped += 1
+        else:
+            lines.append(build + "passed")
+            passed += 1
+    lines.extend(["", "-----------------------",
+                  "Total builds: %d Total build errors: %d" % (passed + failed,
+                                                                failed),
+                  "Configuration time: %.1fs (%d configurations, %d cached)" %
+                  (rnd.random() * 100, units, rnd.randint(0, units))])
+    return '\n'.join(lines) + '\n', (units, passed, failed, skipped)
+
+def synthQemuLog(rnd, units):
+    lines = ["Build reference: v6.6.%d" % rnd.randint(1, 99),
+             "Compiler version: gcc (GCC) 13.2.0",
+             "Qemu version: QEMU emulator version 8.2.0", ""]
+    passed = failed = skipped = 0
+    for i in range(units):
+        r = rnd.random()
+        build = "Building arm:virt%d:defconfig:initrd ... " % i
+        ticks = "." * rnd.randint(1, 40)
+        if r < failRate:
+            lines.append(build + "running " + ticks + " failed")
+            lines.append("------------")
+            lines.append("qemu log:")
+            lines.extend(bootLog(rnd, maxErrorLines,
+                                 rnd.random() < tracebackRate))
+            lines.append("------------")
+            failed += 1
+        elif r < failRate + skipRate:
+            lines.append(build + "skipped")
+            skipped += 1
+        else:
+            lines.append(build + "running " + ticks + " passed")
+            if rnd.random() < kunitRate:
+                lines.append("Kunit tests:")
+                lines.append("# Totals: pass:%d fail:0 skip:%d total:%d" %
+                             (100, 2, 102))
+            passed += 1
+    return '\n'.join(lines) + '\n', (units, passed, failed, skipped)
+
+qemuLog = re.compile(r'^Building \S+ \.+ running', re.M)
+
+def readLog(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return ('qemu' if qemuLog.search(data) else 'build'), data, None
+
+# Load test
+
+def makeStep(kind, number, slot):
+    if kind == 'qemu':
+        step = QemuBuildCommand()
+        step.properties.update(buildername='qemu-bench-%d' % slot,
+                               release='bench', target='bench')
+    else:
+        step = StableBuildCommand()
+        step.properties.update(buildername='build-bench-%d' % slot,
+                               release='bench', arch='arm')
+    step.properties['buildnumber'] = number
+    return step
+
+def rss():
+    # Current resident set size, in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentiles(samples, points):
+    # samples: list of (value, weight)
+    samples = sorted(samples)
+    total = sum(w for _, w in samples)
+    result = []
+    for p in points:
+        limit = total * p / 100.0
+        acc = 0
+        value = samples[-1][0] if samples else 0
+        for v, w in samples:
+            acc += w
+            if acc >= limit:
+                value = v
+                break
+        result.append(value)
+    return result
+
+class LoadTest(object):
+    def __init__(self, logs, concurrency, chunkSize):
+        self.logs = logs
+        self.concurrency = concurrency
+        self.chunkSize = chunkSize
+        self.latencies = []     # (seconds, lines)
+        self.completions = []   # (seconds, 1)
+        self.lines = 0
+        self.bytes = 0
+        self.progressUpdates = 0
+        self.mismatches = 0
+        self.number = 0
+        self.checkTime = 0.0
+
+    def complete(self, step, expected):
+        start = timer()
+        step.stdio.finish()
+        step.commandComplete(None)
+        step.createSummary(None)
+        results = step.evaluateCommand(None)
+        step.getText(None, results)
+        step.getText2(None, results)
+        self.completions.append((timer() - start, 1))
+        self.progressUpdates += step.progressUpdates
+        c = step.counter.counts
+        counts = (c.numTotal, c.numPassed, c.numFailed, c.numSkipped)
+        if expected is not None and counts != expected:
+            print("%s %d: counters %r, expected %r" %
+                  (step.name, step.getProperty('buildnumber'), counts,
+                   expected))
+            self.mismatches += 1
+        self.checkMarkers(step, expected)
+
+    def checkMarkers(self, step, expected):
+        start = timer()
+        reader = logstore.LogReader(step.counter.store.path)
+        data = reader.read(0)
+        units = 0
+        for kind, label, offset in reader.markers:
+            end = data.find(b'\n', offset)
+            line = data[offset:end].decode('utf-8', 'replace')
+            if kind == 'unit':
+                units += 1
+                ok = line.startswith('Building %s ' % label)
+            else:
+                ok = traceback_qemu.search(line) is not None
+            if not ok:
+                print("%s %d: %s marker for %s at %r" %
+                      (step.name, step.getProperty('buildnumber'), kind,
+                       label, line))
+                self.mismatches += 1
+        if expected is not None and units != expected[0]:
+            print("%s %d: %d unit markers, expected %d" %
+                  (step.name, step.getProperty('buildnumber'), units,
+                   expected[0]))
+            self.mismatches += 1
+        self.checkTime += timer() - start
+
+    def run(self, steps):
+        # Run 'steps' steps, at most 'concurrency' at a time.
+        queue = [self.logs[i % len(self.logs)] for i in range(steps)]
+        queue.reverse()
+        running = []
+        while queue or running:
+            while queue and len(running) < self.concurrency:
+                kind, data, expected = queue.pop()
+                self.number += 1
+                step = makeStep(kind, self.number,
+                                self.number % self.concurrency)
+                step.start()
+                running.append([step, data, 0, expected])
+            start = timer()
+            for entry in running:
+                step, data, offset, expected = entry
+                chunk = data[offset:offset + self.chunkSize]
+                step.stdio.addStdout(chunk)
+                lines = chunk.count('\n')
+                self.latencies.append((timer() - start, lines))
+                self.lines += lines
+                self.bytes += len(chunk)
+                entry[2] = offset + len(chunk)
+            for entry in [e for e in running if e[2] >= len(e[1])]:
+                running.remove(entry)
+                self.complete(entry[0], entry[3])
+
+def ms(seconds):
+    return "%.2f" % (seconds * 1000)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test log ingestion')
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+        help='Number of steps running at the same time')
+    parser.add_argument('-n', '--steps', type=int, default=64,
+        help='Number of steps per pass')
+    parser.add_argument('-p', '--passes', type=int, default=3,
+        help='Number of passes over all steps')
+    parser.add_argument('-b', '--chunk', type=int, default=64 * 1024,
+        help='Log chunk size (the worker sends up to 64 KiB per update)')
+    parser.add_argument('-u', '--units', type=int, default=50,
+        help='Build units per synthetic log')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help='Random seed for synthetic logs')
+    parser.add_argument('-q', '--qemu', action='store_true',
+        help='Generate qemu logs')
+    parser.add_argument('logs', nargs='*', help='Recorded stdio logs')
+    args = parser.parse_args()
+
+    if args.logs:
+        logs = [readLog(path) for path in args.logs]
+    else:
+        rnd = random.Random(args.seed)
+        synth = synthQemuLog if args.qemu else synthBuildLog
+        kind = 'qemu' if args.qemu else 'build'
+        logs = []
+        for _ in range(min(args.steps, 16)):
+            data, expected = synth(rnd, args.units)
+            logs.append((kind, data, expected))
+
+    workdir = tempfile.mkdtemp(prefix='ingestbench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        test = LoadTest(logs, args.concurrency, args.chunk)
+        gc.collect()
+        memory = [rss()]
+        start = timer()
+        for _ in range(args.passes):
+            test.run(args.steps)
+            gc.collect()
+            memory.append(rss())
+        elapsed = timer() - start - test.checkTime
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    MiB = 1024.0 * 1024
+    print("%d steps (%d passes), concurrency %d, %d KiB chunks" %
+          (args.steps * args.passes, args.passes, args.concurrency,
+           args.chunk // 1024))
+    print("%d lines (%.1f MiB) in %.2fs: %.0f lines/s, %.1f MiB/s" %
+          (test.lines, test.bytes / MiB, elapsed,
+           test.lines / max(elapsed, 1e-9), test.bytes / MiB / max(elapsed, 1e-9)))
+    p = percentiles(test.latencies, (50, 90, 99, 100))
+    print("line latency (ms): p50 %s p90 %s p99 %s max %s" %
+          tuple(ms(x) for x in p))
+    p = percentiles(test.completions, (50, 99, 100))
+    print("step completion (ms): p50 %s p99 %s max %s" %
+          tuple(ms(x) for x in p))
+    print("progress updates: %d (%.2f per 1000 lines)" %
+          (test.progressUpdates, test.progressUpdates * 1000.0 /
+           max(test.lines, 1)))
+    for name, stat in sorted(metrics.observers.items()):
+        print("observer %s: %.2fs CPU, %.2f us/line" %
+              (name, stat.cpu, stat.cpu * 1e6 / max(stat.lines, 1)))
+    print("memory (RSS): %.1f MiB at start, %s" %
+          (memory[0] / MiB,
+           ", ".join("%+.1f MiB after pass %d" % ((m - memory[0]) / MiB, i + 1)
+                     for i, m in enumerate(memory[1:]))))
+
+    if test.mismatches or errors:
+        raise SystemExit(1)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+
+# Micro-benchmark for the master side log analyzers.
+#
+# Replays recorded stdio logs through the log analyzers in logmatch.py
+# and through a copy of the original per-line implementation, verifies
+# that both produce the same counters, and reports lines per second.
+#
+# Usage:
+#   logbench.py [-q] [-n repeat] logfile [logfile ...]
+#   logbench.py --check
+#
+# -q selects the qemu log analyzer; the default is the build log analyzer.
+# --check runs the analyzers, and an analyzer derived from the qemu log
+# analyzer to support another log format, against known log snippets.
+
+from __future__ import print_function
+
+import argparse
+import io
+import re
+import time
+
+from logmatch import BuildLogAnalyzer, QemuLogAnalyzer, Rule
+
+# Original implementation, kept for reference and comparison.
+
+passed = re.compile('Building (\S+):(\S+) \.\.\. passed(?: \(cached\))?$')
+failed = re.compile('Building (\S+):(\S+) \.\.\. failed$')
+skipped = re.compile('Building (\S+):(\S+) \.\.\. failed \(\S+\)')
+
+current_qemu = re.compile('Building ([^:\s]+):([^:\s]+):(\S+) \.+ running [\.R]+')
+passed_qemu = re.compile('Building (\S+):(\S+) \.+ running [\.R]+ passed(?: \(cached\))?$')
+failed_qemu = re.compile('Building (\S+):(\S+) .*?failed.*$')
+skipped_qemu = re.compile('Building (\S+):(\S+) \.+ skipped.*$')
+
+kunit_result = re.compile('(?:\[ *\d+\.\d+\](?:\[ *T\d+\])? +)?# ([^:]+): pass:(\d+) fail:(\d+) skip:(\d+) total:\d+$')
+
+class NullStep(object):
+    def setProgress(self, metric, value):
+        pass
+
+class LegacyBuildLogAnalyzer(object):
+    def __init__(self):
+        self.numTotal = 0
+        self.numPassed = 0
+        self.numFailed = 0
+        self.numSkipped = 0
+        self.failed = []
+
+    def outLineReceived(self, line):
+        if line.startswith("Building "):
+            self.numTotal += 1
+            if passed.match(line):
+                self.numPassed += 1
+                self.step.setProgress('pass', self.numPassed)
+            if failed.match(line):
+                self.numFailed += 1
+                self.step.setProgress('fail', self.numFailed)
+                self.failed.append(failed.findall(line))
+            if skipped.match(line):
+                self.numSkipped += 1
+                self.step.setProgress('skipped', self.numSkipped)
+
+class LegacyQemuLogAnalyzer(object):
+    def __init__(self):
+        self.numTotal = 0
+        self.numPassed = 0
+        self.numFailed = 0
+        self.numSkipped = 0
+        self.numKunitPassed = 0
+        self.numKunitFailed = 0
+        self.numKunitSkipped = 0
+        self.tracebacks = False
+        self.current = None
+        self.failed = []
+        self.kunit_failed = []
+
+    def outLineReceived(self, line):
+        current = current_qemu.match(line)
+        if current:
+            self.current = [current.group(1).replace('#','_'), current.group(2).replace('#','_')]
+        if passed_qemu.match(line) or failed_qemu.match(line) or skipped_qemu.match(line):
+            self.numTotal += 1
+            if passed_qemu.match(line):
+                self.numPassed += 1
+                self.step.setProgress('pass', self.numPassed)
+            if failed_qemu.match(line):
+                self.numFailed += 1
+                self.step.setProgress('fail', self.numFailed)
+                self.failed.append(failed_qemu.findall(line))
+            if skipped_qemu.match(line):
+                self.numSkipped += 1
+                self.step.setProgress('skipped', self.numSkipped)
+        if line.find('[ cut here ]') != -1:
+            self.tracebacks = True
+        elif line.find('Call Trace:') != -1:
+            self.tracebacks = True
+        elif line.find('Call trace:') != -1:
+            self.tracebacks = True
+        elif line.find('stack backtrace') != -1:
+            self.tracebacks = True
+        elif line.find('Kernel panic') != -1:
+            self.tracebacks = True
+        elif line.find('show_stack') != -1:
+            self.tracebacks = True
+        elif line.find('(try booting with the "irqpoll" option)') != -1:
+            self.tracebacks = True
+        kunit = kunit_result.match(line)
+        if kunit:
+            if kunit.group(1) == 'Totals':
+                self.numKunitPassed += int(kunit.group(2))
+                self.numKunitFailed += int(kunit.group(3))
+                self.numKunitSkipped += int(kunit.group(4))
+            elif self.current and int(kunit.group(3)) > 0:
+                new = self.current + [kunit.group(1).replace('#','_')]
+                if new not in self.kunit_failed:
+                    self.kunit_failed.append(new)
+
+counters = ['numTotal', 'numPassed', 'numFailed', 'numSkipped', 'failed']
+qemu_counters = counters + ['numKunitPassed', 'numKunitFailed',
+                            'numKunitSkipped', 'tracebacks', 'kunit_failed']
+
+# Known log snippets and the expected results
+
+build_log = [
+    "Build reference: v6.6.1",
+    "Building arm:defconfig ... passed",
+    "Building arm:allmodconfig ... failed",
+    "--------------",
+    "Error log:",
+    "drivers/foo.c:1:1: error: expected ';'",
+    "--------------",
+    "Building arm:tinyconfig ... failed (config) - skipping",
+    "Configuration time: 12.5s (3 configurations, 1 cached)",
+]
+
+qemu_log = [
+    "Build reference: v6.6.1",
+    "Building arm:virt:defconfig:initrd ... running ....R... passed",
+    "Kunit tests:",
+    "# Totals: pass:10 fail:1 skip:2 total:13",
+    "Building arm:virt:multi_v7_defconfig:initrd ... running ..... failed",
+    "------------",
+    "qemu log:",
+    "[    1.000000] Call trace:",
+    "[    1.000000] Call trace:",
+    "------------",
+    "Building arm:vexpress:defconfig:initrd ... skipped",
+]
+
+# Example for supporting another log format without copying an
+# analyzer: kselftest results in qemu logs.
+kselftest_failed = re.compile(r'not ok \d+ selftests: ([^:]+): ')
+
+class KselftestLogAnalyzer(QemuLogAnalyzer):
+    rules = QemuLogAnalyzer.rules + [
+        Rule('kselftest', '_kselftest', prefix='not ok ',
+             regex=kselftest_failed),
+    ]
+
+    def __init__(self):
+        QemuLogAnalyzer.__init__(self)
+        self.kselftestFailed = []
+
+    def _kselftest(self, line, m):
+        self.kselftestFailed.append(m.group(1))
+
+kselftest_log = qemu_log + [
+    "ok 1 selftests: timers: posix_timers",
+    "not ok 2 selftests: net: udpgso",
+]
+
+cached_build_log = [
+    "Building arm:defconfig ... passed (cached)",
+    "Building arm:allmodconfig ... passed",
+]
+
+cached_qemu_log = [
+    "Building arm:virt:defconfig:initrd ... running ....R... passed (cached)",
+    "Building arm:virt:multi_v7_defconfig:initrd ... running . passed",
+]
+
+def analyze(cls, lines):
+    analyzer = cls()
+    analyzer.step = NullStep()
+    for line in lines:
+        analyzer.outLineReceived(line)
+    analyzer.flushProgress()
+    return analyzer
+
+def check():
+    errors = []
+
+    def expect(what, actual, expected):
+        if actual != expected:
+            errors.append("%s: %r != %r" % (what, actual, expected))
+
+    a = analyze(BuildLogAnalyzer, build_log)
+    c = a.counts
+    expect('build counters', (c.numTotal, c.numPassed, c.numFailed,
+                              c.numSkipped), (3, 1, 1, 1))
+    expect('build results', [(r['target'], r['status'], r.get('reason'))
+                             for r in c.results],
+           [('arm:defconfig', 'passed', None),
+            ('arm:allmodconfig', 'failed', None),
+            ('arm:tinyconfig', 'skipped', 'config')])
+    expect('build config', a.config,
+           {'seconds': 12.5, 'configs': 3, 'cached': 1})
+
+    for cls, lines in ((QemuLogAnalyzer, qemu_log),
+                       (KselftestLogAnalyzer, kselftest_log)):
+        name = cls.__name__
+        a = analyze(cls, lines)
+        c = a.counts
+        expect('%s counters' % name, (c.numTotal, c.numPassed, c.numFailed,
+                                      c.numSkipped), (3, 1, 1, 1))
+        expect('%s kunit' % name, (c.numKunitPassed, c.numKunitFailed,
+                                   c.numKunitSkipped), (10, 1, 2))
+        expect('%s tracebacks' % name, [r['tracebacks'] for r in c.results],
+               [False, True, False])
+        expect('%s boot time' % name, (c.results[0]['boot_time'],
+                                       c.results[0]['retries']), (15, 1))
+
+    a = analyze(KselftestLogAnalyzer, kselftest_log)
+    expect('kselftest failures', a.kselftestFailed, ['net'])
+
+    # Results replayed from the result cache
+    a = analyze(BuildLogAnalyzer, cached_build_log)
+    expect('cached build results',
+           [(r['status'], r.get('cached')) for r in a.counts.results],
+           [('passed', True), ('passed', None)])
+    a = analyze(QemuLogAnalyzer, cached_qemu_log)
+    expect('cached qemu results',
+           [(r['status'], r.get('cached'), r['boot_time'])
+            for r in a.counts.results],
+           [('passed', True, 15), ('passed', None, 5)])
+
+    for error in errors:
+        print(error)
+    print("%d checks failed" % len(errors) if errors else "all checks passed")
+    return len(errors)
+
+def readlog(path):
+    with io.open(path, encoding='utf-8', errors='replace') as f:
+        return [line.rstrip('\r\n') for line in f]
+
+def replay(cls, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        analyzer = cls()
+        analyzer.step = NullStep()
+        feed = analyzer.outLineReceived
+        start = time.time()
+        for line in lines:
+            feed(line)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return analyzer, best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark log analyzers')
+    parser.add_argument('-q', '--qemu', action='store_true',
+        help='Use qemu log analyzer')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+        help='Number of runs per log (best run is reported)')
+    parser.add_argument('--check', action='store_true',
+        help='Check analyzers against known log snippets')
+    parser.add_argument('logs', nargs='*', help='Recorded stdio logs')
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(1 if check() else 0)
+    if not args.logs:
+        parser.error('No logs provided')
+
+    if args.qemu:
+        old, new, names = LegacyQemuLogAnalyzer, QemuLogAnalyzer, qemu_counters
+    else:
+        old, new, names = LegacyBuildLogAnalyzer, BuildLogAnalyzer, counters
+
+    errors = 0
+    for path in args.logs:
+        lines = readlog(path)
+        ref, t_old = replay(old, lines, args.repeat)
+        res, t_new = replay(new, lines, args.repeat)
+        for name in names:
+            if getattr(ref, name) != getattr(res.counts, name):
+                print("%s: %s mismatch: %r != %r" %
+                      (path, name, getattr(ref, name),
+                       getattr(res.counts, name)))
+                errors += 1
+        print("%s: %d lines, before %.0f lines/s, after %.0f lines/s (%.2fx)" %
+              (path, len(lines), len(lines) / max(t_old, 1e-9),
+               len(lines) / max(t_new, 1e-9), t_old / max(t_new, 1e-9)))
+
+    if errors:
+        raise SystemExit(1)
@@ -0,0 +1,413 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Line classification for build and qemu logs.
+#
+# Every line of every stdio log passes through the log observers on the
+# master, so the observers must be cheap for the (vast) majority of lines
+# which are of no interest. A LineMatcher checks each line exactly once
+# against a list of rules. Each rule is guarded by a cheap prefix and/or
+# keyword test, and its regular expression is only evaluated if the
+# guard passes. Matching lines are dispatched to the rule's handler.
+#
+# This module must not depend on buildbot so that it can be exercised
+# offline (see logbench.py).
+
+import re
+import time
+
+passed = re.compile('Building (\S+):(\S+) \.\.\. passed(?: \(cached\))?$')
+failed = re.compile('Building (\S+):(\S+) \.\.\. failed$')
+skipped = re.compile('Building (\S+):(\S+) \.\.\. failed \(\S+\)')
+
+current_qemu = re.compile('Building ([^:\s]+):([^:\s]+):(\S+) \.+ running [\.R]+')
+passed_qemu = re.compile('Building (\S+):(\S+) \.+ running [\.R]+ passed(?: \(cached\))?$')
+failed_qemu = re.compile('Building (\S+):(\S+) .*?failed.*$')
+skipped_qemu = re.compile('Building (\S+):(\S+) \.+ skipped.*$')
+
+kunit_result = re.compile('(?:\[ *\d+\.\d+\](?:\[ *T\d+\])? +)?# ([^:]+): pass:(\d+) fail:(\d+) skip:(\d+) total:\d+$')
+
+# Configuration phase summary of stable-build-arch.sh
+config_time = re.compile(r'Configuration time: ([\d.]+)s \((\d+) configurations, (\d+) cached\)')
+
+# Reason for a failure or skipped build, such as "failed (config)".
+result_reason = re.compile(r'(?:failed|skipped) \(([^)]*)\)')
+
+# Qemu boot progress: one '.' per LOOPTIME seconds, 'R' for each retry.
+boot_progress = re.compile(r' running ([\.R]+)')
+# Must match LOOPTIME in rootfs/scripts/common.sh
+looptime = 5
+
+# Any of those in a qemu log indicates a traceback or crash.
+traceback_qemu = re.compile(r'\[ cut here \]|Call [Tt]race:|stack backtrace|'
+                            r'Kernel panic|show_stack|'
+                            r'\(try booting with the "irqpoll" option\)')
+
+class Rule(object):
+    """A single line classification rule.
+
+    The rule applies to lines starting with 'prefix' and containing
+    'keyword' (either may be None). If 'regex' is provided, it must also
+    match the line (or be found in the line if 'search' is True). The
+    target method named 'handler' is then called with the line and the
+    match object (None if there is no regex).
+    """
+
+    __slots__ = ('name', 'handler', 'prefix', 'keyword', 'regex', 'search')
+
+    def __init__(self, name, handler, prefix=None, keyword=None,
+                 regex=None, search=False):
+        self.name = name
+        self.handler = handler
+        self.prefix = prefix
+        self.keyword = keyword
+        self.regex = regex
+        self.search = search
+
+class LineMatcher(object):
+    """Rule set which can be bound to handler objects.
+
+    Rules are evaluated in the order provided. Consecutive rules with the
+    same prefix share a single prefix check.
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+
+    def bind(self, target):
+        return BoundLineMatcher(self.rules, target)
+
+class BoundLineMatcher(object):
+    """A LineMatcher with handlers resolved on a specific target."""
+
+    def __init__(self, rules, target):
+        self._rules = rules
+        self._target = target
+        self._disabled = set()
+        self._compile()
+
+    def _compile(self):
+        groups = []
+        for rule in self._rules:
+            if rule.name in self._disabled:
+                continue
+            if rule.regex is None:
+                check = None
+            elif rule.search:
+                check = rule.regex.search
+            else:
+                check = rule.regex.match
+            entry = (rule.keyword, check, getattr(self._target, rule.handler))
+            if groups and groups[-1][0] == rule.prefix:
+                groups[-1][1].append(entry)
+            else:
+                groups.append((rule.prefix, [entry]))
+        self._groups = tuple((prefix, tuple(entries))
+                             for prefix, entries in groups)
+
+    def disable(self, name):
+        # Stop evaluating a rule, for example because its result
+        # can no longer change.
+        if name not in self._disabled:
+            self._disabled.add(name)
+            self._compile()
+
+    def enable(self, name):
+        if name in self._disabled:
+            self._disabled.discard(name)
+            self._compile()
+
+    def feed(self, line):
+        for prefix, entries in self._groups:
+            if prefix is not None and not line.startswith(prefix):
+                continue
+            for keyword, check, handler in entries:
+                if keyword is not None and keyword not in line:
+                    continue
+                if check is None:
+                    handler(line, None)
+                    continue
+                m = check(line)
+                if m:
+                    handler(line, m)
+
+class Counters(object):
+    """Counter state for build logs."""
+
+    __slots__ = ('numTotal', 'numPassed', 'numFailed', 'numSkipped', 'failed',
+                 'results')
+
+    def __init__(self):
+        self.numTotal = 0
+        self.numPassed = 0
+        self.numFailed = 0
+        self.numSkipped = 0
+        self.failed = []
+        self.results = []
+
+class QemuCounters(Counters):
+    """Counter state for qemu logs."""
+
+    __slots__ = ('numKunitPassed', 'numKunitFailed', 'numKunitSkipped',
+                 'tracebacks', 'kunit_failed', 'slowBoots')
+
+    def __init__(self):
+        Counters.__init__(self)
+        self.numKunitPassed = 0
+        self.numKunitFailed = 0
+        self.numKunitSkipped = 0
+        self.tracebacks = False
+        self.kunit_failed = []
+        self.slowBoots = 0
+
+class LogAnalyzer(object):
+    """Base class for log analyzers.
+
+    Subclasses declare 'rules' (a list of Rule objects) and 'counters',
+    the class holding their counter state. Handlers update self.counts
+    and report progress through self.progress(). Progress updates are
+    rate limited to one update per 'progressInterval' seconds since each
+    update causes status push work on the master; call flushProgress()
+    when the log is complete to report the final values.
+
+    Analyzers also keep a structured record for each build unit (one
+    "Building" line) in self.counts.results; summary() returns those
+    together with the counters.
+
+    If 'marker' is set, it is called with (kind, label) for the line just
+    seen if it is a build unit result ('unit') or the first traceback of a
+    build unit ('traceback'). The label is the build unit.
+
+    To support a new log format, derive from this class (or from one of
+    the analyzers below) and add rules.
+    """
+
+    rules = []
+    counters = Counters
+    progressInterval = 0.25
+    marker = None
+
+    def __init__(self):
+        cls = self.__class__
+        if cls.__dict__.get('_lineMatcher') is None:
+            cls._lineMatcher = LineMatcher(cls.rules)
+        self.counts = self.counters()
+        self._matcher = cls._lineMatcher.bind(self)
+        self._pending = {}
+        self._lastProgress = 0
+        self._lastResult = None
+
+    def started(self):
+        # Called when the step starts; build unit durations are measured
+        # from here.
+        self._lastResult = time.time()
+
+    def outLineReceived(self, line):
+        self._matcher.feed(line)
+
+    def count(self, name, metric):
+        value = getattr(self.counts, name) + 1
+        setattr(self.counts, name, value)
+        if metric:
+            self.progress(metric, value)
+
+    def progress(self, metric, value):
+        self._pending[metric] = value
+        now = time.time()
+        if now - self._lastProgress >= self.progressInterval:
+            self.flushProgress(now)
+
+    def flushProgress(self, now=None):
+        for metric, value in self._pending.items():
+            self.step.setProgress(metric, value)
+        self._pending.clear()
+        self._lastProgress = now or time.time()
+
+    def warnings(self):
+        # Return True if the log indicates a problem even though all
+        # builds passed.
+        return False
+
+    def addResult(self, line, status):
+        # Builds are executed sequentially, and each result line is only
+        # seen when the build unit is complete. The duration is therefore
+        # the time since the previous result (or since the step started).
+        now = time.time()
+        record = {
+            'target': line[len('Building '):].split(' ', 1)[0],
+            'status': status,
+        }
+        m = result_reason.search(line)
+        if m:
+            record['reason'] = m.group(1)
+        if line.endswith(' (cached)'):
+            # Passed in an earlier run; the result was replayed.
+            record['cached'] = True
+        if self._lastResult is not None:
+            record['duration'] = round(now - self._lastResult, 1)
+        self._lastResult = now
+        self.counts.results.append(record)
+        if self.marker is not None:
+            self.marker('unit', record['target'])
+        return record
+
+    def summary(self):
+        c = self.counts
+        return {
+            'total': c.numTotal,
+            'passed': c.numPassed,
+            'failed': c.numFailed,
+            'skipped': c.numSkipped,
+            'results': c.results,
+        }
+
+class BuildLogAnalyzer(LogAnalyzer):
+    # Look for:
+    # Building <arch>:<config> ... passed
+    # Building <arch>:<config> ... passed (cached)
+    # Building <arch>:<config> ... failed
+    # Building <arch:<config> ... failed (config) - skipping
+    # and the time spent generating configurations.
+
+    rules = [
+        Rule('result', '_result', prefix='Building '),
+        Rule('config', '_config', prefix='Configuration time: ',
+             regex=config_time),
+    ]
+
+    def __init__(self):
+        LogAnalyzer.__init__(self)
+        self.config = None
+
+    def summary(self):
+        summary = LogAnalyzer.summary(self)
+        if self.config is not None:
+            summary['config'] = self.config
+        return summary
+
+    def _config(self, line, m):
+        self.config = {
+            'seconds': float(m.group(1)),
+            'configs': int(m.group(2)),
+            'cached': int(m.group(3)),
+        }
+
+    def _result(self, line, m):
+        c = self.counts
+        c.numTotal += 1
+        status = 'unknown'
+        if ' passed' in line and passed.match(line):
+            self.count('numPassed', 'pass')
+            status = 'passed'
+        if ' failed' in line:
+            if failed.match(line):
+                self.count('numFailed', 'fail')
+                c.failed.append(failed.findall(line))
+                status = 'failed'
+            if skipped.match(line):
+                self.count('numSkipped', 'skipped')
+                status = 'skipped'
+        self.addResult(line, status)
+
+class QemuLogAnalyzer(LogAnalyzer):
+    # Look for:
+    # Building <arch>:<machine>:<config> .+ running .+ passed
+    # Building <arch>:<machine>:<config> .+ running .+ passed (cached)
+    # Building <arch>:<machine>:<config> .* failed.*
+    # Building <arch>:<machine>:<config> .+ skipped.*
+    # tracebacks, and kunit results.
+
+    rules = [
+        Rule('current', '_current', prefix='Building ', keyword=' running ',
+             regex=current_qemu),
+        Rule('result', '_result', prefix='Building '),
+        Rule('traceback', '_traceback', regex=traceback_qemu, search=True),
+        Rule('kunit', '_kunit', keyword=': pass:', regex=kunit_result),
+    ]
+    counters = QemuCounters
+
+    def __init__(self):
+        LogAnalyzer.__init__(self)
+        self.current = None
+        self.record = None
+
+    def warnings(self):
+        return self.counts.tracebacks
+
+    def summary(self):
+        c = self.counts
+        summary = LogAnalyzer.summary(self)
+        summary['kunit'] = {
+            'pass': c.numKunitPassed,
+            'fail': c.numKunitFailed,
+            'skip': c.numKunitSkipped,
+        }
+        summary['tracebacks'] = c.tracebacks
+        summary['slow'] = c.slowBoots
+        return summary
+
+    def _current(self, line, m):
+        # save architecture and machine in self.current for later use
+        # Make sure that '#" is not in the architecture or machine name
+        # because that is used as separator later on.
+        self.current = [m.group(1).replace('#','_'), m.group(2).replace('#','_')]
+
+    def _result(self, line, m):
+        p = ' passed' in line and passed_qemu.match(line)
+        f = 'failed' in line and failed_qemu.match(line)
+        s = ' skipped' in line and skipped_qemu.match(line)
+        if not (p or f or s):
+            return
+        self.counts.numTotal += 1
+        if p:
+            self.count('numPassed', 'pass')
+            status = 'passed'
+        if f:
+            self.count('numFailed', 'fail')
+            self.counts.failed.append(failed_qemu.findall(line))
+            status = 'failed'
+        if s:
+            self.count('numSkipped', 'skipped')
+            status = 'skipped'
+        # The qemu log, including tracebacks and kunit results, is
+        # reported after the result line. Attribute it to this record.
+        self.record = self.addResult(line, status)
+        self.record['tracebacks'] = False
+        b = boot_progress.search(line)
+        if b:
+            # Boot time is measured for the last attempt only.
+            ticks = b.group(1)
+            self.record['retries'] = ticks.count('R')
+            self.record['boot_time'] = len(ticks.rsplit('R', 1)[-1]) * looptime
+        self._matcher.enable('traceback')
+
+    def _traceback(self, line, m):
+        self.counts.tracebacks = True
+        if self.record is not None:
+            self.record['tracebacks'] = True
+            if self.marker is not None:
+                self.marker('traceback', self.record['target'])
+        # Nothing else to learn until the next build unit; stop looking.
+        self._matcher.disable('traceback')
+
+    def _kunit(self, line, m):
+        # count totals but add individual test results to output
+        c = self.counts
+        if m.group(1) == 'Totals':
+            c.numKunitPassed += int(m.group(2))
+            c.numKunitFailed += int(m.group(3))
+            c.numKunitSkipped += int(m.group(4))
+            if self.record is not None:
+                kunit = self.record.setdefault('kunit',
+                                               {'pass': 0, 'fail': 0, 'skip': 0})
+                kunit['pass'] += int(m.group(2))
+                kunit['fail'] += int(m.group(3))
+                kunit['skip'] += int(m.group(4))
+        elif self.current and int(m.group(3)) > 0:
+            new = self.current + [m.group(1).replace('#','_')]
+            if new not in c.kunit_failed:
+                c.kunit_failed.append(new)
+            if self.record is not None:
+                suites = self.record.setdefault('kunit_failed', [])
+                if new[-1] not in suites:
+                    suites.append(new[-1])
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+
+# Build unit index of build and qemu logs.
+#
+# Stable build and qemu logs can be many megabytes long, and finding the
+# output of one build unit means loading and scrolling through all of it.
+# The log analyzers therefore write an index of the stdio log of their
+# step while it runs. The log itself is only stored by buildbot, which
+# compresses it once the step finished (c['logCompressionMethod']).
+#
+# - The index (<log>.idx, next to the log) has one JSON line per marker,
+#   [kind, label, offset]: the offset of each build unit result line
+#   (kind 'unit') and of each traceback detected by the log analyzers
+#   (kind 'traceback') in the output of the log, with the build unit as
+#   label. The output of a log is its stdout and stderr, without the
+#   headers buildbot adds.
+# - Markers are appended as they are found. The index file is buffered,
+#   so it is written in blocks, not once per marker.
+# - The name of the index starts with the build number, like the name of
+#   the log, so buildbot removes both together (c['logHorizon']).
+#
+# A reader decompresses the log up to the end of the requested range.
+# As a script, this module prints the markers of a log, or the output of
+# one build unit:
+#
+#   logstore.py [--unit <target> | --tracebacks] <log>
+#
+# This module must not depend on buildbot.
+
+from __future__ import print_function
+
+import argparse
+import bz2
+import collections
+import errno
+import gzip
+import json
+import os
+import sys
+
+# Channels of buildbot log files holding output (stdout, stderr); the
+# header channel (2) holds buildbot's own messages.
+outputChannels = (0, 1)
+
+class LogIndexWriter(object):
+    """Write the index of a log while buildbot writes the log."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + '.idx', 'w')
+        self.offset = 0         # output received so far
+        self.lineOffset = 0     # offset of the last line seen
+        # Offset and length of complete stdout lines not seen yet, and
+        # of the incomplete last stdout line
+        self._lines = collections.deque()
+        self._partial = None
+
+    def received(self, data, stdout=True):
+        # Account for a chunk of output, before its lines are parsed.
+        if stdout:
+            offset = self.offset
+            pieces = data.split(b'\n')
+            last = len(pieces) - 1
+            for i, piece in enumerate(pieces):
+                if i == last and not piece:
+                    break
+                if self._partial is None:
+                    self._partial = [offset, 0]
+                self._partial[1] += len(piece)
+                offset += len(piece) + 1
+                if i < last:
+                    self._lines.append(tuple(self._partial))
+                    self._partial = None
+        self.offset += len(data)
+
+    def line(self, line):
+        # Called for each stdout line parsed. Return its offset. Lines
+        # the parser dropped (too long) are skipped.
+        while self._lines:
+            offset, length = self._lines.popleft()
+            if length == len(line):
+                self.lineOffset = offset
+                break
+        return self.lineOffset
+
+    def mark(self, kind, label, offset=None):
+        # Add a marker, by default for the last line seen.
+        if offset is None:
+            offset = self.lineOffset
+        self.file.write(json.dumps([kind, label, offset]) + '\n')
+
+    def close(self):
+        self.file.close()
+
+def openLog(path):
+    # Open buildbot log file 'path', or its compressed version.
+    for suffix, opener in (('.bz2', bz2.BZ2File), ('.gz', gzip.open),
+                           ('', open)):
+        if os.path.exists(path + suffix):
+            return opener(path + suffix, 'rb')
+    raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+def readChunks(f, blockSize=64 * 1024):
+    # Yield (channel, data) for each entry of buildbot log file 'f', a
+    # sequence of netstrings '<length>:<channel><data>,'.
+    buf = b''
+    pos = 0
+    while True:
+        colon = buf.find(b':', pos)
+        if colon >= 0:
+            end = colon + 1 + int(buf[pos:colon])
+            if end < len(buf):
+                yield int(buf[colon + 1:colon + 2]), buf[colon + 2:end]
+                pos = end + 1
+                continue
+        data = f.read(blockSize)
+        if not data:
+            return      # end of log, or incomplete last entry
+        buf = buf[pos:] + data
+        pos = 0
+
+class LogReader(object):
+    """Read ranges of the output of an indexed log."""
+
+    def __init__(self, path):
+        self.path = path
+        self.markers = []
+        with open(path + '.idx') as f:
+            for line in f:
+                try:
+                    self.markers.append(tuple(json.loads(line)))
+                except ValueError:
+                    break   # the step is still writing the index
+
+    def read(self, start=0, end=None):
+        # Return the output between offsets start and end.
+        result = []
+        offset = 0
+        with openLog(self.path) as f:
+            for channel, data in readChunks(f):
+                if channel not in outputChannels:
+                    continue
+                if end is not None and offset >= end:
+                    break
+                if offset + len(data) > start:
+                    result.append(data[max(start - offset, 0):
+                                       None if end is None else end - offset])
+                offset += len(data)
+        return b''.join(result)
+
+    def units(self):
+        # Return a list of (label, start, end) for all build units. The
+        # last unit ends at the end of the log (None).
+        starts = [(m[2], m[1]) for m in self.markers if m[0] == 'unit']
+        result = []
+        for i, (start, label) in enumerate(starts):
+            end = starts[i + 1][0] if i + 1 < len(starts) else None
+            result.append((label, start, end))
+        return result
+
+    def unit(self, label):
+        # Return the output of build unit 'label', or None.
+        for name, start, end in self.units():
+            if name == label:
+                return self.read(start, end)
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show indexed log')
+    parser.add_argument('--unit', help='Show output of build unit')
+    parser.add_argument('--tracebacks', action='store_true',
+                        help='Show output of build units with tracebacks')
+    parser.add_argument('log')
+    args = parser.parse_args()
+
+    reader = LogReader(args.log)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    if args.unit:
+        data = reader.unit(args.unit)
+        if data is None:
+            parser.exit(1, 'No build unit %s\n' % args.unit)
+        out.write(data)
+    elif args.tracebacks:
+        labels = set(m[1] for m in reader.markers if m[0] == 'traceback')
+        for label, start, end in reader.units():
+            if label in labels:
+                out.write(reader.read(start, end))
+    else:
+        for kind, label, offset in reader.markers:
+            print('%10d %-10s %s' % (offset, kind, label))
@@ -0,0 +1,272 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Build matrix.
+#
+# Derives the list of branches, build and qemu builders, and schedulers
+# from the data in config.py. The result is a tree of named tuples which
+# is hashable and compares by value. It is cached per configuration, and
+# the builder objects created from it are cached per builder spec, so a
+# reconfiguration only creates builders which actually changed.
+#
+# Adding a release only requires adding it to config.releases.
+
+import collections
+import inspect
+import sys
+import types
+
+import config
+
+Branch = collections.namedtuple('Branch',
+        'name project repo branch priority builds qemu')
+# Sharded builds are split into 'shards' builders. The first shard has
+# the name of the unsharded builder and triggers the others. Each shard
+# has its own build directory, so shards can run on the same worker at
+# the same time.
+Build = collections.namedtuple('Build',
+        'name builddir repo branch arch release shard shards workers')
+Qemu = collections.namedtuple('Qemu',
+        'name builddir repo branch target release workers')
+
+# hwmon/watchdog branches first, then upstream/next, then stable
+priorities = { 'hwmon': 2, 'upstream': 3, 'next': 3, 'stable': 4 }
+
+def version(release):
+    # Version tuple for release names such as '6.12'. Branches other than
+    # stable releases are newer than any release.
+    try:
+        return tuple(int(v) for v in release.split('.'))
+    except ValueError:
+        return (sys.maxsize,)
+
+def supported(branch, first):
+    return first is None or version(branch) >= version(first)
+
+def branchSource(cfg, b):
+    # Return (project, repository, branch) for branch name 'b'.
+    if b == 'master':
+        return 'upstream', cfg.upstream_repo, b
+    if b in cfg.hwmon_branches_only + cfg.watchdog_branches_only:
+        return 'hwmon', cfg.hwmon_repo, b
+    if b == 'next':
+        return 'next', cfg.next_repo, 'master'
+    if b == 'pending-fixes':
+        return 'next', cfg.next_repo, b
+    return 'stable', cfg.stable_repo, 'linux-%s.y' % b
+
+def branchNames(cfg):
+    return (cfg.releases + [ 'pending-fixes', 'next' ] +
+            cfg.hwmon_branches_only + cfg.watchdog_branches_only +
+            cfg.upstream_branch)
+
+def configKey(cfg):
+    # Everything the matrix depends on, in hashable form.
+    return (tuple(cfg.workers), tuple(cfg.releases),
+            cfg.hwmon_repo, cfg.upstream_repo, cfg.stable_repo, cfg.next_repo,
+            tuple(cfg.hwmon_branches_only), tuple(cfg.watchdog_branches_only),
+            tuple(cfg.upstream_branch), tuple(cfg.next_branches),
+            tuple(cfg.stable_arches), tuple(sorted(cfg.first_release.items())),
+            tuple(sorted(cfg.stable_shards.items())),
+            tuple(cfg.qemu_targets),
+            tuple(sorted(cfg.qemu_first_release.items())))
+
+def shardName(name, shard):
+    return name if shard == 1 else "%s-shard%d" % (name, shard)
+
+def buildMatrix(cfg):
+    workers = tuple(cfg.workers)
+    branches = []
+    for b in branchNames(cfg):
+        project, repo, branch = branchSource(cfg, b)
+        builddir = "%s-%s" % (project, b)
+        builds = tuple(
+                Build(shardName("%s-%s-%s" % (project, arch, b), shard),
+                      shardName(builddir, shard), repo, branch, arch, b,
+                      shard, shards, workers)
+                for arch in cfg.stable_arches
+                if supported(b, cfg.first_release.get(arch))
+                for shards in (cfg.stable_shards.get(arch, 1),)
+                for shard in range(1, shards + 1))
+        qemu = tuple(
+                Qemu("qemu-%s-%s" % (t, b), "qemu-%s" % t, repo, branch, t, b,
+                     workers)
+                for t in cfg.qemu_targets
+                if supported(b, cfg.qemu_first_release.get(t)))
+        branches.append(Branch(b, project, repo, branch, priorities[project],
+                               builds, qemu))
+    return tuple(branches)
+
+_matrices = {}
+
+def getMatrix(cfg=config):
+    key = configKey(cfg)
+    if key not in _matrices:
+        _matrices.clear()
+        _matrices[key] = buildMatrix(cfg)
+    return _matrices[key]
+
+def load():
+    # Re-read config.py and return the resulting matrix. Modules imported
+    # by master.cfg are not reloaded on reconfig, so this is necessary to
+    # pick up changes.
+    try:
+        reload(config)
+    except NameError:   # python 3
+        from importlib import reload as _reload
+        _reload(config)
+    return getMatrix(config)
+
+def builderSpecs(matrix):
+    specs = collections.OrderedDict()
+    for branch in matrix:
+        for spec in branch.builds + branch.qemu:
+            specs[spec.name] = spec
+    return specs
+
+try:
+    _scalars = (type(None), bool, int, long, float, str, unicode)
+except NameError:   # python 3
+    _scalars = (type(None), bool, int, float, str, bytes)
+
+# Modules and classes are compared by identity. Old style classes are
+# classes as well in python 2.
+_identity = (types.ModuleType, type, getattr(types, 'ClassType', type))
+
+_maxDepth = 8
+
+def _globalNames(code):
+    # Names of globals (and attributes) referenced by code, including
+    # nested functions
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _globalNames(const)
+    return names
+
+def _cells(closure):
+    values = []
+    for cell in closure or ():
+        try:
+            values.append(cell.cell_contents)
+        except ValueError:  # empty cell
+            values.append(None)
+    return tuple(values)
+
+def _comparesByValue(cls):
+    return any(m in vars(c) for c in inspect.getmro(cls) if c is not object
+               for m in ('__eq__', '__cmp__'))
+
+def fingerprint(value, depth=0, path=()):
+    # Return a hashable value which changes if 'value', or anything it
+    # references, changes. master.cfg is executed again on reconfig, so
+    # its functions and objects are new but may be equivalent to the old
+    # ones. Functions are compared by code, defaults, closure, and the
+    # master.cfg globals they reference; other objects by value or by
+    # attributes. Values which can not be compared, or are nested too
+    # deeply, get a unique fingerprint: callers depending on them are
+    # always created again.
+    if isinstance(value, _scalars) or isinstance(value, _identity):
+        return value
+    if depth > _maxDepth:
+        return object()
+    if id(value) in path:
+        # Reference cycle; the value itself is already covered.
+        return ('cycle', path.index(id(value)))
+    depth += 1
+    path += (id(value),)
+    if isinstance(value, types.CodeType):
+        return ('code', value.co_code, value.co_names,
+                tuple(fingerprint(c, depth, path) for c in value.co_consts))
+    if isinstance(value, types.FunctionType):
+        code = value.__code__
+        refs = sorted((name, value.__globals__[name])
+                      for name in _globalNames(code)
+                      if name in value.__globals__)
+        return ('function', fingerprint(code, depth, path),
+                fingerprint(value.__defaults__, depth, path),
+                fingerprint(_cells(value.__closure__), depth, path),
+                tuple((name, fingerprint(v, depth, path))
+                      for name, v in refs))
+    if isinstance(value, types.MethodType):
+        return ('method', fingerprint(value.__func__, depth, path),
+                fingerprint(value.__self__, depth, path))
+    if isinstance(value, (list, tuple)):
+        return (type(value),
+                tuple(fingerprint(v, depth, path) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (type(value),
+                frozenset(fingerprint(v, depth, path) for v in value))
+    if isinstance(value, dict):
+        return (type(value),
+                frozenset((fingerprint(k, depth, path),
+                           fingerprint(v, depth, path))
+                          for k, v in value.items()))
+    cls = getattr(value, '__class__', type(value))
+    if _comparesByValue(cls):
+        try:
+            hash(value)
+            return (cls, value)
+        except TypeError:
+            pass
+    try:
+        attributes = vars(value)
+    except TypeError:
+        return object()
+    return (cls, fingerprint(attributes, depth, path))
+
+_builders = {}
+
+def makeBuilders(matrix, makeBuild, makeQemu, depends=()):
+    # Return builder configurations for all builders in the matrix.
+    # Builders are only created if their spec, the function creating
+    # them (see fingerprint()), or any of the (hashable) objects in
+    # 'depends' changed since the last call.
+    global _builders
+    builders = {}
+    result = []
+    depends = tuple(depends)
+    fingerprints = {}
+    for spec in builderSpecs(matrix).values():
+        make = makeQemu if isinstance(spec, Qemu) else makeBuild
+        if make not in fingerprints:
+            fingerprints[make] = fingerprint(make)
+        key = (spec, fingerprints[make], depends)
+        builder = _builders.get(key)
+        if builder is None:
+            builder = make(spec)
+        builders[key] = builder
+        result.append(builder)
+    _builders = builders
+    return result
+
+def diff(old, new):
+    # Return (added, removed, changed) builder names between two matrices.
+    old = builderSpecs(old or ())
+    new = builderSpecs(new)
+    added = [name for name in new if name not in old]
+    removed = [name for name in old if name not in new]
+    changed = [name for name in new if name in old and new[name] != old[name]]
+    return added, removed, changed
+
+_previous = None
+
+def describeChanges(matrix):
+    # Return a list of messages describing the changes since the matrix
+    # was last passed to this function.
+    global _previous
+    if _previous is None:
+        _previous = matrix
+        return ["build matrix: %d branches, %d builders" %
+                (len(matrix), len(builderSpecs(matrix)))]
+    if matrix is _previous or matrix == _previous:
+        return ["build matrix unchanged"]
+    added, removed, changed = diff(_previous, matrix)
+    _previous = matrix
+    messages = []
+    for what, names in (('added', added), ('removed', removed),
+                        ('changed', changed)):
+        if names:
+            messages.append("build matrix: %d builders %s: %s" %
+                            (len(names), what, ' '.join(names)))
+    return messages or ["build matrix: branches changed"]
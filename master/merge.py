@@ -0,0 +1,173 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Build request merging.
+#
+# Two pending build requests of a builder are merged if they build the
+# same tree, or if building only the newer tree does not lose anything
+# worth testing. Requests are compared by
+#
+# - project, repository and branch. Forced builds do not carry those;
+#   they are taken from the builder's entry in the build matrix (or the
+#   sources passed to configure() for other builders), so
+#   forced and scheduled requests for the same tree are merged. This also
+#   keeps 'master' of upstream and next apart.
+# - the resolved commit SHA: the requested revision, the revision of the
+#   last change, or for forced builds without revision the branch head
+#   last seen by the GitPoller (which is what the build will check out).
+#
+# Requests with the same SHA are always merged. Otherwise the older SHA
+# is looked up in the poller's repository:
+#
+# - if the older commit is no longer an ancestor of the newer one, the
+#   branch was rewritten (next, hwmon-next). The older tree is gone and
+#   the requests are merged.
+# - if a commit between the two reverts a commit, the requests are not
+#   merged so the reverted state is tested as well.
+# - if the two are more than 'maxDistance' commits apart, they are not
+#   merged to keep bisect ranges short.
+#
+# If a SHA can not be resolved or looked up, requests with the same
+# project, repository, and branch are merged as before.
+#
+# Requests triggered by different builds of a sharded builder are never
+# merged; the results of each shard build are merged into the build which
+# triggered it.
+# Forced requests bypass the result cache and are not merged with
+# requests which use it.
+
+import collections
+
+from twisted.internet import defer
+from twisted.internet import utils
+from twisted.python import log
+
+# Resolved (project, repository, branch, sha) of a build request.
+# sha is None if it could not be resolved.
+Tree = collections.namedtuple('Tree', 'project repository branch sha')
+
+revertPattern = '^This reverts commit [0-9a-f]'
+
+# Requests are only merged if those properties match
+separateProperties = ('shard_parent', 'result_cache')
+
+class RequestMerger(object):
+    """mergeRequests implementation for buildbot."""
+
+    # Maximum commit distance of requests which can be merged, or None
+    maxDistance = None
+    # Maximum number of cached commit range lookups
+    maxCache = 10000
+
+    def __init__(self):
+        self.sources = {}
+        self._ranges = {}
+
+    def configure(self, buildmatrix, sources={}, maxDistance=None):
+        # Project, repository, and branch of matrix builders and of the
+        # builders in 'sources' (name: (project, repository, branch))
+        self.sources = dict(sources)
+        for branch in buildmatrix:
+            for spec in branch.builds + branch.qemu:
+                self.sources[spec.name] = (branch.project, branch.repo,
+                                           branch.branch)
+        if self.maxDistance != maxDistance:
+            self._ranges.clear()
+        self.maxDistance = maxDistance
+
+    def pollers(self, master):
+        # GitPollers by repository URL
+        result = {}
+        for service in master.change_svc:
+            if hasattr(service, 'lastRev') and hasattr(service, 'repourl'):
+                result[service.repourl] = service
+        return result
+
+    def resolve(self, builder, req, pollers):
+        if len(req.sources) != 1:
+            return None
+        ss = req.source
+        if ss.patch:
+            return None
+        project, repository, branch = self.sources.get(builder.name,
+                                                       (None, None, None))
+        project = ss.project or project
+        repository = ss.repository or repository
+        branch = ss.branch or branch
+        sha = ss.revision
+        if not sha and ss.changes:
+            sha = ss.changes[-1].revision
+        if not sha:
+            poller = pollers.get(repository)
+            if poller is not None:
+                sha = (poller.lastRev or {}).get(branch)
+        return Tree(project or None, repository or None, branch or None,
+                    sha or None)
+
+    @defer.inlineCallbacks
+    def lookupRange(self, poller, old, new):
+        # Return True if the range old..new can be merged, False if not,
+        # or None if unknown.
+        key = (old, new)
+        if key in self._ranges:
+            defer.returnValue(self._ranges[key])
+
+        def git(*args):
+            return utils.getProcessOutputAndValue('git', args,
+                                                  path=poller.workdir)
+
+        _, _, rc = yield git('merge-base', '--is-ancestor', old, new)
+        if rc == 1:
+            result = True
+            reason = 'branch rewritten'
+        elif rc != 0:
+            defer.returnValue(None)
+        else:
+            (count, _, rc1), (reverts, _, rc2) = yield defer.gatherResults([
+                git('rev-list', '--count', '%s..%s' % (old, new)),
+                git('rev-list', '--count', '--extended-regexp',
+                    '--grep=%s' % revertPattern, '%s..%s' % (old, new))])
+            if rc1 or rc2:
+                defer.returnValue(None)
+            count, reverts = int(count), int(reverts)
+            reason = '%d commits, %d reverts' % (count, reverts)
+            result = not reverts and (self.maxDistance is None or
+                                      count <= self.maxDistance)
+        if len(self._ranges) >= self.maxCache:
+            self._ranges.clear()
+        self._ranges[key] = result
+        if not result:
+            log.msg("not merging build requests for %s..%s: %s" %
+                    (old[:12], new[:12], reason))
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def __call__(self, builder, req1, req2):
+        if req1 is req2:
+            defer.returnValue(True)
+        if set(req1.sources) != set(req2.sources):
+            defer.returnValue(False)
+        for name in separateProperties:
+            if (req1.properties.getProperty(name) !=
+                    req2.properties.getProperty(name)):
+                defer.returnValue(False)
+        pollers = self.pollers(builder.master)
+        tree1 = self.resolve(builder, req1, pollers)
+        tree2 = self.resolve(builder, req2, pollers)
+        if tree1 is None or tree2 is None or tree1[:3] != tree2[:3]:
+            defer.returnValue(False)
+        if tree1.sha == tree2.sha:
+            defer.returnValue(True)
+        poller = pollers.get(tree1.repository)
+        if tree1.sha is None or tree2.sha is None or poller is None:
+            defer.returnValue(True)
+        # The merged build checks out the newer tree.
+        if req1.submittedAt <= req2.submittedAt:
+            old, new = tree1.sha, tree2.sha
+        else:
+            old, new = tree2.sha, tree1.sha
+        result = yield self.lookupRange(poller, old, new)
+        defer.returnValue(result is not False)
+
+# Shared across reconfigurations, so cached lookups are kept.
+requestMerger = RequestMerger()
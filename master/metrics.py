@@ -0,0 +1,223 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Hot path metrics of the master.
+#
+# Collected cheaply enough to be always enabled:
+#
+# - per lock (by name; per worker locks are summed over workers): the
+#   number of claims, the time the lock was held, and the time it kept
+#   builds waiting. Builds whose locks are not available are not started
+#   at all, so there is no explicit wait. Instead, a wait starts with the
+#   first rejected attempt to take the lock and ends when the lock is
+#   released (or claimed). Image builds of a branch wait on the lock of
+#   their build directory on a worker (builddir_<dir>).
+# - per worker: the time builds waited for admission by resources (see
+#   resources.py). Like a lock wait, a wait starts with the first build
+#   the worker rejects and ends when it admits a build.
+# - per builder: the number of pending build requests and the age of the
+#   oldest one, sampled periodically.
+# - per timed scheduler: the time from timedChangeTimerFired until the
+#   first build of one of its builders started and, for staggered
+#   schedulers, until the release coordinator released its buildset.
+# - per log observer class: the CPU time spent processing stdio log output,
+#   measured per log chunk instead of per line to keep the overhead low.
+#
+# metricstatus.py feeds lock and build events into 'metrics', serves the
+# metrics as text (Prometheus text exposition format) on a local HTTP
+# port, and dumps them as JSON. This module must not depend on buildbot.
+
+import collections
+import json
+import os
+import time
+
+cputime = getattr(time, 'process_time', None) or time.clock
+
+class Stat(object):
+    """Count, sum, maximum, and last value of a series of durations."""
+
+    __slots__ = ('count', 'total', 'max', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def asdict(self):
+        return {
+            'count': self.count,
+            'total': round(self.total, 3),
+            'max': round(self.max, 3),
+            'last': round(self.last, 3),
+        }
+
+class ObserverStat(object):
+    """CPU time spent by a log observer class."""
+
+    __slots__ = ('cpu', 'lines', 'chunks')
+
+    def __init__(self):
+        self.cpu = 0.0
+        self.lines = 0
+        self.chunks = 0
+
+    def asdict(self):
+        return {
+            'cpu': round(self.cpu, 3),
+            'lines': self.lines,
+            'chunks': self.chunks,
+        }
+
+def quote(value):
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.time()
+        self.lockWaits = collections.defaultdict(Stat)
+        self.lockHolds = collections.defaultdict(Stat)
+        self.lockHeld = collections.defaultdict(int)
+        self.admissionWaits = collections.defaultdict(Stat)
+        self.queues = {}
+        self.firstBuild = collections.defaultdict(Stat)
+        self.releases = collections.defaultdict(Stat)
+        self.observers = collections.defaultdict(ObserverStat)
+        self._fired = {}
+
+    # Locks
+
+    def lockWait(self, name, seconds):
+        self.lockWaits[name].add(seconds)
+
+    def lockClaimed(self, name):
+        self.lockHeld[name] += 1
+
+    def lockReleased(self, name, seconds):
+        self.lockHeld[name] -= 1
+        self.lockHolds[name].add(seconds)
+
+    # Worker admission
+
+    def admissionWait(self, worker, seconds):
+        self.admissionWaits[worker].add(seconds)
+
+    # Build request queues
+
+    def setQueues(self, queues):
+        # queues: {builder: (pending requests, age of oldest in seconds)}
+        self.queues = dict(queues)
+
+    # Timed schedulers
+
+    def timerFired(self, scheduler, builderNames, now=None):
+        self._fired[scheduler] = (now or time.time(), frozenset(builderNames))
+
+    def timerReleased(self, scheduler, now=None):
+        entry = self._fired.get(scheduler)
+        if entry is not None:
+            self.releases[scheduler].add((now or time.time()) - entry[0])
+
+    def buildStarted(self, builder, now=None):
+        if not self._fired:
+            return
+        now = now or time.time()
+        for scheduler, (fired, builders) in list(self._fired.items()):
+            if builder in builders:
+                self.firstBuild[scheduler].add(now - fired)
+                del self._fired[scheduler]
+
+    # Log observers
+
+    def observerTime(self, name, seconds, lines):
+        stat = self.observers[name]
+        stat.cpu += seconds
+        stat.lines += lines
+        stat.chunks += 1
+
+    # Output
+
+    def snapshot(self, now=None):
+        now = now or time.time()
+        locks = {}
+        for name in set(self.lockWaits) | set(self.lockHolds):
+            locks[name] = {
+                'wait': self.lockWaits[name].asdict(),
+                'hold': self.lockHolds[name].asdict(),
+                'held': self.lockHeld[name],
+            }
+        return {
+            'time': int(now),
+            'uptime': int(now - self.started),
+            'locks': locks,
+            'admission': dict((w, {'wait': stat.asdict()})
+                              for w, stat in self.admissionWaits.items()),
+            'queues': dict((b, {'pending': n, 'oldest': int(age)})
+                           for b, (n, age) in self.queues.items()),
+            'schedulers': dict((s, {'first_build': self.firstBuild[s].asdict(),
+                                    'release': self.releases[s].asdict()})
+                               for s in set(self.firstBuild) |
+                                        set(self.releases)),
+            'observers': dict((o, stat.asdict())
+                              for o, stat in self.observers.items()),
+        }
+
+    def text(self):
+        lines = []
+
+        def metric(name, kind, label, values):
+            lines.append('# TYPE buildbot_%s %s' % (name, kind))
+            for key, value in sorted(values):
+                lines.append('buildbot_%s{%s=%s} %s' %
+                             (name, label, quote(key), value))
+
+        waits = sorted(self.lockWaits.items())
+        holds = sorted(self.lockHolds.items())
+        metric('lock_wait_seconds_total', 'counter', 'lock',
+               [(k, '%.3f' % s.total) for k, s in waits])
+        metric('lock_waits_total', 'counter', 'lock',
+               [(k, s.count) for k, s in waits])
+        metric('lock_wait_seconds_max', 'gauge', 'lock',
+               [(k, '%.3f' % s.max) for k, s in waits])
+        metric('lock_hold_seconds_total', 'counter', 'lock',
+               [(k, '%.3f' % s.total) for k, s in holds])
+        metric('lock_claims_total', 'counter', 'lock',
+               [(k, s.count) for k, s in holds])
+        metric('lock_held', 'gauge', 'lock', self.lockHeld.items())
+        admission = sorted(self.admissionWaits.items())
+        metric('admission_wait_seconds_total', 'counter', 'worker',
+               [(k, '%.3f' % s.total) for k, s in admission])
+        metric('admission_waits_total', 'counter', 'worker',
+               [(k, s.count) for k, s in admission])
+        metric('admission_wait_seconds_max', 'gauge', 'worker',
+               [(k, '%.3f' % s.max) for k, s in admission])
+        metric('builder_pending_requests', 'gauge', 'builder',
+               [(k, n) for k, (n, _) in self.queues.items()])
+        metric('builder_oldest_request_seconds', 'gauge', 'builder',
+               [(k, int(age)) for k, (_, age) in self.queues.items()])
+        metric('scheduler_first_build_seconds', 'gauge', 'scheduler',
+               [(k, '%.1f' % s.last) for k, s in self.firstBuild.items()])
+        metric('scheduler_release_seconds', 'gauge', 'scheduler',
+               [(k, '%.1f' % s.last) for k, s in self.releases.items()])
+        metric('observer_cpu_seconds_total', 'counter', 'observer',
+               [(k, '%.3f' % s.cpu) for k, s in self.observers.items()])
+        metric('observer_lines_total', 'counter', 'observer',
+               [(k, s.lines) for k, s in self.observers.items()])
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+
+# Shared across reconfigurations, so the metrics are cumulative.
+metrics = Metrics()
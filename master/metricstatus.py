@@ -0,0 +1,146 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Buildbot side of metrics.py.
+#
+# MasterLock and SlaveLock are drop-in replacements for the buildbot lock
+# classes whose real locks report claims, hold times, and wait times.
+# MetricsStatus is a status target which reports build starts, samples
+# the pending build requests of each builder, serves the metrics as text
+# on a local HTTP port, and dumps them into a JSON file.
+
+import calendar
+import time
+
+from buildbot import locks
+from buildbot.status import base
+from twisted.application import internet
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web import resource, server
+
+from metrics import metrics
+
+class MeteredLock(locks.BaseLock):
+    """BaseLock which reports its use to 'metrics'."""
+
+    def __init__(self, name, maxCount=1):
+        locks.BaseLock.__init__(self, name, maxCount)
+        self._blocked = None    # time of the first rejected attempt
+        self._claims = {}
+
+    def _endWait(self, now):
+        if self._blocked is not None:
+            metrics.lockWait(self.name, now - self._blocked)
+            self._blocked = None
+
+    def isAvailable(self, requester, access):
+        available = locks.BaseLock.isAvailable(self, requester, access)
+        if not available and self._blocked is None:
+            self._blocked = time.time()
+        return available
+
+    def claim(self, owner, access):
+        locks.BaseLock.claim(self, owner, access)
+        now = time.time()
+        self._endWait(now)
+        self._claims[(owner, access.mode)] = now
+        metrics.lockClaimed(self.name)
+
+    def release(self, owner, access):
+        # Waiters are woken up by the release; end the current wait first.
+        now = time.time()
+        self._endWait(now)
+        locks.BaseLock.release(self, owner, access)
+        start = self._claims.pop((owner, access.mode), None)
+        if start is not None:
+            metrics.lockReleased(self.name, now - start)
+
+class MeteredRealMasterLock(MeteredLock):
+    def __init__(self, lockid):
+        MeteredLock.__init__(self, lockid.name, lockid.maxCount)
+        self.description = "<MasterLock(%s, %s)>" % (self.name, self.maxCount)
+
+    def getLock(self, slave):
+        return self
+
+class MeteredRealSlaveLock(locks.RealSlaveLock):
+    def getLock(self, slave):
+        slavename = slave.slavename
+        if slavename not in self.locks:
+            maxCount = self.maxCountForSlave.get(slavename, self.maxCount)
+            lock = MeteredLock(self.name, maxCount)
+            lock.description = "<SlaveLock(%s, %s)[%s] %d>" % (
+                    self.name, maxCount, slavename, id(lock))
+            self.locks[slavename] = lock
+        return self.locks[slavename]
+
+class MasterLock(locks.MasterLock):
+    lockClass = MeteredRealMasterLock
+
+class SlaveLock(locks.SlaveLock):
+    lockClass = MeteredRealSlaveLock
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return metrics.text().encode('utf-8')
+
+class MetricsStatus(base.StatusReceiverMultiService):
+    """Status target serving 'metrics'.
+
+    The metrics are served on http://<interface>:<port>/ (local only by
+    default) and written to 'dumpfile' every 'interval' seconds, after
+    sampling the pending build requests.
+    """
+
+    def __init__(self, port=8011, interface='127.0.0.1',
+                 dumpfile='metrics.json', interval=60):
+        base.StatusReceiverMultiService.__init__(self)
+        self.dumpfile = dumpfile
+        self.master = None
+        self.master_status = None
+        self.watched = []
+        site = server.Site(MetricsResource())
+        internet.TCPServer(port, site,
+                           interface=interface).setServiceParent(self)
+        internet.TimerService(interval, self.update).setServiceParent(self)
+
+    def setServiceParent(self, parent):
+        base.StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent
+        self.master_status.subscribe(self)
+        self.master = self.master_status.master
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        self.master_status = None
+        for w in self.watched:
+            w.unsubscribe(self)
+        self.watched = []
+        return base.StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, name, builder):
+        self.watched.append(builder)
+        return self     # subscribe to builds of this builder
+
+    def buildStarted(self, builderName, build):
+        metrics.buildStarted(builderName)
+
+    @defer.inlineCallbacks
+    def update(self):
+        try:
+            pending = yield self.master.db.buildrequests.getBuildRequests(
+                    claimed=False, complete=False)
+            now = time.time()
+            queues = {}
+            for br in pending:
+                submitted = calendar.timegm(br['submitted_at'].utctimetuple())
+                n, age = queues.get(br['buildername'], (0, 0))
+                queues[br['buildername']] = (n + 1, max(age, now - submitted))
+            metrics.setQueues(queues)
+            metrics.dump(self.dumpfile)
+        except Exception:
+            log.err(None, "while updating metrics")
@@ -0,0 +1,246 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Builder prioritization.
+#
+# The build request distributor asks prioritizeBuilders for the order in
+# which builders with pending build requests get a chance to claim a
+# worker. CostModel orders builders by
+#
+# - whether they can start at all: builders whose locks are not
+#   available, or whose resource needs do not fit, on any worker go last.
+#   This lets short qemu runs fill the remaining capacity of workers while
+#   image builds can not start.
+# - their static priority, raised by one for every 'agingInterval'
+#   seconds their oldest request has been waiting (up to 'maxAging'), so
+#   low priority builders are not starved.
+# - their expected duration. Builders which need exclusive access to a
+#   shared lock, or a large share of a worker's CPUs, and thus occupy a
+#   worker (image builds), are ordered longest first so long builds do
+#   not end up at the end of a run.
+#   Other builders (qemu runs) are ordered shortest first to fill gaps.
+# - the age of their oldest request.
+#
+# The model itself does not depend on buildbot; prioritysim.py uses it
+# to replay recorded build request timelines. BuilderPrioritizer adapts
+# it to buildbot's prioritizeBuilders interface.
+
+import calendar
+import collections
+import time
+
+import resources
+
+# A lock needed by a builder. Per worker locks (SlaveLock) have a
+# count per worker; 'maxCountForWorker' is a tuple of (worker, count) pairs.
+LockNeed = collections.namedtuple('LockNeed',
+        'name perWorker maxCount maxCountForWorker exclusive')
+
+# 'resources' are the resource needs of one build (resources.Resources).
+Profile = collections.namedtuple('Profile', 'priority needs workers resources')
+
+# Builders needing at least this many CPUs occupy a worker
+occupyingCpus = 8
+
+def occupiesWorker(profile):
+    # True if the builder locks out all other users of a shared lock, or
+    # uses most of a worker.
+    if profile.resources.cpus >= occupyingCpus:
+        return True
+    for need in profile.needs:
+        counts = [need.maxCount] + [c for _, c in need.maxCountForWorker]
+        if need.exclusive and max(counts) > 1:
+            return True
+    return False
+
+def lockNeedsFromConfig(locks):
+    # Convert a list of buildbot LockAccess objects.
+    needs = []
+    for access in locks:
+        lock = access.lockid
+        perWorker = hasattr(lock, 'maxCountForSlave')
+        counts = ()
+        if perWorker:
+            counts = tuple(sorted((lock.maxCountForSlave or {}).items()))
+        needs.append(LockNeed(lock.name, perWorker, lock.maxCount, counts,
+                              access.mode == 'exclusive'))
+    return tuple(needs)
+
+class LockState(object):
+    """Lock and worker resource usage of running builds."""
+
+    def __init__(self, profiles, running, capacity):
+        # running: list of (builder name, worker name)
+        # capacity: {worker name: resources.Resources}
+        self.capacity = capacity
+        self.holders = collections.defaultdict(lambda: [0, 0])
+        self.used = collections.defaultdict(lambda: resources.none)
+        self.onWorker = set(running)
+        for name, worker in running:
+            self.acquire(profiles[name], worker)
+
+    def _key(self, need, worker):
+        return (need.name, worker if need.perWorker else None)
+
+    def acquire(self, profile, worker):
+        self.used[worker] = resources.add(self.used[worker], profile.resources)
+        for need in profile.needs:
+            self.holders[self._key(need, worker)][need.exclusive] += 1
+
+    def release(self, profile, worker):
+        self.used[worker] = resources.sub(self.used[worker], profile.resources)
+        for need in profile.needs:
+            self.holders[self._key(need, worker)][need.exclusive] -= 1
+
+    def canStart(self, name, profile, worker):
+        if (name, worker) in self.onWorker:
+            return False
+        capacity = self.capacity.get(worker)
+        if capacity is not None and not resources.fits(self.used[worker],
+                                                       profile.resources,
+                                                       capacity):
+            return False
+        for need in profile.needs:
+            counting, exclusive = self.holders.get(self._key(need, worker),
+                                                   (0, 0))
+            if exclusive:
+                return False
+            if need.exclusive:
+                if counting:
+                    return False
+                continue
+            maxCount = dict(need.maxCountForWorker).get(worker, need.maxCount)
+            if counting >= maxCount:
+                return False
+        return True
+
+    def startable(self, name, profile, workers):
+        return any(self.canStart(name, profile, w) for w in workers)
+
+class CostModel(object):
+    # Expected duration of builders without history
+    defaultDuration = 900
+    # Raise priority by one for each agingInterval seconds of waiting
+    agingInterval = 3600
+    maxAging = 2
+    # Weight of the most recent build in the expected duration
+    smoothing = 0.3
+
+    def __init__(self):
+        self.durations = {}
+
+    def recordDuration(self, name, seconds):
+        old = self.durations.get(name)
+        if old is None:
+            self.durations[name] = seconds
+        else:
+            self.durations[name] = old + (seconds - old) * self.smoothing
+
+    def expectedDuration(self, name):
+        return self.durations.get(name, self.defaultDuration)
+
+    def order(self, candidates, profiles, state, workers, now):
+        # candidates: list of (builder name, submit time of oldest request)
+        # Return candidate builder names, in the order they should be
+        # offered a worker.
+        def key(candidate):
+            name, oldest = candidate
+            profile = profiles[name]
+            usable = [w for w in profile.workers if w in workers]
+            blocked = not state.startable(name, profile, usable)
+            waited = max(0, now - oldest) if oldest is not None else 0
+            aging = min(int(waited // self.agingInterval), self.maxAging)
+            duration = self.expectedDuration(name)
+            if occupiesWorker(profile):
+                duration = -duration
+            return (blocked, profile.priority - aging, duration,
+                    oldest if oldest is not None else now)
+        return [name for name, _ in sorted(candidates, key=key)]
+
+class BuilderPrioritizer(CostModel):
+    """prioritizeBuilders implementation for buildbot."""
+
+    defaultPriority = 5
+
+    def __init__(self):
+        CostModel.__init__(self)
+        self.profiles = {}
+        self.capacity = {}
+        self._configs = {}
+        self._buildNumbers = {}
+
+    def configure(self, capacity):
+        # capacity: {worker name: resources.Resources}
+        self.capacity = dict(capacity)
+
+    def profile(self, builder):
+        # Builder configurations only change on reconfig; cache their
+        # profiles per configuration object.
+        name = builder.name
+        config = builder.config
+        if self._configs.get(name) is not config:
+            self._configs[name] = config
+            self.profiles[name] = Profile(
+                    config.properties.get('priority', self.defaultPriority),
+                    lockNeedsFromConfig(config.locks),
+                    tuple(config.slavenames),
+                    resources.needsOf(config.properties))
+        return self.profiles[name]
+
+    def updateDuration(self, builder):
+        # Only look at the last finished build if there was a new build
+        # since the last call; loading build status may involve disk I/O.
+        status = builder.builder_status
+        number = status.nextBuildNumber
+        if self._buildNumbers.get(builder.name) == number:
+            return
+        self._buildNumbers[builder.name] = number
+        build = status.getLastFinishedBuild()
+        if build is None:
+            return
+        start, finish = build.getTimes()
+        if start and finish:
+            self.recordDuration(builder.name, finish - start)
+
+    def __call__(self, buildmaster, builders):
+        # Imported here so prioritysim.py does not need twisted
+        from twisted.internet import defer
+
+        botmaster = buildmaster.botmaster
+        workers = set()
+        for name, slave in botmaster.slaves.items():
+            if slave.isConnected():
+                workers.add(name)
+
+        running = []
+        for builder in botmaster.builders.values():
+            self.profile(builder)
+            for build in builder.building:
+                running.append((builder.name, build.getSlaveName()))
+
+        for builder in builders:
+            self.updateDuration(builder)
+
+        state = LockState(self.profiles, running, self.capacity)
+
+        d = defer.gatherResults([b.getOldestRequestTime() for b in builders])
+
+        def sort(times):
+            byname = dict((b.name, b) for b in builders)
+            candidates = [(b.name, self._seconds(t))
+                          for b, t in zip(builders, times)]
+            order = self.order(candidates, self.profiles, state, workers,
+                               time.time())
+            return [byname[name] for name in order]
+        d.addCallback(sort)
+        return d
+
+    @staticmethod
+    def _seconds(t):
+        # getOldestRequestTime() returns a datetime, or None
+        if t is None:
+            return None
+        return calendar.timegm(t.utctimetuple())
+
+# Shared across reconfigurations, so learned durations are kept.
+builderPrioritizer = BuilderPrioritizer()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+
+# Replay simulator for builder prioritization.
+#
+# Feeds a recorded build request timeline through the original static
+# priority ordering and through the cost model in prioritize.py, and
+# reports makespan, worker slot utilization, and request wait times for
+# both. Builder profiles (priorities and locks) are derived from the build
+# matrix and mirror the locks and resource needs defined in master.cfg.
+#
+# The timeline is read either from the buildbot state database or from a
+# file with one JSON object per line:
+#   {"builder": "qemu-arm-6.6", "submitted": 1700000000, "duration": 312}
+#
+# Usage:
+#   prioritysim.py [-d state.sqlite] [--days n] [--cold] [timeline]
+
+from __future__ import print_function
+
+import argparse
+import collections
+import heapq
+import json
+import sqlite3
+import time
+
+import config
+import matrix
+import resources
+from prioritize import CostModel, LockNeed, LockState, Profile
+
+def capacity():
+    return resources.workerCapacity(config.workers, config.worker_resources,
+                                    config.default_worker_resources)
+
+def profiles():
+    # Builder profiles, mirroring the locks and resources in master.cfg
+    workers = tuple(config.workers)
+    def needs(kind):
+        return resources.builderNeeds(config.builder_resources, kind)
+    smatch_lock = LockNeed('smatch', True, 1, (), True)
+    result = {}
+    for branch in matrix.load():
+        for spec in branch.builds:
+            builddir_lock = LockNeed('builddir_%s' % spec.builddir, True, 1,
+                                     (), True)
+            result[spec.name] = Profile(3, (builddir_lock,), workers,
+                                        needs('build'))
+        for spec in branch.qemu:
+            target_lock = LockNeed('qemu_target_%s' % spec.target, True, 1,
+                                   (), True)
+            result[spec.name] = Profile(4, (target_lock,), workers,
+                                        needs('qemu'))
+    for name in config.hwmon_branches_only:
+        result[name] = Profile(2, (smatch_lock,), workers, needs('smatch'))
+    return result
+
+def readDatabase(path, days):
+    db = sqlite3.connect(path)
+    since = int(time.time()) - days * 24 * 60 * 60
+    # Merged requests share a build; count each build once.
+    c = db.execute("""SELECT br.buildername, MIN(br.submitted_at),
+                             MAX(b.finish_time - b.start_time)
+                      FROM buildrequests br JOIN builds b ON b.brid = br.id
+                      WHERE b.finish_time IS NOT NULL AND br.submitted_at >= ?
+                      GROUP BY br.buildername, b.number""", (since,))
+    requests = [(submitted, name, duration)
+                for name, submitted, duration in c.fetchall()]
+    db.close()
+    return sorted(requests)
+
+def readTimeline(path):
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                r = json.loads(line)
+                requests.append((r['submitted'], r['builder'], r['duration']))
+    return sorted(requests)
+
+class StaticPolicy(object):
+    # The original prioritizeBuilders: static priority only.
+    def recordDuration(self, name, seconds):
+        pass
+
+    def order(self, candidates, profiles, state, workers, now):
+        ordered = sorted(candidates, key=lambda c: profiles[c[0]].priority)
+        return [name for name, _ in ordered]
+
+def simulate(policy, requests, profiles):
+    workers = set(config.workers)
+    capacities = capacity()
+    slots = sum(c.builds for c in capacities.values())
+    state = LockState(profiles, [], capacities)
+    pending = collections.defaultdict(collections.deque)
+    running = []
+    waits = []
+    busy = 0
+    arrivals = collections.deque(requests)
+    start = arrivals[0][0]
+    now = end = start
+    seq = 0
+
+    while arrivals or running:
+        times = []
+        if arrivals:
+            times.append(arrivals[0][0])
+        if running:
+            times.append(running[0][0])
+        now = min(times)
+        while running and running[0][0] <= now:
+            finish, _, name, worker, duration = heapq.heappop(running)
+            state.release(profiles[name], worker)
+            state.onWorker.discard((name, worker))
+            policy.recordDuration(name, duration)
+            end = max(end, finish)
+        while arrivals and arrivals[0][0] <= now:
+            submitted, name, duration = arrivals.popleft()
+            pending[name].append((submitted, duration))
+
+        candidates = [(name, q[0][0]) for name, q in pending.items() if q]
+        for name in policy.order(candidates, profiles, state, workers, now):
+            profile = profiles[name]
+            queue = pending[name]
+            while queue:
+                usable = [w for w in profile.workers
+                          if w in workers and state.canStart(name, profile, w)]
+                if not usable:
+                    break
+                worker = min(usable, key=lambda w: (state.used[w].builds, w))
+                submitted, duration = queue.popleft()
+                state.acquire(profile, worker)
+                state.onWorker.add((name, worker))
+                seq += 1
+                heapq.heappush(running,
+                               (now + duration, seq, name, worker, duration))
+                waits.append(now - submitted)
+                busy += duration
+
+    makespan = max(end - start, 1)
+    waits.sort()
+    return {
+        'makespan': makespan,
+        'utilization': busy * 100.0 / (makespan * slots),
+        'wait_mean': sum(waits) / float(len(waits)),
+        'wait_p90': waits[int(len(waits) * 0.9)],
+        'wait_max': waits[-1],
+    }
+
+def hms(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay build requests')
+    parser.add_argument('-d', '--database',
+        help='Buildbot state database (state.sqlite)')
+    parser.add_argument('--days', type=int, default=7,
+        help='Replay requests from the last n days (default 7)')
+    parser.add_argument('--cold', action='store_true',
+        help='Do not seed the cost model with recorded durations')
+    parser.add_argument('timeline', nargs='?',
+        help='Request timeline, one JSON object per line')
+    args = parser.parse_args()
+
+    if args.database:
+        requests = readDatabase(args.database, args.days)
+    elif args.timeline:
+        requests = readTimeline(args.timeline)
+    else:
+        parser.error('Need database or timeline')
+
+    known = profiles()
+    unknown = set(name for _, name, _ in requests if name not in known)
+    requests = [r for r in requests if r[1] in known]
+    if unknown:
+        print("Ignoring %d unknown builders" % len(unknown))
+    if not requests:
+        raise SystemExit("No requests to replay")
+
+    costModel = CostModel()
+    if not args.cold:
+        # The live model learns durations from finished builds.
+        for _, name, duration in requests:
+            costModel.recordDuration(name, duration)
+
+    print("%d requests, %d builders" %
+          (len(requests), len(set(r[1] for r in requests))))
+    print("%-8s %10s %12s %10s %10s %10s" %
+          ('policy', 'makespan', 'utilization', 'wait mean', 'wait p90',
+           'wait max'))
+    for label, policy in (('static', StaticPolicy()), ('cost', costModel)):
+        r = simulate(policy, requests, known)
+        print("%-8s %10s %11.1f%% %10s %10s %10s" %
+              (label, hms(r['makespan']), r['utilization'],
+               hms(r['wait_mean']), hms(r['wait_p90']), hms(r['wait_max'])))
@@ -0,0 +1,115 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Worker resource accounting.
+#
+# Each worker declares its capacity (CPUs, memory and scratch disk space
+# in GB, and the maximum number of concurrent builds) in
+# config.worker_resources, and each kind of builder declares what one of
+# its builds needs in config.builder_resources. A build is admitted to a
+# worker if the needs of all builds running there plus its own fit into
+# the worker's capacity. A build is always admitted to an idle worker, so
+# builds needing more than a small worker has still run there, alone.
+#
+# Admission is the canStartBuild implementation for buildbot. It reports
+# how long workers kept builds waiting to metrics.py. The accounting
+# itself does not depend on buildbot; prioritize.py and prioritysim.py
+# use it as well.
+
+import collections
+import time
+
+from metrics import metrics
+
+Resources = collections.namedtuple('Resources', 'cpus memory disk builds')
+
+none = Resources(0, 0, 0, 0)
+
+def fromConfig(values, default=None):
+    # Convert a dictionary from config.py. Missing entries are taken from
+    # 'default' (a dictionary as well).
+    merged = dict(default or {})
+    merged.update(values or {})
+    return Resources(*(merged.get(f, 0) for f in Resources._fields))
+
+def add(a, b):
+    return Resources(*(x + y for x, y in zip(a, b)))
+
+def sub(a, b):
+    return Resources(*(x - y for x, y in zip(a, b)))
+
+def fits(used, need, capacity):
+    if used.builds == 0:
+        return True
+    total = add(used, need)
+    return all(t <= c for t, c in zip(total, capacity))
+
+def workerCapacity(workers, resources, default):
+    # Return {worker: Resources} from config.worker_resources and
+    # config.default_worker_resources.
+    return dict((w, fromConfig(resources.get(w), default)) for w in workers)
+
+def builderNeeds(resources, kind):
+    # One build slot, plus what config.builder_resources declares
+    return fromConfig(resources.get(kind), {'builds': 1})
+
+def needsOf(properties):
+    # Needs of a builder, from its 'resources' property
+    need = properties.get('resources')
+    if need is None:
+        return Resources(0, 0, 0, 1)
+    return Resources(*need)
+
+class Admission(object):
+    """canStartBuild implementation for buildbot."""
+
+    # Builds which were admitted but are not (yet) running are counted
+    # for this many seconds. Starting a build involves pinging the
+    # worker; this keeps other builds from being admitted meanwhile.
+    reservationTimeout = 60
+
+    def __init__(self):
+        self.capacity = {}
+        self._reserved = {}
+        self._blocked = {}      # worker: time of the first rejected build
+
+    def configure(self, capacity):
+        self.capacity = dict(capacity)
+
+    def usage(self, botmaster):
+        # Return {worker: Resources} of running and reserved builds.
+        used = collections.defaultdict(lambda: none)
+        running = set()
+        for builder in botmaster.builders.values():
+            need = needsOf(builder.config.properties)
+            for build in builder.building:
+                worker = build.getSlaveName()
+                running.add((builder.name, worker))
+                used[worker] = add(used[worker], need)
+        now = time.time()
+        for key, (when, need) in list(self._reserved.items()):
+            if key in running or now - when > self.reservationTimeout:
+                del self._reserved[key]
+            else:
+                used[key[1]] = add(used[key[1]], need)
+        return used
+
+    def __call__(self, builder, slavebuilder, breq):
+        worker = slavebuilder.slave.slavename
+        capacity = self.capacity.get(worker)
+        if capacity is None:
+            return True
+        need = needsOf(builder.config.properties)
+        used = self.usage(builder.botmaster)[worker]
+        now = time.time()
+        if not fits(used, need, capacity):
+            self._blocked.setdefault(worker, now)
+            return False
+        blocked = self._blocked.pop(worker, None)
+        if blocked is not None:
+            metrics.admissionWait(worker, now - blocked)
+        self._reserved[(builder.name, worker)] = (now, need)
+        return True
+
+# Shared across reconfigurations, so reservations are kept.
+buildAdmission = Admission()
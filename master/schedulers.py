@@ -1,3 +1,4 @@
+from buildbot import config
 from buildbot import util
 from twisted.internet import defer
 from twisted.internet import reactor
@@ -5,42 +6,90 @@ from twisted.python import log
 
 from buildbot.schedulers import base
 from buildbot.util import NotABranch
-from buildbot.changes import changes
 from buildbot.changes import filter
 
-import datetime
-from dateutil import parser
-
-def currentTimeInRange(range):
-    start = parser.parse(range[0])
-    end = parser.parse(range[1])
-    now=datetime.datetime.now()
-    if end < start:	# crosses midnight
-        if end >= now:	# not yet ended
-	    start -= datetime.timedelta(days=1)
-	else:		# possibly not yet started
-	    end += datetime.timedelta(days=1)
-    return start <= now <= end
-
-def timeToStart(range):
-    start = parser.parse(range[0])
-    end = parser.parse(range[1])
-    now=datetime.datetime.now()
-    if start > now:
-        # later today
-	delta=start-now
-	# delta includes fractions of seconds, so let's round up.
-	return delta.days*24*60*60 + delta.seconds + 1
-    if end < now:
-	# tomorrow and not later today
-	delta=start+datetime.timedelta(days=1)-now
-	# delta includes fractions of seconds, so let's round up.
-	return delta.days*24*60*60 + delta.seconds + 1
-    return 0
+import heapq
+import sqlalchemy as sa
+import time
+
+from metrics import metrics
+from timewindow import TimeWindow
+
+class ReleaseCoordinator(object):
+    """Staggered release of timed buildsets.
+
+    Staggered schedulers whose timer fires are queued here instead of
+    adding their buildsets immediately. Queued schedulers are released one
+    at a time, 'interval' seconds apart, ordered by scheduler priority
+    (lower first) and by the duration of their previous buildset (longer
+    first). A release is held back while more than 'maxPending' build
+    requests are waiting for a worker.
+    """
+
+    _reactor = reactor  # for tests
+
+    # Wait this long after the first scheduler was queued before releasing
+    # anything, to give other schedulers firing at the same time a chance
+    # to be queued.
+    gather = 10
+
+    def __init__(self, interval=120, maxPending=None):
+        self.interval = interval
+        self.maxPending = maxPending
+        self._queue = []
+        self._seq = 0
+        self._timer = None
+
+    def configure(self, interval=120, maxPending=None):
+        self.interval = interval
+        self.maxPending = maxPending
+
+    def enqueue(self, scheduler, duration):
+        self._seq += 1
+        heapq.heappush(self._queue,
+                       (scheduler.priority, -(duration or 0), self._seq, scheduler))
+        if not self._timer:
+            self._timer = self._reactor.callLater(self.gather, self._release)
+
+    def cancel(self, scheduler):
+        self._queue = [e for e in self._queue if e[3] is not scheduler]
+        heapq.heapify(self._queue)
+
+    def _release(self):
+        self._timer = None
+        if not self._queue:
+            return
+        master = self._queue[0][3].master
+        d = master.db.buildrequests.getBuildRequests(claimed=False,
+                                                     complete=False)
+        d.addCallback(self._maybeRelease)
+        d.addErrback(log.err, "while releasing timed buildsets")
+
+        def reschedule(_):
+            if self._queue and not self._timer:
+                self._timer = self._reactor.callLater(self.interval,
+                                                      self._release)
+        d.addCallback(reschedule)
+
+    def _maybeRelease(self, pending):
+        if not self._queue:
+            return
+        if self.maxPending is not None and len(pending) > self.maxPending:
+            log.msg("%d build requests pending, holding back %d scheduler(s)"
+                    % (len(pending), len(self._queue)))
+            return
+        scheduler = heapq.heappop(self._queue)[3]
+        return scheduler.releaseTimedChanges()
+
+# Shared by all staggered schedulers. This survives reconfigurations,
+# so master.cfg should call configure() instead of creating a new one.
+releaseCoordinator = ReleaseCoordinator()
 
 class TimedSingleBranchScheduler(base.BaseScheduler):
 
-    compare_attrs = ['timeRange', 'treeStableTimer', 'change_filter',
+    compare_attrs = ['timeRange', 'weekdays', 'timezone', 'priority',
+		     'staggered',
+		     'treeStableTimer', 'change_filter',
 		      'fileIsImportant', 'collapseRequests',
 		     'onlyImportant', 'reason']
 
@@ -49,20 +98,38 @@ class TimedSingleBranchScheduler(base.BaseScheduler):
     fileIsImportant = None
     reason = ''
 
-    def __init__(self, name, timeRange=["0:00","23:59:59"], treeStableTimer=None,
+    def __init__(self, name, timeRange=["0:00","23:59:59"], weekdays=None,
+		 timezone=None, treeStableTimer=None,
 		 builderNames=None, branch=NotABranch, branches=NotABranch,
 		 fileIsImportant=None, properties={}, categories=None,
 		 reason="The %(classname)s scheduler named '%(name)s' triggered this build",
 		 change_filter=None, onlyImportant=False,
-		 collapseRequests=None,
+		 collapseRequests=None, priority=0, staggered=False,
 		 **kwargs):
 
 	base.BaseScheduler.__init__(self, name, builderNames, properties, **kwargs)
 
+	# timeRange is a [start, end] pair or a list of such pairs.
+	# weekdays optionally restricts the time windows to the given days,
+	# and timezone selects the time zone (default: local time).
 	self.timeRange = timeRange
+	self.weekdays = weekdays
+	self.timezone = timezone
+	try:
+	    self.window = TimeWindow(timeRange, weekdays=weekdays,
+				     timezone=timezone)
+	except (ValueError, IndexError) as e:
+	    config.error("TimedSingleBranchScheduler '%s': bad time window: %s"
+			 % (name, e))
 	self._timed_change_lock = defer.DeferredLock()
 	self._timed_change_timer = None
 
+	# Staggered schedulers don't add their buildsets when their timer
+	# fires but leave it to releaseCoordinator to release them.
+	self.priority = priority
+	self.staggered = staggered
+	self._release_pending = False
+
 	self.treeStableTimer = treeStableTimer
 	if fileIsImportant is not None:
 	    self.fileIsImportant = fileIsImportant
@@ -96,7 +163,8 @@ class TimedSingleBranchScheduler(base.BaseScheduler):
 
     @util.deferredLocked('_timed_change_lock')
     def gotChange(self, change, important):
-	if currentTimeInRange(self.timeRange) and not self._timed_change_timer:
+	if (self.window.inWindow() and not self._timed_change_timer and
+		not self._release_pending):
 	    return self.addBuildsetForChanges(reason=self.reason,
 					      changeids=[change.number])
 
@@ -106,39 +174,136 @@ class TimedSingleBranchScheduler(base.BaseScheduler):
 	def set_timer(_):
 	    if not important and not self._timed_change_timer:
 		return
-
-	    if self._timed_change_timer:
-		self._timed_change_timer.cancel()
-
-	    def fire_timer():
-		d = self.timedChangeTimerFired()
-		d.addErrback(log.err, "while firing deferred timed timer")
-	    self._timed_change_timer = self._reactor.callLater(
-			timeToStart(self.timeRange), fire_timer)
+	    # A pending release picks up this change as well.
+	    if self._release_pending:
+		return
+	    return self.startTimer()
 	d.addCallback(set_timer)
 	return d
 
+    def startTimer(self):
+        # (Re-)arm the timer to fire at the start of the next time window.
+        # Must be called with _timed_change_lock held. The time the timer
+        # fires is kept in the scheduler state ('release_at') until the
+        # changes are built, so that a restarted or reconfigured scheduler
+        # still releases changes whose window passed meanwhile, or which
+        # were held back by releaseCoordinator, instead of waiting for
+        # the next window.
+        if self._timed_change_timer:
+            self._timed_change_timer.cancel()
+
+        def fire_timer():
+            d = self.timedChangeTimerFired()
+            d.addErrback(log.err, "while firing deferred timed timer")
+        delay = self.window.secondsToStart()
+        self._timed_change_timer = self._reactor.callLater(delay, fire_timer)
+        return self.setState('release_at', self._reactor.seconds() + delay)
+
+    @util.deferredLocked('_timed_change_lock')
     @defer.inlineCallbacks
     def scanExistingClassifiedChanges(self):
-        # call gotChange for each classified change.  This is called at startup
-        # and is intended to re-start the build timer for any changes that
-        # had not yet been built when the scheduler was stopped.
-
-        # NOTE: this may double-call gotChange for changes that arrive just as
-        # the scheduler starts up.  In practice, this doesn't hurt anything.
+        # This is called at startup and is intended to re-start the build
+        # timer for any changes that had not yet been built when the
+        # scheduler was stopped. The changes are already classified, so
+        # there is no need to classify them again or to handle them one
+        # by one.
         classifications = \
             yield self.master.db.schedulers.getChangeClassifications(
                 self.objectid)
 
-        # call gotChange for each change, after first fetching it from the db
-        for changeid, important in classifications.iteritems():
-            chdict = yield self.master.db.changes.getChange(changeid)
+        if not classifications:
+            return
+
+        # Changes are due if the timer fired, or should have fired, before
+        # the scheduler was (re)started.
+        releaseAt = yield self.getState('release_at', None)
+        due = releaseAt is not None and releaseAt <= self._reactor.seconds()
+        if due and not self.window.inWindow():
+            log.msg("%s: releasing changes due since %s" %
+                    (self.name, time.ctime(releaseAt)))
+            metrics.timerFired(self.name, self.builderNames)
+
+        if ((due or self.window.inWindow()) and
+                not self._timed_change_timer):
+            if self.staggered:
+                yield self.queueRelease()
+            else:
+                yield self.addBuildsetForClassifiedChanges(classifications)
+        elif any(classifications.itervalues()) or self._timed_change_timer:
+            yield self.startTimer()
+
+    @defer.inlineCallbacks
+    def queueRelease(self):
+        # Must be called with _timed_change_lock held.
+        if self._release_pending:
+            return
+        self._release_pending = True
+        duration = yield self.getLastDuration()
+        releaseCoordinator.enqueue(self, duration)
+
+    @util.deferredLocked('_timed_change_lock')
+    @defer.inlineCallbacks
+    def releaseTimedChanges(self):
+        # Called by releaseCoordinator when it is our turn.
+        self._release_pending = False
+        metrics.timerReleased(self.name)
+        classifications = \
+            yield self.master.db.schedulers.getChangeClassifications(
+                self.objectid)
+        if classifications:
+            yield self.addBuildsetForClassifiedChanges(classifications)
 
-            if not chdict:
-                continue
+    @defer.inlineCallbacks
+    def getLastDuration(self):
+        # Return the time it took to complete the buildset added last time,
+        # or None if unknown.
+        bsid = yield self.getState('last_bsid', None)
+        if bsid is None:
+            defer.returnValue(None)
+        bsdict = yield self.master.db.buildsets.getBuildset(bsid)
+        if not bsdict or not bsdict['complete'] or not bsdict['complete_at']:
+            defer.returnValue(None)
+        delta = bsdict['complete_at'] - bsdict['submitted_at']
+        defer.returnValue(delta.days * 24 * 60 * 60 + delta.seconds)
+
+    def getExistingChangeIds(self, changeids):
+        # Return the set of changeids which still exist in the database,
+        # using a single database round trip instead of one per change.
+        changes_tbl = self.master.db.model.changes
+        changeids = list(changeids)
+
+        def thd(conn):
+            found = set()
+            # Stay below the sqlite limit for the number of host parameters.
+            for i in range(0, len(changeids), 500):
+                q = sa.select([changes_tbl.c.changeid],
+                        whereclause=changes_tbl.c.changeid.in_(changeids[i:i + 500]))
+                for row in conn.execute(q):
+                    found.add(row.changeid)
+            return found
+        return self.master.db.pool.do(thd)
 
-            change = yield changes.Change.fromChdict(self.master, chdict)
-            yield self.gotChange(change, important)
+    @defer.inlineCallbacks
+    def addBuildsetForClassifiedChanges(self, classifications):
+        # Add a buildset for all classified changes and flush the
+        # classifications. Must be called with _timed_change_lock held.
+        changeids = sorted(classifications.keys())
+        max_changeid = changeids[-1]
+        # Verify that each change is still in the database; if it isn't,
+        # addBuildsetForChanges() will bail out.
+        existing = yield self.getExistingChangeIds(changeids)
+        changeids = [changeid for changeid in changeids if changeid in existing]
+
+        if changeids:
+            if self.collapseRequests:
+                changeids = changeids[-1:]
+            bsid, brids = yield self.addBuildsetForChanges(reason=self.reason,
+                                                           changeids=changeids)
+            yield self.setState('last_bsid', bsid)
+
+        yield self.master.db.schedulers.flushChangeClassifications(
+                self.objectid, less_than=max_changeid + 1)
+        yield self.setState('release_at', None)
 
     def getChangeFilter(self, branch, branches, change_filter, categories):
 	if branch is NotABranch and not change_filter:
@@ -169,27 +334,14 @@ class TimedSingleBranchScheduler(base.BaseScheduler):
 
 	# just in case: databases do weird things sometimes!
 	if not classifications:
+	    yield self.setState('release_at', None)
 	    return
 
-	changeids = sorted(classifications.keys())
-	max_changeid = changeids[-1]
-	# Verify that each change is still in the database; if it isn't,
-	# addBuildsetForChanges() will bail out.
-	# Use list() to copy the list for use as iterator; otherwise
-	# the iterator fails if an element is removed from the list.
-	for changeid in list(changeids):
-	    chdict = yield self.master.db.changes.getChange(changeid)
-	    if not chdict:
-		changeids.remove(changeid)
-
-	if changeids:
-	    if self.collapseRequests:
-		changeids = changeids[-1:]
-	    yield self.addBuildsetForChanges(reason=self.reason,
-					     changeids=changeids)
-
-	yield self.master.db.schedulers.flushChangeClassifications(
-		self.objectid, less_than=max_changeid + 1)
+	metrics.timerFired(self.name, self.builderNames)
+	if self.staggered:
+	    yield self.queueRelease()
+	else:
+	    yield self.addBuildsetForClassifiedChanges(classifications)
 
     def stopService(self):
 	d = base.BaseScheduler.stopService(self)
@@ -199,6 +351,9 @@ class TimedSingleBranchScheduler(base.BaseScheduler):
 	    if self._timed_change_timer:
 		self._timed_change_timer.cancel()
 		del self._timed_change_timer
+	    if self._release_pending:
+		releaseCoordinator.cancel(self)
+		self._release_pending = False
 	d.addCallback(cancel_timer)
 	return d
 
@@ -0,0 +1,112 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Pending results of sharded builds.
+#
+# The configuration list of a sharded build (see config.stable_shards) is
+# built by several builds, one per shard. Each shard build reports its
+# own results. Once all shards of a build finished, their summaries (the
+# 'results' property set by StableBuildCommand) are merged into the first
+# shard's build; see shardstatus.py.
+#
+# Summaries of finished shards are kept in a database until all shards
+# of their build finished, so that a build can be merged after a master
+# restart. Builds are identified by the name and number of the first
+# shard's build ('<builder>/<number>', the 'shard_parent' property of
+# the other shards). This module must not depend on buildbot.
+
+import json
+import sqlite3
+import time
+
+shardsdb = 'shards.sqlite'
+
+# Merged builds are remembered for this many seconds, so that late shards
+# of a build merged without them are ignored.
+keepMerged = 7 * 24 * 3600
+
+class ShardStore(object):
+    def __init__(self, dbname=shardsdb):
+        self.db = sqlite3.connect(dbname, timeout=10)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS shards
+                (parent text NOT NULL,
+                 shard INTEGER NOT NULL,
+                 shards INTEGER NOT NULL,
+                 arch text NOT NULL,
+                 time INTEGER NOT NULL,
+                 summary text,
+                 PRIMARY KEY (parent, shard))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS merged
+                (parent text PRIMARY KEY,
+                 time INTEGER NOT NULL)""")
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def add(self, parent, shard, shards, arch, summary, now=None):
+        # Add the summary of a finished shard (None if the shard did not
+        # produce one). Return True if all shards of the build finished.
+        if self.db.execute("SELECT 1 FROM merged WHERE parent = ?",
+                           (parent,)).fetchone():
+            return False
+        self.db.execute("""INSERT OR REPLACE INTO shards
+                (parent, shard, shards, arch, time, summary)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (parent, shard, shards, arch, int(now or time.time()),
+                 None if summary is None else json.dumps(summary)))
+        count, = self.db.execute("SELECT COUNT(*) FROM shards WHERE parent = ?",
+                                 (parent,)).fetchone()
+        return count >= shards
+
+    def expired(self, timeout, now=None):
+        # Return the builds whose first shard finished more than 'timeout'
+        # seconds ago without all other shards finishing.
+        c = self.db.execute("""SELECT parent FROM shards GROUP BY parent
+                HAVING MIN(time) < ?""", (int(now or time.time()) - timeout,))
+        return [row[0] for row in c.fetchall()]
+
+    def take(self, parent, now=None):
+        # Remove the shards of build 'parent' and mark it merged. Return
+        # (shards, arch, {shard: summary}), or None if nothing is pending.
+        now = int(now or time.time())
+        rows = self.db.execute("""SELECT shard, shards, arch, summary
+                FROM shards WHERE parent = ?""", (parent,)).fetchall()
+        if not rows:
+            return None
+        self.db.execute("DELETE FROM shards WHERE parent = ?", (parent,))
+        self.db.execute("DELETE FROM merged WHERE time < ?",
+                        (now - keepMerged,))
+        self.db.execute("INSERT OR REPLACE INTO merged (parent, time) VALUES (?, ?)",
+                        (parent, now))
+        summaries = dict((shard, None if summary is None else json.loads(summary))
+                         for shard, _, _, summary in rows)
+        return rows[0][1], rows[0][2], summaries
+
+def mergeSummaries(arch, shards, summaries):
+    # Merge the summaries of shards 1..'shards' into one. A shard without
+    # summary failed before building anything, or did not finish in time;
+    # it is counted as failed build.
+    merged = {'total': 0, 'passed': 0, 'failed': 0, 'skipped': 0,
+              'results': []}
+    for shard in range(1, shards + 1):
+        summary = summaries.get(shard)
+        if summary is None:
+            merged['total'] += 1
+            merged['failed'] += 1
+            merged['results'].append({'target': "%s:shard%d" % (arch, shard),
+                                      'status': 'failed', 'reason': 'shard'})
+            continue
+        for k in ('total', 'passed', 'failed', 'skipped'):
+            merged[k] += summary[k]
+        merged['results'].extend(summary['results'])
+        if summary.get('log'):
+            merged.setdefault('logs', []).append(summary['log'])
+        config = summary.get('config')
+        if config is not None:
+            if 'config' not in merged:
+                merged['config'] = dict(config)
+            else:
+                for k in config:
+                    merged['config'][k] += config[k]
+    return merged
@@ -0,0 +1,140 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Buildbot side of shards.py.
+#
+# ShardMerger is a status target which collects the summaries of finished
+# shard builds and, once all shards of a build finished, merges them into
+# the status of the first shard's build: its text, result, and 'results'
+# property then cover the entire configuration list. The merge runs on
+# the master after the shard builds finished, so no build keeps a worker
+# or resource reservation while it waits for other shards. Database
+# access runs in a thread, not in the reactor.
+
+from buildbot.status import base
+from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, SKIPPED
+from buildbot.status.builder import EXCEPTION, RETRY
+from twisted.application import internet
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from shards import ShardStore, mergeSummaries
+from shellcommands import StableBuildCommand, countText, failedText
+
+def summaryResult(summary):
+    # Same as AnalyzedBuildCommand.evaluateCommand for build logs
+    if summary['failed'] > 0:
+        return FAILURE if summary['passed'] == 0 else WARNINGS
+    if summary['passed'] == 0:
+        return SKIPPED
+    return SUCCESS
+
+class ShardMerger(base.StatusReceiverMultiService):
+    """Status target merging the results of sharded builds.
+
+    Builds whose shards did not all finish within 'timeout' seconds after
+    the first one are merged without the missing shards, which count as
+    failed builds. This is checked every 'interval' seconds.
+    """
+
+    def __init__(self, timeout=6 * 3600, interval=600):
+        base.StatusReceiverMultiService.__init__(self)
+        self.timeout = timeout
+        self.master_status = None
+        self.watched = []
+        # Serializes database access of merges running in threads
+        self.lock = defer.DeferredLock()
+        internet.TimerService(interval, self.expire).setServiceParent(self)
+
+    def setServiceParent(self, parent):
+        base.StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent
+        self.master_status.subscribe(self)
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        self.master_status = None
+        for w in self.watched:
+            w.unsubscribe(self)
+        self.watched = []
+        return base.StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, name, builder):
+        self.watched.append(builder)
+        return self     # subscribe to builds of this builder
+
+    def buildFinished(self, builderName, build, results):
+        shards = build.getProperty('shards', 1)
+        shard = build.getProperty('shard', 1)
+        if shards <= 1:
+            return
+        if shard == 1:
+            parent = "%s/%d" % (builderName, build.getNumber())
+        else:
+            parent = build.getProperty('shard_parent', None)
+            if parent is None:
+                return      # not triggered by a first shard
+        summary = build.getProperty('results', None)
+        d = self.lock.run(threads.deferToThread, self._add, parent, shard,
+                          shards, build.getProperty('arch'), summary)
+        d.addCallback(self._merge)
+        d.addErrback(log.err, "while recording shard results")
+
+    def expire(self):
+        d = self.lock.run(threads.deferToThread, self._expired)
+        d.addCallback(lambda merges: [self._merge(m) for m in merges])
+        d.addErrback(log.err, "while expiring shard results")
+        return d
+
+    # Run in threads
+
+    def _add(self, parent, shard, shards, arch, summary):
+        store = ShardStore()
+        try:
+            if store.add(parent, shard, shards, arch, summary):
+                return parent, store.take(parent)
+            return None
+        finally:
+            store.close()
+
+    def _expired(self):
+        store = ShardStore()
+        try:
+            return [(parent, store.take(parent))
+                    for parent in store.expired(self.timeout)]
+        finally:
+            store.close()
+
+    # Reactor
+
+    def _merge(self, pending):
+        if pending is None or pending[1] is None:
+            return
+        parent, (shards, arch, summaries) = pending
+        name, number = parent.rsplit('/', 1)
+        try:
+            build = self.master_status.getBuilder(name).getBuild(int(number))
+        except KeyError:
+            build = None    # builder was removed
+        if build is None:
+            log.msg("shards: build %s no longer exists" % parent)
+            return
+        merged = mergeSummaries(arch, shards, summaries)
+        # Replace the counts and failure list of the build step, which
+        # end the build text, with the merged ones.
+        text = build.getText()
+        end = [i for i, t in enumerate(text) if t.startswith('total: ')]
+        text = text[:end[0]] if end else list(text)
+        text.extend(countText(merged['total'], merged['passed'],
+                              merged['skipped'], merged['failed']))
+        if merged['failed'] > 0:
+            failed = [tuple(r['target'].split(':', 1))
+                      for r in merged['results'] if r['status'] == 'failed']
+            text.extend(failedText(failed, StableBuildCommand.failMarkers))
+        build.setText(text)
+        # A first shard which did not produce results failed on its own
+        if (summaries.get(1) is not None and
+                build.getResults() not in (EXCEPTION, RETRY)):
+            build.setResults(summaryResult(merged))
+        build.setProperty('results', merged, 'ShardMerger')
+        build.saveYourself()
@@ -2,21 +2,20 @@
 # ex: set syntax=python:
 
 from buildbot.steps.shell import ShellCommand
-from buildbot.process.buildstep import LogLineObserver
+from buildbot.process.buildstep import BuildStep, LogLineObserver
 from buildbot.status.builder import SUCCESS,WARNINGS,FAILURE,EXCEPTION,RETRY,SKIPPED
 
+import json
 import re
 
-passed = re.compile('Building (\S+):(\S+) \.\.\. passed$')
-failed = re.compile('Building (\S+):(\S+) \.\.\. failed$')
-skipped = re.compile('Building (\S+):(\S+) \.\.\. failed \(\S+\)')
+from twisted.internet import threads
+from twisted.python import log
 
-current_qemu = re.compile('Building ([^:\s]+):([^:\s]+):(\S+) \.+ running [\.R]+')
-passed_qemu = re.compile('Building (\S+):(\S+) \.+ running [\.R]+ passed$')
-failed_qemu = re.compile('Building (\S+):(\S+) .*?failed.*$')
-skipped_qemu = re.compile('Building (\S+):(\S+) \.+ skipped.*$')
-
-kunit_result = re.compile('(?:\[ *\d+\.\d+\](?:\[ *T\d+\])? +)?# ([^:]+): pass:(\d+) fail:(\d+) skip:(\d+) total:\d+$')
+from boottime import checkBoots
+from buildtime import buildWeights, recordBuilds
+from logmatch import BuildLogAnalyzer, QemuLogAnalyzer
+import logstore
+from metrics import metrics, cputime
 
 def lastStep(step):
     allSteps = step.build.getStatus().getSteps()
@@ -24,7 +23,34 @@ def lastStep(step):
     (started, finished) = last.getTimes()
     return started
 
-class GetBuildReference(LogLineObserver):
+def countText(total, passed, skipped, failed):
+    text = [ "total: " + str(total) ]
+    if passed > 0:
+        text.append("pass: " + str(passed))
+    if skipped > 0:
+        text.append("skipped: " + str(skipped))
+    if failed > 0:
+        text.append("fail: " + str(failed))
+    return text
+
+def failedText(failed, markers):
+    # 'failed' is a list of (arch, config)
+    text = [ markers[0] ]
+    for arch, config in failed:
+        text.append(str(arch) + ":" + str(config) + " ")
+    text.append(markers[1])
+    return text
+
+class MeteredLogLineObserver(LogLineObserver):
+    # Accounts the CPU time spent on each log chunk to the observer class
+    # (see metrics.py).
+    def outReceived(self, data):
+        start = cputime()
+        LogLineObserver.outReceived(self, data)
+        metrics.observerTime(self.__class__.__name__, cputime() - start,
+                             data.count('\n'))
+
+class GetBuildReference(MeteredLogLineObserver):
     ref = None
     _re_ref = re.compile(r'^Build reference: (\S+)$')
 
@@ -82,232 +108,143 @@ class RefShellCommand(ShellCommand):
 #	    return FAILURE
 #	return SUCCESS
 
-class AnalyzeBuildLog(LogLineObserver):
+class IndexLog(object):
+    # Write the build unit index of the stdio log; see logstore.py. The
+    # log analyzer observers below feed it each chunk of output before
+    # parsing it, and each line right before analyzing it, so that
+    # markers point at the line the analyzer just saw. A separate
+    # observer would not work: each observer is fed a complete chunk of
+    # log output before the next one sees it.
+    writer = None
+    path = None
+
+    def open(self, path):
+        self.path = path
+        try:
+            self.writer = logstore.LogIndexWriter(path)
+        except Exception:
+            log.err(None, "while opening index of %s" % path)
+
+    def received(self, data, stdout=True):
+        if self.writer is not None:
+            self.writer.received(data, stdout)
+
+    def line(self, line):
+        if self.writer is not None:
+            self.writer.line(line)
+
+    def mark(self, kind, label):
+        if self.writer is not None:
+            try:
+                self.writer.mark(kind, label)
+            except Exception:
+                log.err(None, "while writing index of %s" % self.path)
+                self.writer = None
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                log.err(None, "while closing index of %s" % self.path)
+            self.writer = None
+
+class IndexedLogObserver(MeteredLogLineObserver):
+    # Base of the log analyzer observers: indexes the log they observe.
+    # stderr is only indexed, not parsed.
     def __init__(self, **kwargs):
         LogLineObserver.__init__(self, **kwargs)   # always upcall!
-        self.numTotal = 0
-        self.numPassed = 0
-        self.numFailed = 0
-        self.numSkipped = 0
-        self.failed = []
-    def outLineReceived(self, line):
-        # Look for:
-        # Building <arch>:<config> ... passed
-        # Building <arch>:<config> ... failed
-        # Building <arch:<config> ... failed (config) - skipping
-        if line.startswith("Building "):
-            self.numTotal += 1
-	    if passed.match(line):
-                self.numPassed += 1
-                self.step.setProgress('pass', self.numPassed)
-	    if failed.match(line):
-                self.numFailed += 1
-                self.step.setProgress('fail', self.numFailed)
-                self.failed.append(failed.findall(line))
-	    if skipped.match(line):
-                self.numSkipped += 1
-                self.step.setProgress('skipped', self.numSkipped)
-
-class StableBuildCommand(RefShellCommand):
-    name = "buildcommand"
-    command = [name]
+        self.store = IndexLog()
 
-    def __init__(self, **kwargs):
-        RefShellCommand.__init__(self, **kwargs)   # always upcall!
-        self.counter = AnalyzeBuildLog()
-        self.addLogObserver('stdio', self.counter)
-        self.progressMetrics += ('builds', 'pass', 'fail', 'skipped',)
+    def setLog(self, loog):
+        MeteredLogLineObserver.setLog(self, loog)
+        self.store.open(loog.getFilename())
 
-    def getText(self, cmd, results):
-        text = RefShellCommand.getText(self, cmd, results)
-	# if results == SKIPPED:
-	#     return text
-	text.append("total: " + str(self.counter.numTotal))
-        if self.counter.numPassed > 0:
-            text.append("pass: " + str(self.counter.numPassed))
-        if self.counter.numSkipped > 0:
-            text.append("skipped: " + str(self.counter.numSkipped))
-        if self.counter.numFailed > 0:
-            text.append("fail: " + str(self.counter.numFailed))
-	    # text.append("<!-- [")
-            # for elem in self.counter.failed:
-	    #     text.append(str(elem[0][0]) + ":" + str(elem[0][1]) + " ")
-	    # text.append("] -->")
-        return text
+    def outReceived(self, data):
+        self.store.received(data)
+        MeteredLogLineObserver.outReceived(self, data)
 
-    def getText2(self, cmd, results):
-        text = RefShellCommand.getText2(self, cmd, results)
-	# if results == SKIPPED:
-	#     return text
-	text.append("<br>")
-	text.append("total: " + str(self.counter.numTotal))
-        if self.counter.numPassed > 0:
-            text.append("pass: " + str(self.counter.numPassed))
-        if self.counter.numSkipped > 0:
-            text.append("skipped: " + str(self.counter.numSkipped))
-        if self.counter.numFailed > 0:
-            text.append("fail: " + str(self.counter.numFailed))
-	    text.append("<!-- ")
-            for elem in self.counter.failed:
-	        text.append(str(elem[0][0]) + ":" + str(elem[0][1]) + " ")
-	    text.append("-->")
-        return text
+    def errReceived(self, data):
+        self.store.received(data, stdout=False)
 
-    def maybeGetText2(self, cmd, results):
-	return self.getText2(cmd, results)
+class AnalyzeBuildLog(BuildLogAnalyzer, IndexedLogObserver):
+    def __init__(self, **kwargs):
+        IndexedLogObserver.__init__(self, **kwargs)   # always upcall!
+        BuildLogAnalyzer.__init__(self)
+        self.marker = self.store.mark
 
-    def evaluateCommand(self, cmd):
-        if self.counter.numFailed > 0:
-	    if self.counter.numPassed == 0:
-	        return FAILURE
-            return WARNINGS
-        else:
-	    if self.counter.numPassed == 0:
-	        self.build.result = SKIPPED
-		return SKIPPED
-            return SUCCESS
+    def outLineReceived(self, line):
+        self.store.line(line)
+        BuildLogAnalyzer.outLineReceived(self, line)
 
-class AnalyzeQemuBuildLog(LogLineObserver):
+class AnalyzeQemuBuildLog(QemuLogAnalyzer, IndexedLogObserver):
     def __init__(self, **kwargs):
-        LogLineObserver.__init__(self, **kwargs)   # always upcall!
-        self.numTotal = 0
-        self.numPassed = 0
-        self.numFailed = 0
-        self.numSkipped = 0
-        self.numKunitPassed = 0
-        self.numKunitFailed = 0
-        self.numKunitSkipped = 0
-        self.tracebacks = False
-        self.current = None
-        self.failed = []
-        self.kunit_failed = []
+        IndexedLogObserver.__init__(self, **kwargs)   # always upcall!
+        QemuLogAnalyzer.__init__(self)
+        self.marker = self.store.mark
+
     def outLineReceived(self, line):
-        # Look for:
-        # Building <arch>:<machine>:<config> .+ running .+ passed
-        # Building <arch>:<machine>:<config> .* failed.*
-        # save architecture and machine in self.current for later use
-        # Make sure that '#" is not in the architecture or machine name
-        # because that is used as separator later on.
-        current = current_qemu.match(line)
-        if current:
-            self.current = [current.group(1).replace('#','_'), current.group(2).replace('#','_')]
-        if passed_qemu.match(line) or failed_qemu.match(line) or skipped_qemu.match(line):
-            self.numTotal += 1
-	    if passed_qemu.match(line):
-                self.numPassed += 1
-                self.step.setProgress('pass', self.numPassed)
-	    if failed_qemu.match(line):
-                self.numFailed += 1
-                self.step.setProgress('fail', self.numFailed)
-                self.failed.append(failed_qemu.findall(line))
-            if skipped_qemu.match(line):
-	        self.numSkipped += 1
-                self.step.setProgress('skipped', self.numSkipped)
-	if line.find('[ cut here ]') != -1:
-	    self.tracebacks = True
-	elif line.find('Call Trace:') != -1:
-	    self.tracebacks = True
-	elif line.find('Call trace:') != -1:
-	    self.tracebacks = True
-	elif line.find('stack backtrace') != -1:
-	    self.tracebacks = True
-	elif line.find('Kernel panic') != -1:
-	    self.tracebacks = True
-	elif line.find('show_stack') != -1:
-	    self.tracebacks = True
-	elif line.find('(try booting with the "irqpoll" option)') != -1:
-            self.tracebacks = True
-        kunit = kunit_result.match(line)
-        if kunit:
-            # count totals but add individual test results to output
-            if kunit.group(1) == 'Totals':
-                self.numKunitPassed += int(kunit.group(2))
-                self.numKunitFailed += int(kunit.group(3))
-                self.numKunitSkipped += int(kunit.group(4))
-            elif self.current and int(kunit.group(3)) > 0:
-                new = self.current + [kunit.group(1).replace('#','_')]
-                if new not in self.kunit_failed:
-                    self.kunit_failed.append(new)
-
-class QemuBuildCommand(RefShellCommand):
-    name = "qemubuildcommand"
-    command = [name]
+        self.store.line(line)
+        QemuLogAnalyzer.outLineReceived(self, line)
+
+class AnalyzedBuildCommand(RefShellCommand):
+    # Common base for build steps whose stdio log is analyzed by one of
+    # the log analyzers. Subclasses select the analyzer with 'observer'
+    # and the markers used to embed the list of failed builds in getText2.
+    observer = AnalyzeBuildLog
+    failMarkers = ("<!-- ", "-->")
 
     def __init__(self, **kwargs):
         RefShellCommand.__init__(self, **kwargs)   # always upcall!
-        self.counter = AnalyzeQemuBuildLog()
+        # The analyzer also writes the index of the log (IndexLog).
+        self.counter = self.observer()
         self.addLogObserver('stdio', self.counter)
-        self.progressMetrics += ('builds', 'pass', 'fail', 'skipped', )
+        self.progressMetrics += ('builds', 'pass', 'fail', 'skipped',)
+
+    def start(self):
+        self.counter.started()
+        return RefShellCommand.start(self)
+
+    def commandComplete(self, cmd):
+        RefShellCommand.commandComplete(self, cmd)
+        self.counter.flushProgress()
+        self.counter.store.close()
+
+    def createSummary(self, log):
+        # Make per build unit results available to reporting tools without
+        # having to scrape the status text.
+        summary = self.counter.summary()
+        summary['log'] = self.counter.store.path
+        self.addCompleteLog('results.json',
+                            json.dumps(summary, indent=1, sort_keys=True))
+        self.setProperty('results', summary)
+
+    def countText(self):
+        c = self.counter.counts
+        return countText(c.numTotal, c.numPassed, c.numSkipped, c.numFailed)
+
+    def failedText(self):
+        return failedText([elem[0] for elem in self.counter.counts.failed],
+                          self.failMarkers)
 
     def getText(self, cmd, results):
-	hidden = self._maybeEvaluate(self.hideStepIf, results, self)
-	if hidden:
-	    return ""
         text = RefShellCommand.getText(self, cmd, results)
-	# if results == SKIPPED:
-	#     return text
-	text.append("total: " + str(self.counter.numTotal))
-        if self.counter.numPassed > 0:
-            text.append("pass: " + str(self.counter.numPassed))
-        if self.counter.numSkipped > 0:
-            text.append("skipped: " + str(self.counter.numSkipped))
-        if self.counter.numFailed > 0:
-            text.append("fail: " + str(self.counter.numFailed))
-	    # text.append("<!-- [")
-            # for elem in self.counter.failed:
-	    #     text.append(str(elem[0][0]) + ":" + str(elem[0][1]) + " ")
-	    # text.append("] -->")
-        if self.counter.numKunitFailed or self.counter.numKunitPassed or self.counter.numKunitSkipped:
-            text.append("kunit: ")
-            if self.counter.numKunitPassed:
-                text.append("pass: " + str(self.counter.numKunitPassed))
-            if self.counter.numKunitSkipped:
-                text.append("skipped: " + str(self.counter.numKunitSkipped))
-            if self.counter.numKunitFailed:
-                text.append("fail: " + str(self.counter.numKunitFailed))
+        text.extend(self.countText())
         return text
 
     def getText2(self, cmd, results):
-	hidden = self._maybeEvaluate(self.hideStepIf, results, self)
-	if hidden:
-	    return ""
         text = RefShellCommand.getText2(self, cmd, results)
-	# if results == SKIPPED:
-	#     return text
-	text.append("<br>")
-	text.append("total: " + str(self.counter.numTotal))
-        if self.counter.numPassed > 0:
-            text.append("pass: " + str(self.counter.numPassed))
-        if self.counter.numSkipped > 0:
-            text.append("skipped: " + str(self.counter.numSkipped))
-        if self.counter.numFailed > 0:
-            text.append("fail: " + str(self.counter.numFailed))
-	    text.append("<!-- fail ")
-            for elem in self.counter.failed:
-	        text.append(str(elem[0][0]) + ":" + str(elem[0][1]) + " ")
-	    text.append("fail -->")
-        if self.counter.numKunitFailed or self.counter.numKunitPassed or self.counter.numKunitSkipped:
-            text.append("<br>")
-            text.append("kunit: ")
-            if self.counter.numKunitPassed:
-                text.append("pass: " + str(self.counter.numKunitPassed))
-            if self.counter.numKunitSkipped:
-                text.append("skipped: " + str(self.counter.numKunitSkipped))
-            if self.counter.numKunitFailed:
-                text.append("fail: " + str(self.counter.numKunitFailed))
-                text.append("<!-- kunit ")
-                elems = []
-                for elem in self.counter.kunit_failed:
-                    elems.append(':'.join(elem))
-                text.append('#'.join(elems))
-                text.append(" kunit -->")
+        text.append("<br>")
+        text.extend(self.countText())
+        if self.counter.counts.numFailed > 0:
+            text.extend(self.failedText())
         return text
 
     def maybeGetText2(self, cmd, results):
-	return self.getText2(cmd, results)
+        return self.getText2(cmd, results)
 
     def evaluateCommand(self, cmd):
-        c = self.counter
+        c = self.counter.counts
         if c.numFailed > 0:
             if c.numPassed == 0:
                 result = FAILURE
@@ -316,9 +253,122 @@ class QemuBuildCommand(RefShellCommand):
         elif c.numPassed == 0:
             self.build.result = SKIPPED
             result = SKIPPED
-        elif c.tracebacks:
+        elif self.counter.warnings():
             result = WARNINGS
         else:
             result = SUCCESS
 
         return result
+
+class StableBuildCommand(AnalyzedBuildCommand):
+    name = "buildcommand"
+    command = [name]
+
+    def commandComplete(self, cmd):
+        AnalyzedBuildCommand.commandComplete(self, cmd)
+        # Track build times per release and architecture. They are used
+        # to balance sharded builds. Also track the time spent generating
+        # configurations. The history is updated in a thread, not in the
+        # reactor.
+        release = self.getProperty('release', None)
+        arch = self.getProperty('arch', None)
+        if release and arch:
+            d = threads.deferToThread(recordBuilds, release, arch,
+                                      self.counter.counts.results,
+                                      self.counter.config)
+            d.addErrback(log.err, "while updating build time history")
+            return d
+
+class ShardWeights(BuildStep):
+    # Set the 'shard_weights' property to the build times of the
+    # configurations of the build's release and architecture, as passed
+    # to stable-build-arch.sh in STABLE_BUILD_WEIGHTS. The history is
+    # read in a thread, not in the reactor.
+    name = "shardweights"
+    hideStepIf = True
+
+    def start(self):
+        d = threads.deferToThread(buildWeights, self.getProperty('release'),
+                                  self.getProperty('arch'))
+        d.addErrback(self.noWeights)
+        d.addCallback(self.setWeights)
+        d.addErrback(self.failed)
+
+    def noWeights(self, failure):
+        # Without history, the configurations are split evenly
+        log.err(failure, "while reading build time history")
+        return {}
+
+    def setWeights(self, weights):
+        self.setProperty('shard_weights',
+                         " ".join("%s=%d" % (k, v)
+                                  for k, v in sorted(weights.items())),
+                         'ShardWeights')
+        self.finished(SUCCESS)
+
+class QemuBuildCommand(AnalyzedBuildCommand):
+    name = "qemubuildcommand"
+    command = [name]
+    observer = AnalyzeQemuBuildLog
+    failMarkers = ("<!-- fail ", "fail -->")
+
+    def kunitText(self):
+        c = self.counter.counts
+        text = [ "kunit: " ]
+        if c.numKunitPassed:
+            text.append("pass: " + str(c.numKunitPassed))
+        if c.numKunitSkipped:
+            text.append("skipped: " + str(c.numKunitSkipped))
+        if c.numKunitFailed:
+            text.append("fail: " + str(c.numKunitFailed))
+        return text
+
+    def createSummary(self, stdio):
+        # Track boot times per release and qemu target. Both are provided
+        # as builder properties. The history is updated in a thread, not
+        # in the reactor.
+        release = self.getProperty('release', None)
+        target = self.getProperty('target', None)
+        if not release or not target:
+            return AnalyzedBuildCommand.createSummary(self, stdio)
+        d = threads.deferToThread(checkBoots, release, target,
+                                  self.counter.counts.results)
+        d.addCallback(self.setSlowBoots)
+        d.addErrback(log.err, "while updating boot time history")
+        d.addCallback(lambda _: AnalyzedBuildCommand.createSummary(self, stdio))
+        return d
+
+    def setSlowBoots(self, slow):
+        self.counter.counts.slowBoots = slow
+
+    def hasKunit(self):
+        c = self.counter.counts
+        return c.numKunitFailed or c.numKunitPassed or c.numKunitSkipped
+
+    def getText(self, cmd, results):
+        hidden = self._maybeEvaluate(self.hideStepIf, results, self)
+        if hidden:
+            return ""
+        text = AnalyzedBuildCommand.getText(self, cmd, results)
+        if self.hasKunit():
+            text.extend(self.kunitText())
+        if self.counter.counts.slowBoots:
+            text.append("slow boots: " + str(self.counter.counts.slowBoots))
+        return text
+
+    def getText2(self, cmd, results):
+        hidden = self._maybeEvaluate(self.hideStepIf, results, self)
+        if hidden:
+            return ""
+        text = AnalyzedBuildCommand.getText2(self, cmd, results)
+        if self.hasKunit():
+            text.append("<br>")
+            text.extend(self.kunitText())
+            if self.counter.counts.numKunitFailed:
+                text.append("<!-- kunit ")
+                elems = []
+                for elem in self.counter.counts.kunit_failed:
+                    elems.append(':'.join(elem))
+                text.append('#'.join(elems))
+                text.append(" kunit -->")
+        return text
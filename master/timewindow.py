@@ -0,0 +1,123 @@
+# -*- python -*-
+# ex: set syntax=python:
+
+# Daily time windows for TimedSingleBranchScheduler.
+#
+# Time ranges are parsed once, when the scheduler is created. Checking if
+# the current time is within a window and calculating the time until the
+# next window starts only involves a few integer comparisons.
+
+import datetime
+
+from dateutil import tz as dateutil_tz
+
+try:
+    basestring
+except NameError:   # python 3, for offline tools such as windowbench.py
+    basestring = str
+
+DAY = 24 * 60 * 60
+
+_weekday_names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def parseTimeOfDay(s):
+    # "HH:MM" or "HH:MM:SS" -> seconds since midnight
+    fields = [int(f) for f in s.strip().split(':')]
+    if len(fields) not in (2, 3):
+        raise ValueError("Bad time of day '%s'" % s)
+    fields += [0] * (3 - len(fields))
+    hours, minutes, seconds = fields
+    if not (0 <= hours < 24 and 0 <= minutes < 60 and 0 <= seconds < 60):
+        raise ValueError("Bad time of day '%s'" % s)
+    return hours * 3600 + minutes * 60 + seconds
+
+def parseWeekdays(weekdays):
+    # Return a 7 element list of booleans, Monday first. Accepts weekday
+    # numbers (0 = Monday) or names ('mon', 'Tuesday', ...).
+    if weekdays is None:
+        return [True] * 7
+    mask = [False] * 7
+    for day in weekdays:
+        if not isinstance(day, int):
+            day = _weekday_names.index(day.strip().lower()[:3])
+        mask[day] = True
+    return mask
+
+class TimeWindow(object):
+    """One or more daily time windows.
+
+    'ranges' is either a single [start, end] pair, as used by the
+    timeRange scheduler argument, or a list of such pairs. Times are
+    "HH:MM[:SS]". A window whose end is before its start crosses midnight.
+    Both start and end are included in the window.
+
+    'weekdays' restricts windows to the given days of the week (by the
+    day the window starts). 'timezone' is a tzinfo object or a name such
+    as 'America/Los_Angeles'; the local time zone is used if not provided.
+
+    Daylight saving time changes are not handled. Windows are compared
+    against the wall clock time, but secondsToStart() assumes that all
+    days have 24 hours. A timer armed before a change can fire an hour
+    early or late.
+    """
+
+    def __init__(self, ranges, weekdays=None, timezone=None):
+        if isinstance(ranges[0], basestring):
+            ranges = [ranges]
+        self.windows = tuple((parseTimeOfDay(start), parseTimeOfDay(end))
+                             for start, end in ranges)
+        self.weekdays = parseWeekdays(weekdays)
+        if not any(self.weekdays):
+            raise ValueError("No weekday selected")
+        if isinstance(timezone, basestring):
+            name = timezone
+            timezone = dateutil_tz.gettz(name)
+            if timezone is None:
+                raise ValueError("Unknown time zone '%s'" % name)
+        self.timezone = timezone
+
+    def _now(self, now):
+        # Return (weekday, seconds since midnight) for the current time.
+        if now is None:
+            now = datetime.datetime.now(self.timezone)
+        elif now.tzinfo is not None and self.timezone is not None:
+            now = now.astimezone(self.timezone)
+        seconds = (now.hour * 3600 + now.minute * 60 + now.second +
+                   now.microsecond / 1000000.0)
+        return now.weekday(), seconds
+
+    def inWindow(self, now=None):
+        return self._inWindow(*self._now(now))
+
+    def _inWindow(self, weekday, seconds):
+        days = self.weekdays
+        for start, end in self.windows:
+            if start <= end:
+                if days[weekday] and start <= seconds <= end:
+                    return True
+            else:
+                # crosses midnight
+                if days[weekday] and seconds >= start:
+                    return True
+                if days[weekday - 1] and seconds <= end:
+                    return True
+        return False
+
+    def secondsToStart(self, now=None):
+        # Return the number of seconds until the next window starts,
+        # or 0 if currently within a window. The result is rounded up
+        # to make sure that a timer firing after it is within the window.
+        weekday, seconds = self._now(now)
+        if self._inWindow(weekday, seconds):
+            return 0
+        best = None
+        for offset in range(8):
+            if not self.weekdays[(weekday + offset) % 7]:
+                continue
+            for start, end in self.windows:
+                delta = offset * DAY + start - seconds
+                if delta > 0 and (best is None or delta < best):
+                    best = delta
+            if best is not None:
+                break
+        return int(best) + 1
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- python -*-
+# ex: set syntax=python:
+
+# Benchmark and consistency check for TimeWindow.
+#
+# Compares TimeWindow against the original per-call implementation of
+# currentTimeInRange() and timeToStart() for random times of day and
+# random time ranges, including ranges crossing midnight, and reports
+# the time per call for both.
+#
+# Also checks multiple windows, weekday masks, time zones, and windows
+# crossing midnight against a list of known cases. With --check, only the
+# checks are run.
+#
+# Usage:
+#   windowbench.py [--check] [-n iterations] [-s seed]
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import random
+import time
+
+from dateutil import parser
+from dateutil import tz
+
+from timewindow import TimeWindow
+
+# Original implementation, with the current time passed as parameter.
+
+def currentTimeInRange(range, now):
+    default = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = parser.parse(range[0], default=default)
+    end = parser.parse(range[1], default=default)
+    if end < start:	# crosses midnight
+        if end >= now:	# not yet ended
+            start -= datetime.timedelta(days=1)
+        else:		# possibly not yet started
+            end += datetime.timedelta(days=1)
+    return start <= now <= end
+
+def timeToStart(range, now):
+    default = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = parser.parse(range[0], default=default)
+    end = parser.parse(range[1], default=default)
+    if start > now:
+        delta=start-now
+        return delta.days*24*60*60 + delta.seconds + 1
+    if end < now:
+        delta=start+datetime.timedelta(days=1)-now
+        return delta.days*24*60*60 + delta.seconds + 1
+    return 0
+
+def randomTime():
+    return "%02d:%02d:%02d" % (random.randrange(24), random.randrange(60),
+                               random.randrange(60))
+
+def randomNow():
+    return datetime.datetime(2024, 1, 1) + datetime.timedelta(
+            days=random.randrange(7), seconds=random.randrange(86400),
+            microseconds=random.randrange(1000000))
+
+def check(iterations):
+    errors = 0
+    for _ in range(iterations):
+        timeRange = [randomTime(), randomTime()]
+        window = TimeWindow(timeRange)
+        now = randomNow()
+        inrange = currentTimeInRange(timeRange, now)
+        if window.inWindow(now) != inrange:
+            print("inWindow(%s) mismatch for %s" % (now, timeRange))
+            errors += 1
+        # The original timeToStart() returns bogus values for ranges
+        # crossing midnight if called within the range. Only compare
+        # results outside the time range.
+        if inrange:
+            expect = 0
+        else:
+            expect = timeToStart(timeRange, now)
+        if window.secondsToStart(now) != expect:
+            print("secondsToStart(%s) mismatch for %s: %s != %s" %
+                  (now, timeRange, window.secondsToStart(now), expect))
+            errors += 1
+    return errors
+
+# 2024-01-01 is a Monday
+def at(day, hour, minute=0, tzinfo=None):
+    return datetime.datetime(2024, 1, 1 + day, hour, minute, tzinfo=tzinfo)
+
+MON, TUE, WED, THU, FRI, SAT, SUN = range(7)
+
+HOUR = 3600
+
+pacific = tz.tzoffset('PST', -8 * HOUR)
+
+# (time ranges, weekdays, time zone, now, inWindow, secondsToStart)
+# secondsToStart is rounded up by one second.
+cases = [
+    # Several windows per day
+    ([["00:00", "00:30"], ["12:00", "12:30"]], None, None,
+     at(MON, 0, 15), True, 0),
+    ([["00:00", "00:30"], ["12:00", "12:30"]], None, None,
+     at(MON, 6), False, 6 * HOUR + 1),
+    ([["00:00", "00:30"], ["12:00", "12:30"]], None, None,
+     at(MON, 12, 30), True, 0),
+    ([["00:00", "00:30"], ["12:00", "12:30"]], None, None,
+     at(MON, 12, 31), False, 11 * HOUR + 29 * 60 + 1),
+    # Weekday masks, by name and by number
+    (["00:00", "00:30"], ['sat', 'sun'], None,
+     at(FRI, 0, 10), False, 23 * HOUR + 50 * 60 + 1),
+    (["00:00", "00:30"], ['sat', 'sun'], None, at(SAT, 0, 10), True, 0),
+    (["00:00", "00:30"], ['Saturday', 'Sunday'], None,
+     at(MON, 0, 10), False, 4 * 24 * HOUR + 23 * HOUR + 50 * 60 + 1),
+    (["00:00", "00:30"], [MON], None, at(SUN, 23), False, HOUR + 1),
+    # Crossing midnight, without and with weekday mask. The window
+    # belongs to the day it starts.
+    (["23:00", "01:00"], None, None, at(MON, 23, 30), True, 0),
+    (["23:00", "01:00"], None, None, at(MON, 0, 30), True, 0),
+    (["23:00", "01:00"], None, None, at(MON, 1, 1), False,
+     21 * HOUR + 59 * 60 + 1),
+    (["23:00", "01:00"], ['fri'], None, at(FRI, 23, 30), True, 0),
+    (["23:00", "01:00"], ['fri'], None, at(SAT, 0, 30), True, 0),
+    (["23:00", "01:00"], ['fri'], None, at(SAT, 23), False,
+     6 * 24 * HOUR + 1),
+    (["23:00", "01:00"], ['fri'], None, at(FRI, 0, 30), False,
+     22 * HOUR + 30 * 60 + 1),
+    (["23:00", "01:00"], ['fri'], None, at(FRI, 22), False, HOUR + 1),
+    # Time zones: the window and its weekdays are in the scheduler's time
+    # zone. Monday 16:15 PST is Tuesday 00:15 UTC.
+    (["00:00", "00:30"], ['tue'], 'UTC',
+     at(MON, 16, 15, tzinfo=pacific), True, 0),
+    (["00:00", "00:30"], ['mon'], 'UTC',
+     at(MON, 16, 15, tzinfo=pacific), False, 6 * 24 * HOUR - 15 * 60 + 1),
+    (["00:00", "00:30"], None, pacific,
+     at(TUE, 0, 15, tzinfo=tz.tzutc()), False, 7 * HOUR + 45 * 60 + 1),
+]
+
+def checkCases():
+    errors = 0
+    for ranges, weekdays, timezone, now, inwindow, seconds in cases:
+        window = TimeWindow(ranges, weekdays=weekdays, timezone=timezone)
+        result = (window.inWindow(now), window.secondsToStart(now))
+        if result != (inwindow, seconds):
+            print("%s weekdays %s time zone %s at %s: %s, expected %s" %
+                  (ranges, weekdays, timezone, now, result,
+                   (inwindow, seconds)))
+            errors += 1
+    for args, kwargs in ((["25:00", "01:00"], {}),
+                         (["00:00", "00:30"], {'weekdays': []}),
+                         (["00:00", "00:30"], {'timezone': 'No/Such_Zone'})):
+        try:
+            TimeWindow(args, **kwargs)
+        except ValueError:
+            continue
+        print("TimeWindow(%s, %s) did not fail" % (args, kwargs))
+        errors += 1
+    return errors
+
+def bench(iterations):
+    timeRange = ["00:00:00", "00:30:00"]
+    window = TimeWindow(timeRange)
+    now = datetime.datetime.now()
+
+    start = time.time()
+    for _ in range(iterations):
+        currentTimeInRange(timeRange, now)
+        timeToStart(timeRange, now)
+    t_old = time.time() - start
+
+    start = time.time()
+    for _ in range(iterations):
+        window.inWindow(now)
+        window.secondsToStart(now)
+    t_new = time.time() - start
+
+    print("before %.2f us/call, after %.2f us/call (%.1fx)" %
+          (t_old * 1e6 / iterations, t_new * 1e6 / iterations,
+           t_old / max(t_new, 1e-9)))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Benchmark time windows')
+    argparser.add_argument('-n', '--iterations', type=int, default=20000)
+    argparser.add_argument('-s', '--seed', type=int, default=None)
+    argparser.add_argument('--check', action='store_true',
+                           help='Run checks only')
+    args = argparser.parse_args()
+
+    random.seed(args.seed)
+    errors = checkCases()
+    errors += check(args.iterations)
+    print("%d checks failed" % errors if errors else "all checks passed")
+    if not args.check:
+        bench(args.iterations)
+    if errors:
+        raise SystemExit(1)
@@ -29,6 +29,16 @@ fi
 
 __cachedir="${__buildbot_cachedir}/$(basename ${__progdir})"
 __fscachedir="${__buildbot_cachedir}/filesystems"
+# Content addressed cache of decompressed images, shared by all targets.
+# Size limit in MiB.
+__imagecachedir="${__buildbot_cachedir}/images"
+__imagecache_size="${IMAGECACHE_SIZE:-8192}"
+# Results of passed qemu sessions. Enabled with QEMU_RESULT_CACHE=1.
+# Entries not used for this many days are removed.
+__resultcachedir="${__buildbot_cachedir}/results/qemu"
+__resultcache="${QEMU_RESULT_CACHE:-0}"
+__resultcache_days=14
+__resultcache_base=""
 
 __do_network_test=0
 __do_tpm_test=0
@@ -76,6 +86,16 @@ __cleanup()
 {
     rv=$?
 
+    if [[ -n "${__spooldir}" ]]; then
+	if [[ ${__parallel_abort} -eq 0 ]]; then
+	    __parallel_finish
+	    rv=$((rv + $?))
+	else
+	    __parallel_kill
+	fi
+	rm -rf "${__spooldir}"
+    fi
+
     if [[ -s "${__logfiles}" ]]; then
 	cat "${__logfiles}" | xargs rm -f
     fi
@@ -113,7 +133,17 @@ trap __cleanup ${signals}
 LOOPTIME=5	# Wait time before checking status
 MAXTIME=180	# Maximum wait time for qemu session to complete
 MAXSTIME=60	# Maximum wait time for qemu session to generate output
+# Log file watcher used by dowait(). If not available, dowait() falls back
+# to polling the log file every LOOPTIME seconds.
+__logwatch="${__basedir}/scripts/logwatch.py"
 __retries=1	# Default number of retries
+# Maximum number of qemu sessions running in parallel. Kernels are still
+# built one at a time, but qemu sessions run in the background while the
+# next kernel is built. Output is kept in the same order as with sequential
+# execution.
+__parallel="${QEMU_PARALLEL:-1}"
+__spooldir=""
+__parallel_abort=0
 
 __testbuild=0	# test build, do not run tests
 ___testbuild=0	# test build, run tests but abort after first failure
@@ -221,13 +251,14 @@ parse_args()
     __print_runtime=0
     extracli=""
 
-    while getopts abBde:KlLnNo:O:qr:tTWx opt; do
+    while getopts abBde:j:KlLnNo:O:qr:tTWx opt; do
 	case ${opt} in
 	a)	runall="$((runall + 1))";;
 	b)	bugverbose=1;;
 	B)	nobugverbose=1;;
 	d)	dodebug=$((dodebug + 1));;
 	e)	extracli=${OPTARG};;
+	j)	__parallel=${OPTARG};;
 	K)	nokallsyms=1;;
 	l)	__log_always=1;;
 	L)	__log_all=1;;
@@ -253,6 +284,129 @@ parse_args()
     if [[ -z "${qemu_builddir}" ]]; then
 	__set_qemu_builddir_default
     fi
+
+    if [[ -z "${__parallel}" || -n ${__parallel//[0-9]/} ]]; then
+	echo "Bad number of parallel qemu sessions: ${__parallel}"
+	exit 1
+    fi
+    # Test builds abort after the first failure, so results are needed
+    # right away.
+    if [[ ${___testbuild} -ne 0 ]]; then
+	__parallel=1
+    fi
+    if [[ ${__parallel} -gt 1 ]]; then
+	__parallel_init
+    fi
+}
+
+# Parallel execution of qemu sessions.
+#
+# Script output is written into numbered segment files in the spool
+# directory. Each qemu session started in the background appends its
+# output to the current segment, and the script continues with the next
+# segment. A segment is complete when its qemu session is done, or for the
+# last segment when the script exits. A printer process copies segments
+# to the original standard output in order, so the output is the same as
+# with sequential execution.
+
+__parallel_printer()
+{
+    local i=0
+    local seg
+    local size
+    local offset
+    local done
+
+    while [[ -e "${__spooldir}/${i}" ]]; do
+	seg="${__spooldir}/${i}"
+	offset=0
+	while true; do
+	    # Check for completion first so no output is lost
+	    done=0
+	    if [[ -e "${seg}.done" ]]; then
+		done=1
+	    fi
+	    size="$(stat -c '%s' "${seg}")"
+	    if [[ ${size} -gt ${offset} ]]; then
+		tail -c +$((offset + 1)) "${seg}" | head -c $((size - offset))
+		offset=${size}
+	    fi
+	    if [[ ${done} -ne 0 ]]; then
+		break
+	    fi
+	    sleep 1
+	done
+	i=$((i + 1))
+    done
+}
+
+__parallel_init()
+{
+    __spooldir="$(mktemp -d "/tmp/qemuspool.XXXXX")"
+    __segment=0
+    __vm_pids=()
+
+    : > "${__spooldir}/0"
+    exec {__stdout}>&1
+    ( trap - ${signals}; __parallel_printer ) >&${__stdout} &
+    __printer_pid=$!
+    exec 1>>"${__spooldir}/0"
+
+    # Signals abort running qemu sessions instead of waiting for them.
+    trap '__parallel_abort=1; exit 1' ${signals#EXIT }
+}
+
+# Wait until no more than $1 qemu sessions are running.
+__parallel_wait()
+{
+    local max=$1
+    local pids
+    local pid
+
+    while true; do
+	pids=()
+	for pid in "${__vm_pids[@]}"; do
+	    if kill -0 "${pid}" 2>/dev/null; then
+		pids+=("${pid}")
+	    fi
+	done
+	__vm_pids=("${pids[@]}")
+	if [[ ${#__vm_pids[@]} -le ${max} ]]; then
+	    break
+	fi
+	sleep 1
+    done
+}
+
+# Wait for all qemu sessions and for their output to be printed.
+# Return the sum of the qemu session return codes.
+__parallel_finish()
+{
+    local rv=0
+    local rc
+
+    __parallel_wait 0
+    touch "${__spooldir}/${__segment}.done"
+    exec 1>&${__stdout}
+    wait "${__printer_pid}"
+
+    for rc in "${__spooldir}"/*.rc; do
+	if [[ -s "${rc}" ]]; then
+	    rv=$((rv + $(cat "${rc}")))
+	fi
+    done
+    return ${rv}
+}
+
+__parallel_kill()
+{
+    local pid
+
+    for pid in "${__vm_pids[@]}" "${__printer_pid}"; do
+	pkill -P "${pid}" >/dev/null 2>&1
+	kill "${pid}" >/dev/null 2>&1
+    done
+    exec 1>&${__stdout}
 }
 
 pcibus_set_root()
@@ -1165,23 +1319,63 @@ rootfsname()
     echo "${__cachedir}/${rootfs%.gz}"
 }
 
-setup_rootfs()
+# Evict least recently used images until the image cache size is below
+# its limit. Must be called with the image cache lock held exclusively.
+__imagecache_evict()
 {
-    local rootfs=$1
-    local rootfspath="${__progdir}/${rootfs}"
-    if [[ ! -e "${rootfspath}" && -e "${rootfspath}.gz" ]]; then
-	rootfs="${rootfs}.gz"
-	rootfspath="${rootfspath}.gz"
-    fi
+    local keep="$1"
+    local max=$((__imagecache_size * 1024))
+    local size
+    local entry
+
+    # Leftovers from interrupted runs
+    find "${__imagecachedir}" -mindepth 1 -maxdepth 1 -name '.tmp.*' -mmin +60 \
+	-exec rm -rf {} + 2>/dev/null
+
+    size="$(du -s -k "${__imagecachedir}" | cut -f1)"
+    for entry in $(ls -1 -t -r "${__imagecachedir}"); do
+	if [[ ${size} -le ${max} ]]; then
+	    break
+	fi
+	entry="${__imagecachedir}/${entry}"
+	if [[ "${entry}" = "${keep}" ]]; then
+	    continue
+	fi
+	size=$((size - $(du -s -k "${entry}" | cut -f1)))
+	rm -rf "${entry}"
+    done
+}
+
+# Provide image $1 (optionally gzip compressed) as read-only file $2.
+# Images are decompressed once into the shared image cache, keyed by
+# their checksum, and linked to $2. Hard links are used if possible,
+# otherwise reflinks or (sparse) copies. The checksum is verified when
+# the image is added to the cache. If the image has no checksum file,
+# or if the checksum does not match, the image is copied as before.
+__setup_image()
+{
+    local srcpath="$1"
+    local destfile="$2"
+    local name="$(basename "${destfile}")"
+    local md5=""
+    local entry
+    local tmpdir
+    local lockfd
+    local keyfd
 
-    local destfile="$(rootfsname ${rootfs})"
+    mkdir -p "$(dirname "${destfile}")"
 
-    mkdir -p "${__cachedir}"
+    if [[ -e "${srcpath}.md5" ]]; then
+	md5="$(cut -d ' ' -f1 "${srcpath}.md5")"
+	entry="${__imagecachedir}/${md5}"
+    fi
 
     # Do nothing if file checksums exist and match.
     # Checksums are copied, not regenerated, so that should always work even
     # if the destination has been decompressed.
-    if cmp -s "${rootfspath}.md5" "${destfile}.md5"; then
+    if cmp -s "${srcpath}.md5" "${destfile}.md5"; then
+	# Mark as recently used
+	touch -c "${entry}"
 	echo "${destfile}"
 	return
     fi
@@ -1189,16 +1383,57 @@ setup_rootfs()
     # If we get here, clean up the cache first.
     rm -f "${destfile}" "${destfile}.md5"
 
-    cp "${rootfspath}" "${__cachedir}"
-    if [[ "${rootfs}" == *.gz ]]; then
-	gunzip -f "${destfile}.gz"
-	rootfs="${rootfs%.gz}"
-	# Make it sparse
-	fallocate -d "${destfile}"
+    if [[ -n "${md5}" ]]; then
+	mkdir -p "${__imagecachedir}"
+	# Serialize population of each image
+	exec {keyfd}>"${__imagecachedir}/.lock.${md5}"
+	flock -x "${keyfd}"
+	if [[ ! -e "${entry}/${name}" ]]; then
+	    if [[ "$(md5sum < "${srcpath}" | cut -d ' ' -f1)" = "${md5}" ]]; then
+		tmpdir="$(mktemp -d "${__imagecachedir}/.tmp.XXXXX")"
+		if [[ "${srcpath}" == *.gz ]]; then
+		    gunzip -c "${srcpath}" > "${tmpdir}/${name}"
+		    # Make it sparse
+		    fallocate -d "${tmpdir}/${name}"
+		else
+		    cp "${srcpath}" "${tmpdir}/${name}"
+		fi
+		# Cached files must not be modified.
+		chmod 444 "${tmpdir}/${name}"
+		exec {lockfd}>"${__imagecachedir}/.lock"
+		flock -x "${lockfd}"
+		rm -rf "${entry}"
+		mv "${tmpdir}" "${entry}"
+		__imagecache_evict "${entry}"
+		exec {lockfd}>&-
+	    else
+		echo "Checksum mismatch for ${srcpath}, not cached" >&2
+	    fi
+	fi
+	# Prevent eviction until the image is linked
+	exec {lockfd}>"${__imagecachedir}/.lock"
+	flock -s "${lockfd}"
+	if [[ -e "${entry}/${name}" ]]; then
+	    touch "${entry}"
+	    ln -f "${entry}/${name}" "${destfile}" 2>/dev/null || \
+		cp --reflink=auto --sparse=always "${entry}/${name}" "${destfile}"
+	fi
+	exec {lockfd}>&-
+	exec {keyfd}>&-
     fi
 
-    if [[ -e "${rootfspath}.md5" ]]; then
-	cp "${rootfspath}.md5" "${destfile}.md5"
+    if [[ ! -e "${destfile}" ]]; then
+	if [[ "${srcpath}" == *.gz ]]; then
+	    gunzip -c "${srcpath}" > "${destfile}"
+	    # Make it sparse
+	    fallocate -d "${destfile}"
+	else
+	    cp "${srcpath}" "${destfile}"
+	fi
+    fi
+
+    if [[ -e "${srcpath}.md5" ]]; then
+	cp "${srcpath}.md5" "${destfile}.md5"
     fi
 
     # Cached files must not be modified.
@@ -1209,6 +1444,18 @@ setup_rootfs()
     echo "${destfile}"
 }
 
+setup_rootfs()
+{
+    local rootfs=$1
+    local rootfspath="${__progdir}/${rootfs}"
+    if [[ ! -e "${rootfspath}" && -e "${rootfspath}.gz" ]]; then
+	rootfs="${rootfs}.gz"
+	rootfspath="${rootfspath}.gz"
+    fi
+
+    __setup_image "${rootfspath}" "$(rootfsname ${rootfs})"
+}
+
 fscachepath()
 {
     local fname="$(basename $1)"
@@ -1229,42 +1476,7 @@ setup_filesystem()
 	return
     fi
 
-    local destfile="$(fscachepath ${fsfile})"
-
-    # TODO: Handle the rest in a common function between root file
-    # system setup and this code.
-
-    mkdir -p "${__fscachedir}"
-
-    # Do nothing if file checksums exist and match.
-    # Checksums are copied, not regenerated, so that should always work even
-    # if the destination has been decompressed.
-    if cmp -s "${fspath}.md5" "${destfile}.md5"; then
-	echo "${destfile}"
-	return
-    fi
-
-    # If we get here, clean up the cache first.
-    rm -f "${destfile}" "${destfile}.md5"
-
-    cp "${fspath}" "${__fscachedir}"
-    if [[ "${fsfile}" == *.gz ]]; then
-	gunzip -f "${destfile}.gz"
-	fsfile="${fsfile%.gz}"
-	# Make it sparse
-	fallocate -d "${destfile}"
-    fi
-
-    if [[ -e "${fspath}.md5" ]]; then
-	cp "${fspath}.md5" "${destfile}.md5"
-    fi
-
-    # Cached files must not be modified.
-    chmod 444 "${destfile}"
-    if [[ -e "${destfile}.md5" ]]; then
-	chmod 444 "${destfile}.md5"
-    fi
-    echo "${destfile}"
+    __setup_image "${fspath}" "$(fscachepath ${fsfile})"
 }
 
 set_config()
@@ -2231,6 +2443,7 @@ dowait()
     local fsize_tmp
     local starttime
     local endtime
+    local watched=0
 
     # Give the process some time to start
     sleep 2
@@ -2243,7 +2456,49 @@ dowait()
 
     starttime="$(date +%s)"
 
-    while true
+    # Use the log file watcher if available. It reads the log file
+    # incrementally and returns as soon as the outcome is known.
+    if [[ -x "${__logwatch}" ]] && command -v python3 >/dev/null 2>&1; then
+	local watchargs=(--pid "${pid}" --looptime "${LOOPTIME}")
+	watchargs+=(--maxtime "${MAXTIME}" --maxstime "${MAXSTIME}")
+	if [ "${manual}" = "manual" ]; then
+	    watchargs+=(--manual "${waitlist[0]}")
+	fi
+	watched=1
+	"${__logwatch}" "${watchargs[@]}" "${logfile}"
+	case $? in
+	10)	# process exited
+	    wait ${pid} >/dev/null 2>&1
+	    if [[ $? -ne 0 ]]; then
+		msg="failed (qemu)"
+		retcode=1
+	    fi
+	    ;;
+	11)	# crashed
+	    msg="failed (crashed)"
+	    retcode=1
+	    dokill ${pid}
+	    ;;
+	12|13)	# crashed in machine restart, or done
+	    dokill ${pid}
+	    ;;
+	14)
+	    msg="failed (silent)"
+	    dokill ${pid}
+	    retcode=1
+	    ;;
+	15)
+	    msg="failed (timeout)"
+	    dokill ${pid}
+	    retcode=1
+	    ;;
+	*)	# watcher failed, fall back to polling
+	    watched=0
+	    ;;
+	esac
+    fi
+
+    while [[ ${watched} -eq 0 ]]
     do
         # terminate if process is no longer running
 	if [[ ! -d "/proc/${pid}" ]]; then
@@ -2486,21 +2741,126 @@ dowait()
     return ${retcode}
 }
 
+# Result cache.
+#
+# The output of passed qemu sessions is cached, keyed by everything the
+# session depends on: the kernel source tree, kernel configuration, and
+# toolchain, the qemu version and command line, the checksums of root file
+# systems and other images, and the test scripts. Sessions with a cached
+# result are not started; their output is replayed instead. The cache is
+# only used if the source tree has no local modifications.
+
+# Initialize the result cache. Must be called from the source tree.
+# Returns 0 if the cache is enabled.
+__resultcache_init()
+{
+    local tree
+
+    if [[ "${__resultcache}" = "2" ]]; then
+	return 0
+    fi
+    if [[ "${__resultcache}" != "1" ]]; then
+	return 1
+    fi
+    __resultcache=0
+    if [[ -n "$(git status --porcelain -uno 2>/dev/null)" ]]; then
+	return 1
+    fi
+    if ! tree="$(git rev-parse -q --verify 'HEAD^{tree}')"; then
+	return 1
+    fi
+    __resultcache_base="${tree} $(cat "$0" "${__basedir}/scripts/common.sh" | md5sum)"
+    mkdir -p "${__resultcachedir}"
+    find "${__resultcachedir}" -type f -mtime +${__resultcache_days} -delete 2>/dev/null
+    __resultcache=2
+    return 0
+}
+
+# Print the result cache key of a qemu session.
+__resultcache_key()
+{
+    local waitflag=$1
+    local waitlist=("${!2}")
+    local cmd="$3"
+    local x
+    local p
+
+    shift 3
+
+    {
+	echo "${__resultcache_base}"
+	echo "${ARCH} ${PREFIX} $(${PREFIX}gcc --version 2>/dev/null | head -n 1)"
+	"${cmd}" --version 2>/dev/null | head -n 1
+	md5sum < "${qemu_builddir}/.config"
+	echo "${waitflag} ${waitlist[*]} ${__do_network_test} ${__do_tpm_test}"
+	for x in "$@"; do
+	    # Names of temporary files differ from run to run; their
+	    # contents are covered by the checksums below.
+	    echo "${x}" | sed -e "s,${__swtpmdir},swtpm,g" -e 's,/tmp/[^,= ]*,tmp,g'
+	    for p in ${x//[=,]/ }; do
+		if [[ -e "${p}.md5" ]]; then
+		    cat "${p}.md5"
+		elif [[ "${p}" == /* && -f "${p}" ]]; then
+		    md5sum < "${p}"
+		fi
+	    done
+	done
+    } | sha256sum | cut -d ' ' -f1
+}
+
+# Run qemu session with __run_qemu and cache its output if it passed.
+# The first parameter is the result cache key, or empty.
+__run_qemu_cached()
+{
+    local key=$1
+    local out
+    local retcode
+
+    shift
+
+    if [[ -z "${key}" ]]; then
+	__run_qemu "$@"
+	return
+    fi
+
+    out="$(__mktemp /tmp/result.XXXXX)"
+    __run_qemu "$@" > >(tee "${out}")
+    retcode=$?
+    # Wait for all output to be written
+    wait $!
+
+    if [[ ${retcode} -eq 0 ]]; then
+	cp "${out}" "${__resultcachedir}/.tmp.${key}" && \
+	    mv "${__resultcachedir}/.tmp.${key}" "${__resultcachedir}/${key}"
+    fi
+    return ${retcode}
+}
+
 execute()
 {
     local waitflag=$1
     local waitlist=("${!2}")
     local cmd="$3"
-    local pid
     local logfile="$(__mktemp /tmp/run.XXXXX)"
-    local retries=0
     local retcode
-    local last=0
+    local key=""
 
     shift; shift; shift
 
     echo -n "running ..."
 
+    if [[ -e "${qemu_builddir}/.config" ]] && __resultcache_init; then
+	key="$(__resultcache_key "${waitflag}" waitlist[@] "${cmd}" "$@")"
+	if [[ -s "${__resultcachedir}/${key}" ]]; then
+	    touch "${__resultcachedir}/${key}"
+	    # Mark the result as replayed so that it is not mistaken for
+	    # a new boot (boot times are derived from the result line).
+	    sed '0,/ passed$/s// passed (cached)/' "${__resultcachedir}/${key}"
+	    echo "Cached result ${key:0:12}"
+	    return 0
+	fi
+    fi
+
     pushd "${qemu_builddir}" >/dev/null
 
     if [[ ${dodebug} -ne 0 ]]; then
@@ -2549,6 +2909,32 @@ execute()
 	echo
     fi
 
+    if [[ -n "${__spooldir}" ]]; then
+	__run_qemu_parallel "${key}" "${logfile}" "${waitflag}" waitlist[@] "${cmd}" "$@"
+    else
+	__run_qemu_cached "${key}" "${logfile}" "${waitflag}" waitlist[@] "${cmd}" "$@"
+    fi
+    retcode=$?
+
+    popd >/dev/null
+
+    return ${retcode}
+}
+
+# Run qemu session, with retries, and wait for it to complete.
+__run_qemu()
+{
+    local logfile=$1
+    local waitflag=$2
+    local waitlist=("${!3}")
+    local cmd="$4"
+    local pid
+    local retries=0
+    local retcode
+    local last=0
+
+    shift 4
+
     while [[ ${retries} -le ${__retries} ]]; do
 	if [[ ${retries} -eq ${__retries} ]]; then
 	    last=1
@@ -2577,7 +2963,56 @@ execute()
 	retries=$((retries + 1))
     done
 
-    popd >/dev/null
-
     return ${retcode}
 }
+
+# Start qemu session in the background. The session gets its own copy
+# of the build artifacts it uses (kernel, dtb), so the next kernel can be
+# built while it runs, and its own swtpm instance. Always returns 0; the
+# session's return code is added to the script's exit code.
+__run_qemu_parallel()
+{
+    local key=$1
+    local logfile=$2
+    local waitflag=$3
+    local waitlist=("${!4}")
+    local cmd="$5"
+    local seg="${__spooldir}/${__segment}"
+    local vmdir="${seg}.vm"
+    local args=()
+    local x
+
+    shift 5
+
+    __parallel_wait $((__parallel - 1))
+
+    mkdir -p "${vmdir}"
+    for x in "$@"; do
+	if [[ "${x}" != /* && -f "${x}" ]]; then
+	    mkdir -p "${vmdir}/$(dirname "${x}")"
+	    cp "${x}" "${vmdir}/${x}"
+	fi
+	args+=("${x//"${__swtpmsock}"/${vmdir}/swtpm-sock}")
+    done
+
+    # The next segment must exist before this one is complete.
+    : > "${__spooldir}/$((__segment + 1))"
+    (
+	trap - ${signals}
+	__swtpmdir="${vmdir}"
+	__swtpmsock="${vmdir}/swtpm-sock"
+	__swtpmpidfile="${vmdir}/swtpm.pid"
+	cd "${vmdir}"
+	__run_qemu_cached "${key}" "${logfile}" "${waitflag}" waitlist[@] "${cmd}" "${args[@]}"
+	echo "$?" > "${seg}.rc"
+	__stop_tpm
+	rm -rf "${vmdir}"
+	touch "${seg}.done"
+    ) >> "${seg}" 2>&1 &
+    __vm_pids+=($!)
+
+    __segment=$((__segment + 1))
+    exec 1>>"${__spooldir}/${__segment}"
+
+    return 0
+}
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Watch a qemu log file for a running qemu process.
+#
+# Used by dowait() in common.sh in place of its polling loop. Instead of
+# grepping the entire log file every LOOPTIME seconds, the log is read
+# incrementally from the last offset and all conditions are checked in a
+# single pass over new data. The watcher returns as soon as a decisive
+# line is seen. After a crash, it keeps reading until the log is quiet for
+# --crashquiet seconds (at most --crashtime seconds), so the backtrace
+# printed after the crash line makes it into the log before qemu is killed.
+#
+# As with the polling loop, one '.' is printed for each LOOPTIME seconds
+# spent waiting. The log analyzer on the build master uses the number of
+# dots to calculate boot times.
+#
+# Exit codes (dowait falls back to its polling loop for any other code):
+#   10	qemu process exited
+#   11	crashed
+#   12	crashed, but the crash happened during machine restart (ignored)
+#   13	the message to wait for (first waitlist entry) was seen
+#   14	no output for more than MAXSTIME seconds
+#   15	no completion within MAXTIME seconds
+
+import argparse
+import os
+import re
+import sys
+import time
+
+EXITED = 10
+CRASHED = 11
+CRASH_IGNORED = 12
+DONE = 13
+SILENT = 14
+TIMEOUT = 15
+
+crash = re.compile(r'Oops: |Kernel panic|Internal error:|segfault|BUG: spinlock recursion')
+restart = re.compile(r'^machine restart', re.M)
+
+# Maximum length of incomplete lines kept for matching
+maxpartial = 65536
+
+
+def grep_pattern(pattern):
+    # Convert a grep basic regular expression to a python regular expression.
+    # Only the subset used in waitlists is supported.
+    result = ''
+    escaped = False
+    for c in pattern:
+        if escaped:
+            if c in '|(){}+?':
+                result += c
+            else:
+                result += '\\' + c
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in '|(){}+?':
+            result += '\\' + c
+        else:
+            result += c
+    return re.compile(result, re.M)
+
+
+def running(pid):
+    return os.path.isdir('/proc/%d' % pid)
+
+
+def watch(args):
+    marker = grep_pattern(args.manual) if args.manual else None
+    fd = os.open(args.logfile, os.O_RDONLY)
+    offset = 0
+    partial = ''
+    crashed = False
+    restarted = False
+    dots = 0
+    crashtime = None
+    start = time.time()
+    lastchange = start
+
+    while True:
+        if not crashed and not running(args.pid):
+            return EXITED
+
+        data = os.pread(fd, 1 << 20, offset)
+        while data:
+            offset += len(data)
+            lastchange = time.time()
+            text = partial + data.decode('latin-1')
+            # Keep the last, possibly incomplete, line for the next pass
+            # since patterns may span chunks.
+            end = text.rfind('\n') + 1
+            lines, partial = text[:end], text[end:]
+            if len(partial) > maxpartial:
+                partial = partial[-maxpartial:]
+            for chunk in (lines, partial):
+                if marker and marker.search(chunk):
+                    return DONE
+                if not crashed and crash.search(chunk):
+                    crashed = True
+                if not restarted and restart.search(chunk):
+                    restarted = True
+            data = os.pread(fd, 1 << 20, offset)
+
+        # As in the polling loop, wait for the marker before checking for
+        # a crash since some kernels crash on reboot.
+        now = time.time()
+        if crashed:
+            if crashtime is None:
+                crashtime = now
+            if (now - lastchange >= args.crashquiet or
+                    now - crashtime >= args.crashtime or
+                    not running(args.pid)):
+                return CRASH_IGNORED if restarted else CRASHED
+        if now - lastchange > args.maxstime:
+            return SILENT
+        if now - start > args.maxtime:
+            return TIMEOUT
+
+        while now - start >= (dots + 1) * args.looptime:
+            dots += 1
+            sys.stdout.write('.')
+            sys.stdout.flush()
+
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch qemu log file')
+    parser.add_argument('--pid', type=int, required=True,
+        help='qemu process id')
+    parser.add_argument('--looptime', type=float, default=5,
+        help='Print a dot every looptime seconds')
+    parser.add_argument('--maxtime', type=float, default=180,
+        help='Maximum time to wait for completion')
+    parser.add_argument('--maxstime', type=float, default=60,
+        help='Maximum time to wait for output')
+    parser.add_argument('--manual',
+        help='Pattern indicating that the qemu session is done')
+    parser.add_argument('--crashquiet', type=float, default=2,
+        help='After a crash, wait until there is no output for this long')
+    parser.add_argument('--crashtime', type=float, default=15,
+        help='Maximum time to wait for output after a crash')
+    parser.add_argument('--interval', type=float, default=0.05,
+        help='Poll interval')
+    parser.add_argument('logfile')
+    sys.exit(watch(parser.parse_args()))